@@ -1,6 +1,7 @@
 import asyncio
 import time
 import motor.motor_asyncio as motor
+from pymongo.errors import BulkWriteError
 from sys import argv
 from encryption.rsa import RsaKeyGenerator
 from encryption.passwords import PasswordHasher
@@ -11,19 +12,166 @@ from config import yaml_config
 
 # используется для ручного индексирования коллекций в базе
 # init-mongo.js делает это автоматически
-async def init_db(db: motor.AsyncIOMotorDatabase):
+async def init_db(db: motor.AsyncIOMotorDatabase, layout):
     users = db["users"]
 
     await users.create_index("login", unique=True)
+    await users.create_index("last-seen")
+    # для people без справочника пользователей в памяти (db.user_directory: false)
+    await users.create_index([("username", 1), ("_id", 1)])
+    await users.create_index([("role", 1), ("_id", 1)])
+    await users.create_index([("is-online", 1), ("last-seen", 1), ("_id", 1)])
 
     files = db["files"]
 
     await files.create_index("token", unique=True)
 
+    # для удаления брошенных загрузок
+    await db["uploads"].create_index("time")
+
     chats = db["chats"]
 
     await chats.create_index("users")
 
+    # ключ пары пользователей для бесед, созданных до его появления
+    async for chat in chats.find({"key": {"$exists": False}}):
+        key = "-".join(sorted(str(x) for x in chat["users"]))
+        await chats.update_one({"_id": chat["_id"]}, {"$set": {"key": key}})
+
+    await chats.create_index("key", unique=True, partialFilterExpression={"key": {"$exists": True}})
+
+    summaries = db["chat-summaries"]
+
+    await summaries.create_index([("user", 1), ("peer", 1)], unique=True)
+    await summaries.create_index([("user", 1), ("time", -1), ("message-id", -1)])
+    await summaries.create_index([("user", 1), ("read-at", 1)])
+    await summaries.create_index([("peer", 1), ("read-at", 1)])
+
+    messages = db["messages"]
+
+    await messages.create_index([("chat", 1), ("time", -1), ("_id", -1)])
+
+    # коллекции бесед, созданных до появления индекса; новым беседам индекс создает сервер
+    if layout != "single":
+        async for chat in chats.find({}, {"name": 1}):
+            await db[chat["name"]].create_index([("time", 1), ("_id", 1)])
+
+
+def chat_messages(db: motor.AsyncIOMotorDatabase, layout, name):
+    if layout == "single":
+        return db["messages"], {"chat": name}
+    return db[name], {}
+
+
+# переносит сообщения из коллекций отдельных бесед в общую коллекцию messages;
+# _id сообщений сохраняются, поэтому повторный запуск пропускает уже перенесенные сообщения
+async def migrate_chats(db: motor.AsyncIOMotorDatabase, batch_size=1000):
+    chats = db["chats"]
+    messages = db["messages"]
+
+    migrated = 0
+
+    async def flush(batch):
+        try:
+            await messages.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            if any(x["code"] != 11000 for x in e.details["writeErrors"]):
+                raise
+        return len(batch)
+
+    async for chat in chats.find():
+        batch = []
+        async for message in db[chat["name"]].find(batch_size=batch_size):
+            message["chat"] = chat["name"]
+            batch.append(message)
+            if len(batch) >= batch_size:
+                migrated += await flush(batch)
+                batch = []
+        if batch:
+            migrated += await flush(batch)
+
+    print(f"Перенесено сообщений: {migrated}. Коллекции бесед не удалены - "
+          f"после проверки переключите db.layout на single")
+
+
+# отметка о прочтении из старого поля seen сообщений - последнее прочитанное полученное сообщение,
+# и число полученных сообщений после нее
+async def legacy_read_mark(collection, scope, user_id):
+    received = {**scope, "receiver-id": user_id}
+    seen = await collection.find_one({**received, "seen": True}, {"time": 1},
+                                     sort=[("time", -1), ("_id", -1)])
+    mark = {}
+    if seen is not None:
+        mark = {"read-time": seen["time"], "read-id": seen["_id"]}
+        received["$or"] = [{"time": {"$gt": seen["time"]}},
+                           {"time": seen["time"], "_id": {"$gt": seen["_id"]}}]
+    return mark, await collection.count_documents(received)
+
+
+# заполняет chat-summaries по уже существующим беседам
+async def build_summaries(db: motor.AsyncIOMotorDatabase, layout):
+    chats = db["chats"]
+    summaries = db["chat-summaries"]
+    files = db["files"]
+
+    async for chat in chats.find():
+        collection, scope = chat_messages(db, layout, chat["name"])
+
+        last = await collection.find_one(scope, sort=[("time", -1), ("_id", -1)])
+        if last is None:
+            continue
+
+        for user_id in chat["users"]:
+            peer_id = next((x for x in chat["users"] if x != user_id), user_id)
+            message = next(x for x in last["messages"] if x["target"] == user_id)
+
+            server_files = []
+            async for f in files.find({"_id": {"$in": message["files"]}}, {"_id": 0, "owner-id": 0}):
+                server_files.append(f)
+
+            mark, unread = await legacy_read_mark(collection, scope, user_id)
+
+            await summaries.update_one({"user": user_id, "peer": peer_id}, {"$set": {
+                "chat": chat["name"],
+                "time": last["time"],
+                "message-id": last["_id"],
+                "unread": unread,
+                **mark,
+                "last-message": {
+                    "sender": last["sender-id"],
+                    "receiver": last["receiver-id"],
+                    "seen": last.get("seen", False),
+                    "text": message["text"],
+                    "time": last["time"],
+                    "cursor": f"{last['time']}-{last['_id']}",
+                    "files": server_files
+                }
+            }}, upsert=True)
+
+    print("Сводки бесед построены")
+
+
+# переносит состояние прочтения из поля seen сообщений в отметки сводок бесед;
+# сводки, у которых отметка уже есть, не изменяются, поэтому повторный запуск безопасен
+async def build_read_marks(db: motor.AsyncIOMotorDatabase, layout):
+    summaries = db["chat-summaries"]
+    updated = 0
+
+    async for summary in summaries.find({"read-time": {"$exists": False}}, {"user": 1, "chat": 1}):
+        collection, scope = chat_messages(db, layout, summary["chat"])
+        mark, unread = await legacy_read_mark(collection, scope, summary["user"])
+        if not mark:
+            continue
+        await summaries.update_one({"_id": summary["_id"], "read-time": {"$exists": False}},
+                                   {"$set": {**mark, "unread": unread}})
+        updated += 1
+
+    # индекс по seen больше не используется
+    if "chat_1_receiver-id_1_seen_1" in await db["messages"].index_information():
+        await db["messages"].drop_index("chat_1_receiver-id_1_seen_1")
+
+    print(f"Отметок о прочтении перенесено: {updated}")
+
 
 async def create_user(db: motor.AsyncIOMotorDatabase, pswd):
     username = input("Введите имя и фамилию пользователя: ")
@@ -78,11 +226,20 @@ async def main():
 
     client = motor.AsyncIOMotorClient(connection_string)
     db = client['smln-server']
-    password_hasher = PasswordHasher(cfg.crypto.hash_alg)
+    password_hasher = PasswordHasher.from_config(cfg.crypto)
 
     try:
         if argv[2] == "init_db":
-            await init_db(db)
+            await init_db(db, cfg.db.get("layout", "per-chat"))
+
+        elif argv[2] == "build_summaries":
+            await build_summaries(db, cfg.db.get("layout", "per-chat"))
+
+        elif argv[2] == "build_read_marks":
+            await build_read_marks(db, cfg.db.get("layout", "per-chat"))
+
+        elif argv[2] == "migrate_chats":
+            await migrate_chats(db)
 
         elif argv[2] == 'create_user':
             await create_user(db, password_hasher)
@@ -0,0 +1,146 @@
+# Скорость (МБ/с) и пиковое потребление памяти процесса при передаче файла:
+# целиком в JSON, кусками base64 в JSON и бинарными кадрами websocket.
+# Каждый вариант запускается в отдельном процессе, чтобы пиковый RSS не смешивался.
+# Запуск: python -m bench.binary_frames [размер файла в МБ]
+import asyncio
+import base64
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+from bson import ObjectId
+
+from core.codecs import Codecs
+from core.connection import Connection
+from core.connection_registry import ConnectionRegistry
+from db.file_store import FileStore
+
+MODES = ["json-download", "base64-stream", "binary-stream", "json-upload", "binary-upload"]
+CHUNK = 256 * 1024
+
+
+# Минимальная замена базы данных: один пользователь и один файл в FileStore
+class FileDB:
+    def __init__(self, root):
+        self.file_store = FileStore(root)
+        self.user_id = ObjectId()
+        self.path = None
+        self.size = 0
+        self.uploads = {}
+
+    async def validate_password(self, login, password):
+        return True, self.user_id, "", ""
+
+    async def make_user_online(self, user_id):
+        return {"user-id": user_id, "is-online": True, "last-seen": int(time.time())}
+
+    async def make_user_offline(self, user_id):
+        return {"user-id": user_id, "is-online": False, "last-seen": int(time.time())}
+
+    async def get_file(self, user_id, token):
+        return self.path, self.size
+
+    async def download(self, user_id, token):
+        return (await self.file_store.read(self.path)).decode("utf-8"), True
+
+    async def read_file(self, path, offset, length):
+        return await self.file_store.read_range(path, offset, length)
+
+    async def read_file_into(self, path, offset, buffer):
+        return await self.file_store.read_range_into(path, offset, buffer)
+
+    async def upload_begin(self, owner_id, name, size):
+        self.uploads["u"] = {"received": 0, "size": size}
+        return "u"
+
+    async def upload_chunk(self, owner_id, upload_id, offset, data):
+        upload = self.uploads[upload_id]
+        await self.file_store.write_at(self.file_store.upload_path(upload_id), offset, data)
+        upload["received"] += len(data)
+        return upload, True
+
+
+async def run(mode, size):
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp()
+    db = FileDB(root)
+
+    # содержимое - текст (base64), как у вложений, которые клиенты присылают в "data"
+    src = os.path.join(root, "src")
+    with open(src, "wb") as f:
+        written = 0
+        while written < size:
+            block = base64.b64encode(os.urandom(3 * 2 ** 16))[:size - written]
+            f.write(block)
+            written += len(block)
+    digest = await db.file_store.put_file(src)
+    db.path, db.size = db.file_store.path(digest), size
+
+    handler = Connection.connect(ConnectionRegistry(logging.getLogger("bench")), db, logging.getLogger("bench"),
+                                 Codecs(), 1, CHUNK)
+    async with websockets.serve(handler, "127.0.0.1", 0, max_size=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://127.0.0.1:{port}", max_size=None) as ws:
+            await ws.send(json.dumps({"type": "auth", "args": {"login": "", "pass": ""}}))
+            await ws.recv()
+            await ws.recv()
+
+            start = time.perf_counter()
+            received = 0
+            if mode == "json-download":
+                await ws.send(json.dumps({"type": "download", "args": {"token": "t"}}))
+                received = len(json.loads(await ws.recv())["args"]["data"])
+            elif mode in ("base64-stream", "binary-stream"):
+                binary = mode == "binary-stream"
+                await ws.send(json.dumps({"type": "download", "args": {"token": "t", "stream": True,
+                                                                       "binary": binary}}))
+                await ws.recv()
+                while received < size:
+                    frame = await ws.recv()
+                    if binary:
+                        received += len(frame)
+                    else:
+                        received += len(base64.b64decode(json.loads(frame)["args"]["data"]))
+            else:
+                binary = mode == "binary-upload"
+                await ws.send(json.dumps({"type": "upload-begin", "args": {"name": "f", "size": size}}))
+                await ws.recv()
+                with open(db.path, "rb") as f:
+                    while chunk := f.read(CHUNK):
+                        args = {"upload-id": "u", "offset": received, "binary": binary}
+                        if binary:
+                            await ws.send(json.dumps({"type": "upload-chunk", "args": args}))
+                            await ws.send(chunk)
+                        else:
+                            args["data"] = base64.b64encode(chunk).decode("ascii")
+                            await ws.send(json.dumps({"type": "upload-chunk", "args": args}))
+                        await ws.recv()
+                        received += len(chunk)
+            elapsed = time.perf_counter() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"mode": mode, "mb_s": received / elapsed / 2 ** 20, "peak_rss_mb": rss}))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--mode":
+        asyncio.run(run(sys.argv[2], int(sys.argv[3])))
+        return
+
+    size = int(float(sys.argv[1]) * 2 ** 20) if len(sys.argv) > 1 else 50 * 2 ** 20
+    print(f"file size: {size / 2 ** 20:.1f} MB")
+    for mode in MODES:
+        out = subprocess.run([sys.executable, "-m", "bench.binary_frames", "--mode", mode, str(size)],
+                             capture_output=True, text=True, check=True, cwd=os.getcwd()).stdout
+        res = json.loads(out.splitlines()[-1])
+        print(f"{mode:>14}: {res['mb_s']:8.1f} MB/s, peak RSS {res['peak_rss_mb']:8.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
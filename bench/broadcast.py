@@ -0,0 +1,81 @@
+# Сравнение последовательной рассылки activity-update с рассылкой через Broadcaster.
+# Запуск: python -m bench.broadcast [число соединений ...]
+import asyncio
+import logging
+import random
+import time
+from sys import argv
+
+from core.codecs import JsonCodec
+from core.connection_registry import ConnectionRegistry
+
+
+class FakeWebSocket:
+    def __init__(self, delay):
+        self.delay = delay
+        self.closed = False
+        self.sent = 0
+
+    async def send(self, data):
+        # имитация записи в сокет: большинство отправок мгновенные, часть ждет сеть
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        else:
+            await asyncio.sleep(0)
+        self.sent += 1
+
+
+class FakeConnection:
+    def __init__(self, user_id, delay):
+        self.user_id = user_id
+        self.ws = FakeWebSocket(delay)
+        self.id = user_id
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    codec = JsonCodec()
+
+    async def send_json(self, msg):
+        await self.ws.send(self.codec.encode(msg))
+
+
+def make_registry(n, slow_share=0.01, slow_delay=0.005):
+    registry = ConnectionRegistry(logging.getLogger("bench"))
+    rnd = random.Random(n)
+    for i in range(n):
+        delay = slow_delay if rnd.random() < slow_share else 0
+        registry.authorized[i] = FakeConnection(i, delay)
+    return registry
+
+
+async def sequential(registry, msg):
+    for conn in registry.authorized.values():
+        await conn.send_json(msg)
+
+
+async def run(n):
+    msg = {"type": "activity-update", "args": {"user-id": "0" * 24, "is-online": True, "last-seen": int(time.time())}}
+
+    registry = make_registry(n)
+    start = time.perf_counter()
+    await sequential(registry, msg)
+    seq = time.perf_counter() - start
+
+    registry = make_registry(n)
+    start = time.perf_counter()
+    await registry.broadcast(msg)
+    conc = time.perf_counter() - start
+
+    print(f"{n:>6} connections: sequential {seq * 1000:9.2f} ms, broadcaster {conc * 1000:9.2f} ms")
+
+
+async def main():
+    sizes = [int(x) for x in argv[1:]] or [1000, 10000]
+    for n in sizes:
+        await run(n)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+# Сравнение драйверов БД на одной нагрузке: вход, смена статуса, отправка сообщений с вложениями,
+# people, people-with-messages, messages и read выполняются параллельно от многих "соединений".
+# MongoDB измеряется, только если передана строка подключения; используется отдельная база smln-bench.
+# Запуск: python -m bench.db_drivers [число пользователей] [число сообщений] [mongodb://host:port]
+import asyncio
+import os
+import random
+import tempfile
+import time
+from sys import argv
+
+from bson import ObjectId
+
+from db import InMemoryDB, MongoDB, SQLiteDB
+from encryption.passwords import PasswordHasher
+
+CONCURRENCY = 64
+
+
+def make_users(n, hashed):
+    return [{"_id": ObjectId(), "login": f"user{i}", "password": hashed, "username": f"User {i}", "role": "user",
+             "public-key": "", "private-key": "", "is-online": False, "last-seen": 0} for i in range(n)]
+
+
+async def make_in_memory(hasher, users, root):
+    db = InMemoryDB(hasher, files_root=root)
+    for user in users:
+        db.add_user(user)
+    return db
+
+
+async def make_sqlite(hasher, users, root):
+    db = SQLiteDB(os.path.join(root, "bench.db"), hasher, files_root=root)
+    await db.start()
+    await asyncio.gather(*(db.add_user(user) for user in users))
+    return db
+
+
+async def make_mongo(hasher, users, root, conn_str):
+    from admin_mongo_db import init_db
+
+    db = MongoDB(conn_str, hasher, layout="single", files_root=root)
+    db.db = db.db.client["smln-bench"]
+    await db.db.client.drop_database("smln-bench")
+    await init_db(db.db)
+    await db.db["users"].insert_many([dict(user) for user in users])
+    await db.start()
+    return db
+
+
+async def workload(db, users, messages):
+    ids = [user["_id"] for user in users]
+    rnd = random.Random(len(users))
+    # для каждой операции: число вызовов, время фазы и задержки отдельных вызовов
+    results = {}
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def phase(name, cors):
+        latencies = []
+
+        async def timed(cor):
+            async with semaphore:
+                start = time.perf_counter()
+                await cor
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed(cor) for cor in cors))
+        results[name] = (time.perf_counter() - start, sorted(latencies))
+
+    await phase("validate-password", [db.validate_password(u["login"], "password") for u in users])
+    await phase("make-user-online", [db.make_user_online(i) for i in ids])
+
+    pairs = [rnd.sample(ids, 2) for _ in range(messages)]
+    attachment = "x" * 1024
+
+    def send(sender, receiver, n):
+        files = [{"name": "a.txt", "data": attachment}] if n % 4 == 0 else []
+        message = {"text": f"message {n}", "files": files}
+        return db.send_message(sender, receiver, message, message)
+
+    await phase("send-message", [send(s, r, n) for n, (s, r) in enumerate(pairs)])
+    await phase("people", [db.people({"count": 50, "from": rnd.randrange(len(ids))}) for _ in ids])
+    await phase("people-with-messages", [db.people_with_messages(i, {"count": 20}) for i in ids])
+    await phase("messages", [db.messages(r, s, {"count": 30}) for s, r in pairs[:len(ids)]])
+    await phase("read", [db.read(r, s) for s, r in pairs[:len(ids)]])
+    await phase("make-user-offline", [db.make_user_offline(i) for i in ids])
+
+    return results
+
+
+async def run(name, make, users, messages):
+    root = tempfile.mkdtemp()
+    hasher = PasswordHasher("sha3_256", executor="thread")
+    users = make_users(users, hasher.hash_password("password"))
+    db = await make(hasher, users, root)
+
+    results = await workload(db, users, messages)
+
+    print(f"{name}: {sum(elapsed for elapsed, _ in results.values()):.2f} s total")
+    for op, (elapsed, values) in results.items():
+        print(f"  {op:>22}: {len(values) / elapsed:9.0f} ops/s, "
+              f"p50 {values[len(values) // 2] * 1000:7.2f} ms, p99 {values[int(len(values) * 0.99)] * 1000:7.2f} ms")
+
+    if hasattr(db, "close"):
+        await db.close()
+
+
+async def main():
+    users = int(argv[1]) if len(argv) > 1 else 1000
+    messages = int(argv[2]) if len(argv) > 2 else 10000
+
+    drivers = [("InMemoryDB", make_in_memory), ("SQLiteDB", make_sqlite)]
+    if len(argv) > 3:
+        conn_str = argv[3]
+        drivers.append(("MongoDB", lambda hasher, u, root: make_mongo(hasher, u, root, conn_str)))
+
+    print(f"{users} users, {messages} messages, {CONCURRENCY} concurrent operations")
+    for name, make in drivers:
+        await run(name, make, users, messages)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+# Нагрузочный тест всего сервера: serve() из main.py запускается в этом же процессе с драйвером
+# InMemoryDB, тысячи клиентов входят, запрашивают people и people-with-messages, отправляют
+# друг другу сообщения с вложениями и отключаются. Результаты сохраняются в JSON, чтобы
+# сравнивать их между версиями.
+# Запуск: python -m bench.load [число клиентов] [число циклов запросов на клиента] [файл результатов]
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import tempfile
+import time
+from collections import Counter, defaultdict
+from sys import argv
+
+import websockets
+
+from config import Config
+from db import InMemoryDB
+from encryption.passwords import PasswordHasher
+from main import serve
+
+ATTACHMENT = base64.b64encode(os.urandom(3 * 1024)).decode("ascii")
+CONNECT_CONCURRENCY = 100
+
+
+def make_db(clients):
+    hasher = PasswordHasher("sha3_256", executor="thread")
+    hashed = hasher.hash_password("password")
+    db = InMemoryDB(hasher, files_root=tempfile.mkdtemp())
+    for i in range(clients):
+        db.add_user({"login": f"user{i}", "password": hashed, "username": f"User {i}", "role": "user",
+                     "public-key": "", "private-key": ""})
+    return db
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summary(values):
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else None,
+        "p50_ms": percentile(values, 0.5) * 1000 if values else None,
+        "p99_ms": percentile(values, 0.99) * 1000 if values else None,
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+        self.delivery = []
+        self.events = Counter()
+
+
+class Client:
+    def __init__(self, login, stats):
+        self.login = login
+        self.stats = stats
+        self.ws = None
+        self.id = None
+        self.reader = None
+        self.pending = {}
+        self.next_request_id = 0
+
+    async def connect(self, url):
+        self.ws = await websockets.connect(url, max_size=None)
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        try:
+            async for frame in self.ws:
+                msg = json.loads(frame)
+                request_id = msg.get("request-id")
+                if request_id is not None:
+                    self.pending.pop(request_id).set_result(msg)
+                elif msg["type"] == "message-received":
+                    # текст сообщения - момент отправки по часам этого же процесса
+                    sent = float(msg["args"]["message"]["text"])
+                    self.stats.delivery.append(time.perf_counter() - sent)
+                else:
+                    self.stats.events[msg["type"]] += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def request(self, type_, args):
+        self.next_request_id += 1
+        request_id = self.next_request_id
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+
+        start = time.perf_counter()
+        await self.ws.send(json.dumps({"type": type_, "args": args, "request-id": request_id}))
+        response = await future
+        self.stats.latency[type_].append(time.perf_counter() - start)
+
+        if response["status"]["status"] != 0:
+            self.stats.errors[type_] += 1
+        return response
+
+    async def auth(self):
+        response = await self.request("auth", {"login": self.login, "pass": "password"})
+        self.id = response["args"]["id"]
+
+    async def work(self, rounds, peers, rnd):
+        for _ in range(rounds):
+            await self.request("people", {"list-properties": {"count": 50}})
+            await self.request("people-with-messages", {"list-properties": {"count": 20}})
+
+            peer = rnd.choice(peers)
+            while peer == self.id:
+                peer = rnd.choice(peers)
+            message = {"text": repr(time.perf_counter()), "files": [{"name": "a.txt", "data": ATTACHMENT}]}
+            await self.request("send", {"receiver-id": peer, "message-for-receiver": message,
+                                        "message-for-sender": message})
+
+    async def close(self):
+        await self.ws.close()
+        await self.reader
+
+
+async def run(clients, rounds):
+    logging.getLogger("smln").setLevel(logging.WARNING)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    rss_before = rss_mb()
+    port = free_port()
+    cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0})})
+    server = asyncio.create_task(serve(cfg, db=make_db(clients)))
+
+    url = f"ws://127.0.0.1:{port}"
+    while True:
+        try:
+            async with websockets.connect(url):
+                break
+        except OSError:
+            await asyncio.sleep(0.05)
+
+    stats = Stats()
+    phases = {}
+    population = [Client(f"user{i}", stats) for i in range(clients)]
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def login(client):
+        async with semaphore:
+            await client.connect(url)
+            await client.auth()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login(c) for c in population))
+    phases["login_s"] = time.perf_counter() - start
+    rss_connected = rss_mb()
+
+    peers = [c.id for c in population]
+    rnd = random.Random(clients)
+    start = time.perf_counter()
+    await asyncio.gather(*(c.work(rounds, peers, random.Random(rnd.random())) for c in population))
+    phases["work_s"] = time.perf_counter() - start
+
+    # доставка последних сообщений могла еще не закончиться
+    expected = clients * rounds
+    deadline = time.perf_counter() + 5
+    while len(stats.delivery) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(c.close() for c in population))
+    phases["disconnect_s"] = time.perf_counter() - start
+
+    server.cancel()
+    try:
+        await server
+    except asyncio.CancelledError:
+        pass
+
+    work_requests = sum(len(stats.latency[t]) for t in ("people", "people-with-messages", "send"))
+    return {
+        "clients": clients,
+        "rounds": rounds,
+        "phases": phases,
+        "throughput_rps": work_requests / phases["work_s"],
+        "requests": {t: {**summary(v), "errors": stats.errors[t]} for t, v in stats.latency.items()},
+        "delivery": {**summary(stats.delivery), "expected": expected},
+        "events": dict(stats.events),
+        # клиенты работают в том же процессе, поэтому RSS включает и их
+        "rss_mb": {"before": rss_before, "connected": rss_connected, "peak": peak_rss_mb()},
+    }
+
+
+def main():
+    clients = int(argv[1]) if len(argv) > 1 else 1000
+    rounds = int(argv[2]) if len(argv) > 2 else 10
+    out = argv[3] if len(argv) > 3 else "load.json"
+
+    res = asyncio.run(run(clients, rounds))
+
+    print(f"{clients} clients x {rounds} rounds: login {res['phases']['login_s']:.2f} s, "
+          f"work {res['phases']['work_s']:.2f} s, {res['throughput_rps']:.0f} requests/s")
+    for type_, s in sorted(res["requests"].items()):
+        print(f"{type_:>22}: {s['count']:7d} requests, p50 {s['p50_ms']:8.2f} ms, p99 {s['p99_ms']:8.2f} ms, "
+              f"errors {s['errors']}")
+    d = res["delivery"]
+    if d["count"]:
+        print(f"{'message-received':>22}: {d['count']:7d} of {d['expected']}, p50 {d['p50_ms']:8.2f} ms, "
+              f"p99 {d['p99_ms']:8.2f} ms")
+    print(f"RSS: {res['rss_mb']['before']:.1f} MB before, {res['rss_mb']['connected']:.1f} MB connected, "
+          f"{res['rss_mb']['peak']:.1f} MB peak")
+
+    with open(out, "w") as f:
+        json.dump(res, f, indent=2)
+    print(f"results saved to {out}")
+
+
+if __name__ == '__main__':
+    main()
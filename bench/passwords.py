@@ -0,0 +1,58 @@
+# Пропускная способность входа (проверок пароля в секунду) и задержка цикла событий во время
+# "шторма" входов: проверка в цикле событий против проверки в пуле процессов/потоков.
+# Запуск: python -m bench.passwords [kdf] [число входов]
+import asyncio
+import time
+from sys import argv
+
+from encryption.passwords import PasswordHasher
+
+
+async def measure_loop_latency(stop, delays):
+    # другие соединения: каждые 5 мс цикл событий должен успевать обработать короткую задачу
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        delays.append(time.perf_counter() - start - 0.005)
+
+
+async def storm(check, hashed, logins):
+    stop = asyncio.Event()
+    delays = []
+    pinger = asyncio.create_task(measure_loop_latency(stop, delays))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(check("password", hashed) for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await pinger
+    delays.sort()
+    p99 = delays[int(len(delays) * 0.99)] if delays else elapsed
+    return logins / elapsed, max(delays, default=elapsed), p99
+
+
+async def main():
+    kdf = argv[1] if len(argv) > 1 else "scrypt"
+    logins = int(argv[2]) if len(argv) > 2 else 200
+
+    hasher = PasswordHasher("sha3_256", kdf)
+    hashed = hasher.hash_password("password")
+
+    async def inline(password, hashed_password):
+        return hasher.check_password(password, hashed_password)
+
+    variants = [("inline", inline)]
+    for executor in ("thread", "process"):
+        pool = PasswordHasher("sha3_256", kdf, executor=executor)
+        await pool.check_password_async("password", hashed)  # прогрев пула
+        variants.append((executor, pool.check_password_async))
+
+    print(f"{kdf}, {logins} logins")
+    for name, check in variants:
+        rate, worst, p99 = await storm(check, hashed, logins)
+        print(f"{name:>8}: {rate:8.1f} logins/s, loop delay p99 {p99 * 1000:8.2f} ms, max {worst * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
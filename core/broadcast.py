@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import websockets
+
+from core.log import Sampler
+
+
+class Broadcaster:
+    def __init__(self, logger, concurrency=256):
+        self.logger = logger
+        self.concurrency = concurrency
+
+        self.last_latency = None
+        self.broadcasts = 0
+        self.total_latency = 0.0
+        # число получателей, которым сообщение еще не отправлено, по всем текущим рассылкам
+        self.pending = 0
+        self.metrics = None
+        # доля рассылок, о которых пишется запись уровня INFO
+        self.log_sampler = Sampler()
+
+    # сообщение кодируется один раз для каждого кодека и рассылается параллельно,
+    # но не более чем self.concurrency отправок одновременно
+    async def broadcast(self, connections, msg):
+        start = time.perf_counter()
+
+        targets = iter(connections)
+        dead = []
+        # по одному закодированному сообщению на каждый кодек, используемый соединениями
+        encoded = {}
+
+        async def worker():
+            for conn in targets:
+                self.pending -= 1
+                if conn.closed:
+                    dead.append(conn)
+                    continue
+                data = encoded.get(conn.codec)
+                if data is None:
+                    data = encoded[conn.codec] = conn.codec.encode(msg)
+                try:
+                    await conn.ws.send(data)
+                except websockets.ConnectionClosed:
+                    dead.append(conn)
+
+        workers = min(self.concurrency, len(connections))
+        self.pending += len(connections)
+        if workers:
+            try:
+                await asyncio.gather(*(worker() for _ in range(workers)))
+            finally:
+                # при отмене рассылки оставшиеся получатели уже не ждут отправки
+                self.pending -= sum(1 for _ in targets)
+
+        latency = time.perf_counter() - start
+        self.last_latency = latency
+        self.broadcasts += 1
+        self.total_latency += latency
+        if self.metrics is not None:
+            self.metrics.fanout_latency.observe(latency)
+
+        if self.log_sampler():
+            self.logger.info("Broadcast of '%s' to %d connections took %.2f ms, dead connections: %d",
+                             msg["type"], len(connections), latency * 1000, len(dead),
+                             extra={"type": msg["type"], "targets": len(connections), "latency": latency})
+        return dead, latency
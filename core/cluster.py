@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+
+from bson import json_util
+
+from core.connection_registry import ConnectionRegistry
+
+
+# Сообщения шины - JSON-объекты, по одному на строку. ObjectId и прочие типы bson
+# кодируются через bson.json_util, чтобы идентификаторы пользователей сохраняли тип.
+def encode(msg):
+    return json_util.dumps(msg).encode("utf-8") + b"\n"
+
+
+def decode(line):
+    return json_util.loads(line)
+
+
+# Шина супервизора: знает, к какому воркеру подключен каждый пользователь, и пересылает события
+class Bus:
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.workers = set()
+        self.owners = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle_worker, self.path)
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_worker(self, reader, writer):
+        self.workers.add(writer)
+        try:
+            while line := await reader.readline():
+                await self.dispatch(writer, decode(line))
+        except ConnectionError:
+            pass
+        finally:
+            self.workers.discard(writer)
+            for user_id in [u for u, w in self.owners.items() if w is writer]:
+                del self.owners[user_id]
+            writer.close()
+
+    async def send(self, writer, msg):
+        writer.write(encode(msg))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            self.logger.warning("Worker disconnected from the bus")
+
+    async def dispatch(self, writer, msg):
+        op = msg["op"]
+        if op == "authorize":
+            ok = self.owners.get(msg["user-id"], writer) is writer
+            if ok:
+                self.owners[msg["user-id"]] = writer
+            await self.send(writer, {"op": "reply", "id": msg["id"], "ok": ok})
+        elif op == "unregister":
+            if self.owners.get(msg["user-id"]) is writer:
+                del self.owners[msg["user-id"]]
+        elif op == "activity-update":
+            await asyncio.gather(*(self.send(w, msg) for w in self.workers if w is not writer))
+        elif op == "message-received":
+            owner = self.owners.get(msg["user-id"])
+            if owner is not None and owner is not writer:
+                await self.send(owner, msg)
+        elif op == "messages-read":
+            owner = self.owners.get(msg["sender-id"])
+            if owner is not None and owner is not writer:
+                await self.send(owner, msg)
+        else:
+            self.logger.warning("Unknown bus operation: %s", op)
+
+
+# Реестр воркера: локальные соединения плюс доставка через шину пользователям других воркеров
+class ClusterRegistry(ConnectionRegistry):
+    def __init__(self, logger, bus_path, broadcast_concurrency=256, presence_scope="all", presence_debounce=0.2,
+                 max_subscriptions=1000):
+        super().__init__(logger, broadcast_concurrency, presence_scope, presence_debounce, max_subscriptions)
+        self.bus_path = bus_path
+        self.reader = None
+        self.writer = None
+        self.requests = {}
+        self.request_ids = itertools.count()
+        self.listener = None
+        # события для локальных соединений доставляются отдельной задачей в порядке получения
+        self.deliveries = asyncio.Queue()
+        self.deliverer = None
+
+    async def connect_bus(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.bus_path)
+        self.deliverer = asyncio.create_task(self.deliver())
+        self.listener = asyncio.create_task(self.listen())
+
+    # Ответы на запросы (от них зависит вход пользователей) обрабатываются сразу при чтении шины,
+    # а не после рассылки предыдущих событий, которая может быть долгой
+    async def listen(self):
+        while line := await self.reader.readline():
+            msg = decode(line)
+            if msg["op"] == "reply":
+                self.requests.pop(msg["id"]).set_result(msg["ok"])
+            else:
+                self.deliveries.put_nowait(msg)
+        raise ConnectionError("Bus connection lost")
+
+    async def deliver(self):
+        while True:
+            msg = await self.deliveries.get()
+            op = msg["op"]
+            try:
+                if op == "activity-update":
+                    await self.deliver_presence(msg["changes"])
+                elif op == "message-received":
+                    await super().message_received(msg["user-id"], msg["message"])
+                elif op == "messages-read":
+                    await super().messages_read(msg["sender-id"], msg["reader-id"])
+            except Exception:
+                self.logger.exception("Bus event delivery failed: %s", op)
+
+    async def publish(self, msg):
+        self.writer.write(encode(msg))
+        await self.writer.drain()
+
+    async def request(self, msg):
+        msg["id"] = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.requests[msg["id"]] = future
+        await self.publish(msg)
+        return await future
+
+    async def authorize(self, connection, user_id):
+        if self.authorized.get(user_id) is not None:
+            raise ValueError("Such user is already authorized")
+
+        if not await self.request({"op": "authorize", "user-id": user_id}):
+            raise ValueError("Such user is already authorized on another worker")
+
+        await super().authorize(connection, user_id)
+
+    def unregister_authorized(self, user_id, connection=None):
+        if connection is not None and self.authorized.get(user_id) is not connection:
+            return
+        super().unregister_authorized(user_id, connection)
+        self.writer.write(encode({"op": "unregister", "user-id": user_id}))
+
+    # накопленные смены статуса доставляются локально и одной пачкой отправляются другим воркерам
+    async def flush_presence(self, changes):
+        await asyncio.gather(
+            self.deliver_presence(changes),
+            self.publish({"op": "activity-update", "changes": changes})
+        )
+
+    async def message_received(self, user_id, message):
+        if user_id in self.authorized:
+            await super().message_received(user_id, message)
+            return
+        await self.publish({"op": "message-received", "user-id": user_id, "message": message})
+
+    async def messages_read(self, sender_id, reader_id):
+        if sender_id in self.authorized:
+            await super().messages_read(sender_id, reader_id)
+            return
+        await self.publish({"op": "messages-read", "sender-id": sender_id, "reader-id": reader_id})
@@ -0,0 +1,99 @@
+import json
+
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Явные кодировщики нестандартных типов вместо default=str:
+# неизвестный тип - ошибка сервера, а не молча отправленное строковое представление
+def encode_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+class JsonCodec:
+    subprotocol = "smln.json"
+    # сообщения кодека идут бинарными кадрами - тогда бинарные кадры с содержимым файлов от них не отличить
+    binary_frames = False
+
+    @staticmethod
+    def encode(msg):
+        return json.dumps(msg, default=encode_default, ensure_ascii=False)
+
+    # JSON в бинарном кадре принимается как текст в UTF-8 - так было до появления подпротоколов
+    @staticmethod
+    def decode(data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+
+# Тот же формат, что и JsonCodec, но через orjson; результат декодируется в str,
+# чтобы websockets отправлял его текстовым кадром
+class FastJsonCodec(JsonCodec):
+    @staticmethod
+    def encode(msg):
+        return orjson.dumps(msg, default=encode_default).decode("utf-8")
+
+    # orjson принимает bytes сам и тоже требует UTF-8
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+class MsgPackCodec:
+    subprotocol = "smln.msgpack"
+    binary_frames = True
+
+    @staticmethod
+    def encode(msg):
+        return msgpack.packb(msg, default=encode_default)
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, str):
+            raise ValueError("MessagePack messages must be sent in binary frames")
+        return msgpack.unpackb(data)
+
+
+class Codecs:
+    def __init__(self, fast_json=True, offload_threshold=1024 * 1024):
+        self.json = FastJsonCodec() if fast_json and orjson is not None else JsonCodec()
+        self.by_subprotocol = {JsonCodec.subprotocol: self.json}
+        if msgpack is not None:
+            self.by_subprotocol[MsgPackCodec.subprotocol] = MsgPackCodec()
+
+        # ответы больше этого размера (по грубой оценке) кодируются вне цикла событий
+        self.offload_threshold = offload_threshold
+
+    @property
+    def subprotocols(self):
+        return list(self.by_subprotocol)
+
+    # без согласованного подпротокола используется JSON - как у клиентов, которые о подпротоколах не знают
+    def get(self, subprotocol):
+        return self.by_subprotocol.get(subprotocol, self.json)
+
+    # оценка размера по верхнему уровню "args": обходить сообщение целиком так же дорого, как кодировать
+    def is_large(self, msg):
+        args = msg.get("args")
+        if not isinstance(args, dict):
+            return False
+
+        size = 0
+        for value in args.values():
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            elif isinstance(value, list):
+                size += 256 * len(value)
+        return size > self.offload_threshold
@@ -1,15 +1,23 @@
 import asyncio
-import json
+import base64
+import binascii
+import contextvars
+import logging
 
 from bson import ObjectId
 
 import core.status as status
+from core.log import Sampler
+from core.metrics import Metrics
 import websockets
 from core.smln_handler import SMLNHandler
 
 INVALID_FORMAT = "invalid-format"
 UNSPECIFIED_TYPE = "unspecified-type"
 
+# идентификатор запроса, переданный клиентом, возвращается в ответе
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
 
 def auth_required(cor):
 
@@ -61,6 +69,27 @@ def required_fields(*fields):
     return decorator
 
 
+# Кадр с содержимым, объявленный в запросе "binary": true, читается до всех проверок запроса:
+# иначе при ошибке проверки он остался бы в потоке и был бы разобран как следующий запрос.
+# Содержимое передается обработчику в args["binary-frame"]. Запрос должен быть упорядоченным,
+# чтобы следующий кадр соединения не читался параллельно.
+def binary_frame(cor):
+    name = cor.__name__
+
+    async def new_cor(self, args):
+        if isinstance(args, dict) and args.get("binary") is True:
+            try:
+                frame = await self.ws.recv()
+            except websockets.ConnectionClosed:
+                return
+            self.metrics.frame_size.observe(len(frame), "in")
+            args = {**args, "binary-frame": frame}
+        await cor(self, args)
+
+    new_cor.__name__ = name
+    return new_cor
+
+
 class LogDec:
     def __init__(self, logger):
         self.logger = logger
@@ -69,9 +98,12 @@ class LogDec:
         name = cor.__name__
 
         async def new_cor(self, *args):
-            self.logger.debug(
-                f"Handling request. Connection: {self.id}, func: {name}, args: {'; '.join(str(x) for x in args)}")
-            self.logger.info(f"Connection {self.id} calls handler: {name}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Handling request. Connection: %s, func: %s, args: %s",
+                                  self.id, name, "; ".join(str(x) for x in args))
+            if self.log_sampler():
+                self.logger.info("Connection %s calls handler: %s", self.id, name,
+                                 extra={"connection": self.id, "handler": name})
             await cor(self, *args)
 
         new_cor.__name__ = name
@@ -81,13 +113,27 @@ class LogDec:
 class Connection:
     smln = SMLNHandler()
     logger = None
+    max_in_flight = 1
+    max_chunk_size = 256 * 1024
+    max_streams = 4
+    log_sampler = Sampler()
+    metrics = Metrics()
     handler_log = LogDec(logger)
 
     def __init__(self, ws: websockets.WebSocketServerProtocol):
-        self.logger.info(f"Connection {ws.id} established")
+        self.logger.info("Connection %s established", ws.id, extra={"connection": ws.id})
         self.ws = ws
 
         self.user_id = None
+        self.binary_lock = asyncio.Lock()
+        # задачи потоковых загрузок файлов
+        self.streams = set()
+        # пользователи, о смене статуса которых соединение получает activity-update
+        self.subscriptions = set()
+        # клиент при входе согласился получать несколько смен статуса одним activity-update
+        self.batch_presence = False
+        # кодек определяется подпротоколом, согласованным при подключении
+        self.codec = self.codecs.get(ws.subprotocol)
 
         self.registry.register(self)
 
@@ -104,34 +150,49 @@ class Connection:
     def id(self):
         return self.ws.id
 
-    @staticmethod
-    def decode_message(m):
+    def decode_message(self, m):
+        request_id = None
         try:
-            dct = json.loads(m)
+            dct = self.codec.decode(m)
             if not isinstance(dct, dict):
                 type_ = INVALID_FORMAT
                 args = {}
             else:
                 type_ = dct.get("type", UNSPECIFIED_TYPE)
                 args = dct.get("args", {})
+                request_id = dct.get("request-id")
+                if not isinstance(request_id, (str, int)):
+                    request_id = None
 
-        except json.JSONDecodeError:
+        except (ValueError, TypeError):
             type_ = INVALID_FORMAT
             args = {}
 
-        return type_, args
+        return type_, args, request_id
+
+    async def encode_message(self, msg):
+        if self.codecs.is_large(msg):
+            return await asyncio.get_running_loop().run_in_executor(None, self.codec.encode, msg)
+        return self.codec.encode(msg)
 
     async def send_json(self, msg):
-        self.logger.debug(f"Sending message. Connection: {self.id}, message: {msg}")
-        log_message = f"Connection {self.id} sends message of type '{msg['type']}'"
-        if "status" in msg:
-            log_message += f" and status: {msg['status']}"
+        request_id = request_id_var.get()
+        if request_id is not None and "status" in msg:
+            msg["request-id"] = request_id
+        self.logger.debug("Sending message. Connection: %s, message: %s", self.id, msg)
+        data = await self.encode_message(msg)
+        self.metrics.frame_size.observe(len(data), "out")
+        if msg.get("status", {}).get("status", 0) != 0:
+            self.metrics.errors.inc(self.smln.metric_type(msg["type"]))
         try:
-            await self.ws.send(json.dumps(msg, default=str, ensure_ascii=False))
-            log_message += f". Sent successfully."
+            await self.ws.send(data)
+            sent = True
         except websockets.ConnectionClosed:
-            log_message += f". Failed: connection was closed before receiving response"
-        self.logger.info(log_message)
+            sent = False
+        if self.log_sampler():
+            self.logger.info("Connection %s sends message of type '%s', status: %s, sent: %s",
+                             self.id, msg["type"], msg.get("status"), sent,
+                             extra={"connection": self.id, "type": msg["type"], "sent": sent})
 
     @smln.on_unknown_type
     @handler_log
@@ -156,8 +217,9 @@ class Connection:
         await self.send_json({"type": type_, "status": status.server_error()})
 
     @smln.handler
+    @smln.ordered
     @handler_log
-    @check_type({"login": str, "pass": str})
+    @check_type({"login": str, "pass": str, "batch-presence": bool})
     @required_fields("login", "pass")
     async def auth(self, args):
         if self.user_id is not None:
@@ -173,29 +235,30 @@ class Connection:
             await self.send_json({"type": "auth", "status": st})
             return
 
-        user_found = await self.db.make_user_online(user_id)
-        if not user_found:
+        presence = await self.db.make_user_online(user_id)
+        if presence is None:
             st = status.user_not_found(user_id)
             await self.send_json({"type": "auth", "status": st})
             return
         try:
-            self.registry.authorize(self, user_id)
+            await self.registry.authorize(self, user_id)
         except ValueError:
-            self.logger.warning(f"Someone trying to connect from another device, "
-                                f"user {user_id} might have a compromised password")
+            self.logger.warning("Someone trying to connect from another device, "
+                                "user %s might have a compromised password", user_id, extra={"user": user_id})
             st = status.wrong_credentials()
 
             await self.send_json({"type": "auth", "status": st})
             return
 
         self.user_id = user_id
+        self.batch_presence = args.get("batch-presence", False)
 
         st = status.ok()
 
         await asyncio.gather(
             self.send_json(
                 {"type": "auth", "status": st, "args": {"id": user_id, "public-key": pub, "private-key": pr}}),
-            self.registry.activity_update(user_id)
+            self.registry.activity_update(presence)
         )
 
     @smln.handler
@@ -210,8 +273,32 @@ class Connection:
             st = status.invalid_list_properties(invalid_properties)
             await self.send_json({"type": "people-with-messages", "status": st})
             return
+
+        # собеседники из списка бесед - те, чей статус клиент показывает, поэтому подписка на них автоматическая
+        room = self.registry.max_subscriptions - len(self.subscriptions)
+        peers = {chat["user"]["id"] for chat in res if chat.get("user")} - self.subscriptions
+        self.subscribe_users(set(list(peers)[:max(room, 0)]))
+
         await self.send_json({"type": "people-with-messages", "status": status.ok(), "args": {"chats": res}})
 
+    # изменения после токена из предыдущего ответа на sync вместо повторной загрузки бесед
+    @smln.handler
+    @handler_log
+    @check_type({"token": str, "list-properties": dict})
+    @auth_required
+    async def sync(self, args):
+        res, invalid_properties = await self.db.sync(self.user_id, args.get("token"), args.get("list-properties", {}),
+                                                     self.subscriptions)
+        if invalid_properties and "token" in invalid_properties:
+            await self.send_json({"type": "sync", "status": status.wrong_data_type("token")})
+            return
+        if invalid_properties:
+            st = status.invalid_list_properties(invalid_properties)
+            await self.send_json({"type": "sync", "status": st})
+            return
+
+        await self.send_json({"type": "sync", "status": status.ok(), "args": res})
+
     @smln.handler
     @handler_log
     @check_type({"list-properties": dict})
@@ -267,6 +354,7 @@ class Connection:
         await self.send_json({"type": "get-user", "status": status.ok(), "args": {"user": res}})
 
     @smln.handler
+    @smln.ordered
     @handler_log
     @check_type({"receiver-id": str, "message-for-receiver": dict, "message-for-sender": dict})
     @required_fields("receiver-id", "message-for-receiver", "message-for-sender")
@@ -296,12 +384,16 @@ class Connection:
 
     @smln.handler
     @handler_log
-    @check_type({"token": str})
+    @check_type({"token": str, "offset": int, "length": int, "stream": bool, "chunk-size": int, "binary": bool})
     @required_fields("token")
     @auth_required
     async def download(self, args):
         token = args["token"]
 
+        if "offset" in args or "length" in args or args.get("stream", False) or args.get("binary", False):
+            await self.download_range(args)
+            return
+
         data, accessible = await self.db.download(self.user_id, token)
 
         if not accessible:
@@ -311,15 +403,219 @@ class Connection:
 
         await self.send_json({"type": "download", "status": status.ok(), "args": {"data": data}})
 
+    # Частичная загрузка: "offset"/"length" - один кусок файла в ответе,
+    # "stream" - ответ с размером файла и затем последовательность событий download-chunk.
+    # С "binary" содержимое вместо base64 в JSON передается бинарными кадрами после ответа.
+    # Куски читаются по одному, поэтому память на соединение не зависит от размера файла.
+    # Куски и бинарные кадры отправляются отдельной задачей (start_stream), чтобы загрузка
+    # не задерживала следующие запросы соединения.
+    async def download_range(self, args):
+        token = args["token"]
+        offset = args.get("offset", 0)
+        length = args.get("length", self.max_chunk_size)
+        chunk_size = min(args.get("chunk-size", self.max_chunk_size), self.max_chunk_size)
+        binary = args.get("binary", False)
+        stream = args.get("stream", False) or (binary and "length" not in args and "offset" not in args)
+
+        if offset < 0 or length <= 0 or chunk_size <= 0:
+            await self.send_json({"type": "download", "status": status.invalid_range()})
+            return
+
+        if binary and self.codec.binary_frames:
+            await self.send_json({"type": "download", "status": status.binary_frames_unavailable()})
+            return
+
+        # каждая загрузка держит в памяти кусок файла, поэтому их число на соединение ограничено
+        if (stream or binary) and len(self.streams) >= self.max_streams:
+            await self.send_json({"type": "download", "status": status.too_many_streams(self.max_streams)})
+            return
+
+        path, size = await self.db.get_file(self.user_id, token)
+
+        if path is None:
+            st = status.file_not_accessible(token)
+            await self.send_json({"type": "download", "status": st})
+            return
+
+        if offset > size:
+            await self.send_json({"type": "download", "status": status.invalid_range()})
+            return
+
+        if binary:
+            if not stream:
+                chunk_size = min(length, self.max_chunk_size)
+            end = min(size, offset + length) if "length" in args or not stream else size
+            self.start_stream(self.download_binary(token, path, size, offset, end, chunk_size))
+            return
+
+        if not stream:
+            data = await self.db.read_file(path, offset, min(length, self.max_chunk_size))
+            await self.send_json({"type": "download", "status": status.ok(), "args": {
+                "token": token, "size": size, "offset": offset, "data": base64.b64encode(data).decode("ascii")}})
+            return
+
+        end = min(size, offset + length) if "length" in args else size
+        await self.send_json({"type": "download", "status": status.ok(), "args": {
+            "token": token, "size": size, "offset": offset, "length": end - offset, "chunk-size": chunk_size}})
+        self.start_stream(self.download_chunks(token, path, offset, end, chunk_size))
+
+    # Загрузка выполняется вне обработки запроса и не занимает место в max_in_flight;
+    # при закрытии соединения незавершенные загрузки отменяются
+    def start_stream(self, coro):
+        task = asyncio.create_task(self.run_stream(coro))
+        self.streams.add(task)
+        task.add_done_callback(self.streams.discard)
+
+    async def run_stream(self, coro):
+        try:
+            await coro
+        except Exception:
+            self.logger.exception("File stream failed. Connection: %s", self.id, extra={"connection": self.id})
+
+    async def download_chunks(self, token, path, offset, end, chunk_size):
+        while offset < end and not self.closed:
+            data = await self.db.read_file(path, offset, min(chunk_size, end - offset))
+            if not data:
+                break
+            await self.send_json({"type": "download-chunk", "args": {
+                "token": token, "offset": offset, "data": base64.b64encode(data).decode("ascii"),
+                "last": offset + len(data) >= end}})
+            offset += len(data)
+
+    async def download_binary(self, token, path, size, offset, end, chunk_size):
+        # Кадры одной загрузки не должны перемешиваться с кадрами другой, поэтому бинарные
+        # загрузки соединения выполняются по очереди. Куски читаются в один буфер и отправляются
+        # через memoryview без промежуточных копий.
+        async with self.binary_lock:
+            await self.send_json({"type": "download", "status": status.ok(), "args": {
+                "token": token, "size": size, "offset": offset, "length": end - offset, "chunk-size": chunk_size,
+                "binary": True}})
+
+            buffer = memoryview(bytearray(min(chunk_size, end - offset)))
+            while offset < end and not self.closed:
+                n = await self.db.read_file_into(path, offset, buffer[:end - offset])
+                if not n:
+                    break
+                try:
+                    await self.ws.send(buffer[:n])
+                except websockets.ConnectionClosed:
+                    break
+                offset += n
+
     @smln.handler
     @handler_log
+    @check_type({"name": str, "size": int})
+    @required_fields("name", "size")
+    @auth_required
+    async def upload_begin(self, args):
+        if args["size"] > self.db.max_upload_size:
+            await self.send_json({"type": "upload-begin", "status": status.file_too_large(self.db.max_upload_size)})
+            return
+
+        upload_id = await self.db.upload_begin(self.user_id, args["name"], args["size"])
+
+        if upload_id is None:
+            await self.send_json({"type": "upload-begin", "status": status.invalid_file()})
+            return
+
+        await self.send_json({"type": "upload-begin", "status": status.ok(),
+                              "args": {"upload-id": upload_id, "offset": 0}})
+
+    @smln.handler
+    @smln.ordered
+    @binary_frame
+    @handler_log
+    @check_type({"upload-id": str, "offset": int, "data": str, "binary": bool})
+    @required_fields("upload-id", "offset")
+    @auth_required
+    async def upload_chunk(self, args):
+        upload_id = args["upload-id"]
+
+        # с "binary" содержимое куска приходит следующим бинарным кадром, а не в "data"
+        if args.get("binary", False):
+            if self.codec.binary_frames:
+                st = status.binary_frames_unavailable()
+                await self.send_json({"type": "upload-chunk", "status": st})
+                return
+            data = args["binary-frame"]
+            if not isinstance(data, bytes):
+                await self.send_json({"type": "upload-chunk", "status": status.wrong_data_type("data")})
+                return
+        elif "data" not in args:
+            await self.send_json({"type": "upload-chunk", "status": status.absent_fields(["data"])})
+            return
+        else:
+            try:
+                data = base64.b64decode(args["data"], validate=True)
+            except binascii.Error:
+                await self.send_json({"type": "upload-chunk", "status": status.wrong_data_type("data")})
+                return
+
+        if len(data) > self.max_chunk_size:
+            await self.send_json({"type": "upload-chunk", "status": status.invalid_range()})
+            return
+
+        upload, accepted = await self.db.upload_chunk(self.user_id, upload_id, args["offset"], data)
+
+        if upload is None:
+            await self.send_json({"type": "upload-chunk", "status": status.upload_not_found(upload_id)})
+            return
+
+        if not accepted:
+            st = status.invalid_upload_offset(upload["received"])
+        else:
+            st = status.ok()
+
+        await self.send_json({"type": "upload-chunk", "status": st,
+                              "args": {"upload-id": upload_id, "offset": upload["received"]}})
+
+    @smln.handler
+    @handler_log
+    @check_type({"upload-id": str})
+    @required_fields("upload-id")
+    @auth_required
+    async def upload_status(self, args):
+        upload_id = args["upload-id"]
+        upload = await self.db.upload_status(self.user_id, upload_id)
+
+        if upload is None:
+            await self.send_json({"type": "upload-status", "status": status.upload_not_found(upload_id)})
+            return
+
+        await self.send_json({"type": "upload-status", "status": status.ok(), "args": {
+            "upload-id": upload_id, "offset": upload["received"], "size": upload["size"]}})
+
+    @smln.handler
+    @smln.ordered
+    @handler_log
+    @check_type({"upload-id": str})
+    @required_fields("upload-id")
+    @auth_required
+    async def upload_commit(self, args):
+        upload_id = args["upload-id"]
+        res, committed = await self.db.upload_commit(self.user_id, upload_id)
+
+        if res is None:
+            await self.send_json({"type": "upload-commit", "status": status.upload_not_found(upload_id)})
+            return
+
+        if not committed:
+            st = status.upload_incomplete(res["received"], res["size"])
+            await self.send_json({"type": "upload-commit", "status": st})
+            return
+
+        await self.send_json({"type": "upload-commit", "status": status.ok(), "args": {"file": res}})
+
+    @smln.handler
+    @smln.ordered
+    @handler_log
     @check_type({"user-id": str})
     @required_fields("user-id")
     @auth_required
     async def read(self, args):
         user_id = args["user-id"]
 
-        user_found = await self.db.read(self.user_id, user_id)
+        user_found, advanced = await self.db.read(self.user_id, user_id)
 
         if not user_found:
             st = status.user_not_found(user_id)
@@ -328,15 +624,53 @@ class Connection:
 
         await self.send_json({"type": "read", "status": status.ok()})
 
+        # отправитель узнает о прочтении, только если были непрочитанные сообщения
+        if advanced:
+            await self.registry.read_update(ObjectId(user_id), self.user_id)
+
+    def subscribe_users(self, user_ids):
+        self.subscriptions |= user_ids
+        self.registry.subscribe(self, user_ids)
+
+    @staticmethod
+    def parse_user_ids(ids):
+        if not all(isinstance(x, str) and ObjectId.is_valid(x) for x in ids):
+            return None
+        return {ObjectId(x) for x in ids}
+
+    @smln.handler
     @handler_log
-    async def activity_update(self, user_id):
-        res, user_found = await self.db.get_user(user_id)
+    @check_type({"users": list})
+    @required_fields("users")
+    @auth_required
+    async def subscribe(self, args):
+        user_ids = self.parse_user_ids(args["users"])
+        if user_ids is None:
+            await self.send_json({"type": "subscribe", "status": status.wrong_data_type("users")})
+            return
 
-        if not user_found:
-            raise ValueError("No such user")
+        if len(self.subscriptions | user_ids) > self.registry.max_subscriptions:
+            st = status.too_many_subscriptions(self.registry.max_subscriptions)
+            await self.send_json({"type": "subscribe", "status": st})
+            return
+
+        self.subscribe_users(user_ids)
+        await self.send_json({"type": "subscribe", "status": status.ok()})
+
+    @smln.handler
+    @handler_log
+    @check_type({"users": list})
+    @required_fields("users")
+    @auth_required
+    async def unsubscribe(self, args):
+        user_ids = self.parse_user_ids(args["users"])
+        if user_ids is None:
+            await self.send_json({"type": "unsubscribe", "status": status.wrong_data_type("users")})
+            return
 
-        await self.send_json({"type": "activity-update", "args": {"user-id": user_id, "is-online": res["is-online"],
-                                                                  "last-seen": res["last-seen"]}})
+        self.subscriptions -= user_ids
+        self.registry.unsubscribe(self, user_ids)
+        await self.send_json({"type": "unsubscribe", "status": status.ok()})
 
     @handler_log
     async def message_received(self, message):
@@ -346,26 +680,70 @@ class Connection:
     async def messages_read(self, user_id):
         await self.send_json({"type": "messages-read", "args": {"user-id": user_id}})
 
+    async def process(self, type_, args, request_id):
+        token = request_id_var.set(request_id)
+        try:
+            await self.smln.handle(self, type_, args)
+        finally:
+            request_id_var.reset(token)
+
     async def handle(self):
+        in_flight = set()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        def done(task):
+            in_flight.discard(task)
+            semaphore.release()
+
         try:
             async for message in self.ws:
-                type_, args = self.decode_message(message)
-                await self.smln.handle(self, type_, args)
+                self.metrics.frame_size.observe(len(message), "in")
+                type_, args, request_id = self.decode_message(message)
+                if self.max_in_flight == 1 or self.smln.is_ordered(type_):
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+                    await self.process(type_, args, request_id)
+                    continue
+
+                await semaphore.acquire()
+                task = asyncio.create_task(self.process(type_, args, request_id))
+                in_flight.add(task)
+                task.add_done_callback(done)
         except websockets.ConnectionClosed:
             pass
 
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+        for task in list(self.streams):
+            task.cancel()
+        if self.streams:
+            await asyncio.wait(self.streams)
+
         if self.user_id:
             # сначала делаем offline, потом activity-update
-            self.registry.unregister_authorized(self.user_id)
-            await self.db.make_user_offline(self.user_id)
-            await self.registry.activity_update(self.user_id),
+            self.registry.unregister_authorized(self.user_id, self)
+            presence = await self.db.make_user_offline(self.user_id)
+            if presence is not None:
+                await self.registry.activity_update(presence)
+        else:
+            self.registry.unregister_unauthorized(self)
+        self.registry.unsubscribe(self, self.subscriptions)
 
-        self.logger.info(f"Connection {self.id} closed")
+        self.logger.info("Connection %s closed", self.id, extra={"connection": self.id})
 
     @classmethod
-    def connect(cls, registry, db, logger):
+    def connect(cls, registry, db, logger, codecs, max_in_flight=1, max_chunk_size=256 * 1024,
+                log_sampler=Sampler(), metrics=None, max_streams=4):
         cls.registry = registry
+        cls.metrics = metrics or Metrics()
+        cls.smln.instrument(cls.metrics)
+        cls.log_sampler = log_sampler
         cls.db = db
+        cls.codecs = codecs
+        cls.max_in_flight = max_in_flight
+        cls.max_chunk_size = max_chunk_size
+        cls.max_streams = max_streams
         cls.set_logger(logger)
         cls.smln.logger = logger
 
@@ -1,13 +1,42 @@
+import asyncio
+
+from core.broadcast import Broadcaster
+
+
 class ConnectionRegistry:
-    def __init__(self, logger):
+    presence_scopes = ("all", "subscribed")
+
+    # presence_scope - кому рассылается activity-update: всем ("all") или только подписчикам ("subscribed");
+    # presence_debounce - секунды, за которые смены статуса копятся и схлопываются в одно событие
+    def __init__(self, logger, broadcast_concurrency=256, presence_scope="all", presence_debounce=0.2,
+                 max_subscriptions=1000):
+        if presence_scope not in self.presence_scopes:
+            raise ValueError("Unknown presence scope")
+
         self.logger = logger
         self.unauthorized = set()
         self.authorized = {}
+        self.broadcaster = Broadcaster(logger, broadcast_concurrency)
+
+        self.presence_scope = presence_scope
+        self.presence_debounce = presence_debounce
+        self.max_subscriptions = max_subscriptions
+        # последние еще не разосланные статусы по пользователю
+        self.pending_presence = {}
+        self.presence_flusher = None
+        # соединения, подписанные на статус пользователя
+        self.subscribers = {}
+        # еще не отправленные уведомления о прочтении: пары (отправитель, читатель)
+        self.pending_reads = set()
+        self.read_flusher = None
+
+        self.presence_events = 0
+        self.presence_frames = 0
 
     def register(self, connection):
         self.unauthorized.add(connection)
 
-    def authorize(self, connection, user_id):
+    async def authorize(self, connection, user_id):
         if self.authorized.get(user_id) is not None:
             raise ValueError("Such user is already authorized")
 
@@ -15,13 +44,17 @@ class ConnectionRegistry:
 
         self.authorized[user_id] = connection
 
-        self.logger.info(f"Authentication succeeded. Connection: {connection.id}, user-id: {user_id}")
+        self.logger.info("Authentication succeeded. Connection: %s, user-id: %s", connection.id, user_id,
+                         extra={"connection": connection.id, "user": user_id})
 
     def unregister_unauthorized(self, connection):
-        self.unauthorized.remove(connection)
+        self.unauthorized.discard(connection)
 
-    def unregister_authorized(self, user_id):
-        del self.authorized[user_id]
+    def unregister_authorized(self, user_id, connection=None):
+        # соединение могло быть уже удалено при рассылке, а пользователь - подключиться заново
+        if connection is not None and self.authorized.get(user_id) is not connection:
+            return
+        self.authorized.pop(user_id, None)
 
     def check_online(self, user_id):
         if user_id not in self.authorized:
@@ -29,15 +62,111 @@ class ConnectionRegistry:
         conn = self.authorized[user_id]
 
         if conn.closed:
-            del self.authorized[user_id]
+            self.unregister_authorized(user_id, conn)
             return False
         return True
 
-    async def activity_update(self, user_id):
-        for id_, conn in self.authorized.items():
-            if not self.check_online(id_):
-                return
-            await conn.activity_update(user_id)
+    async def broadcast(self, msg):
+        dead, _ = await self.broadcaster.broadcast(list(self.authorized.values()), msg)
+
+        for conn in dead:
+            self.unregister_authorized(conn.user_id, conn)
+
+    def subscribe(self, connection, user_ids):
+        for user_id in user_ids:
+            self.subscribers.setdefault(user_id, set()).add(connection)
+
+    def unsubscribe(self, connection, user_ids):
+        for user_id in user_ids:
+            subscribers = self.subscribers.get(user_id)
+            if subscribers is None:
+                continue
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.subscribers[user_id]
+
+    # Смена статуса не рассылается сразу: за presence_debounce секунд повторные смены одного
+    # пользователя схлопываются в последнюю, а смены разных пользователей уходят одной рассылкой
+    async def activity_update(self, presence):
+        self.presence_events += 1
+        self.pending_presence[presence["user-id"]] = presence
+        if self.presence_flusher is None:
+            self.presence_flusher = asyncio.create_task(self._flush_presence_later())
+
+    async def _flush_presence_later(self):
+        while self.pending_presence:
+            await asyncio.sleep(self.presence_debounce)
+            changes, self.pending_presence = list(self.pending_presence.values()), {}
+            try:
+                await self.flush_presence(changes)
+            except Exception:
+                self.logger.exception("Presence delivery failed")
+        self.presence_flusher = None
+
+    async def flush_presence(self, changes):
+        await self.deliver_presence(changes)
+
+    @staticmethod
+    def presence_message(changes):
+        # одна смена статуса - прежний формат события, несколько - список в "users"
+        if len(changes) == 1:
+            return {"type": "activity-update", "args": changes[0]}
+        return {"type": "activity-update", "args": {"users": changes}}
+
+    # Список в "users" получают только соединения, запросившие его при входе ("batch-presence"),
+    # остальные - по прежнему событию на каждую смену статуса
+    async def send_presence(self, conns, changes):
+        batched = [conn for conn in conns if conn.batch_presence]
+        single = [conn for conn in conns if not conn.batch_presence]
+
+        sends = []
+        if batched:
+            sends.append(self.broadcaster.broadcast(batched, self.presence_message(changes)))
+        if single:
+            sends.extend(self.broadcaster.broadcast(single, self.presence_message([presence])) for presence in changes)
+        self.presence_frames += len(batched) + len(single) * len(changes)
+
+        for dead, _ in await asyncio.gather(*sends):
+            for conn in dead:
+                self.unregister_authorized(conn.user_id, conn)
+
+    async def deliver_presence(self, changes):
+        if self.presence_scope == "all":
+            await self.send_presence(list(self.authorized.values()), changes)
+            return
+
+        # соединения с одинаковым набором изменений получают одно и то же закодированное сообщение
+        per_connection = {}
+        for presence in changes:
+            for conn in self.subscribers.get(presence["user-id"], ()):
+                per_connection.setdefault(conn, []).append(presence)
+
+        groups = {}
+        for conn, conn_changes in per_connection.items():
+            if self.authorized.get(conn.user_id) is not conn:
+                continue
+            key = tuple(id(presence) for presence in conn_changes)
+            groups.setdefault(key, (conn_changes, []))[1].append(conn)
+
+        await asyncio.gather(*(self.send_presence(conns, conn_changes) for conn_changes, conns in groups.values()))
+
+    # Уведомления о прочтении копятся так же, как смены статуса: повторные чтения одной беседы
+    # за presence_debounce секунд дают отправителю одно событие messages-read
+    async def read_update(self, sender_id, reader_id):
+        self.pending_reads.add((sender_id, reader_id))
+        if self.read_flusher is None:
+            self.read_flusher = asyncio.create_task(self._flush_reads_later())
+
+    async def _flush_reads_later(self):
+        while self.pending_reads:
+            await asyncio.sleep(self.presence_debounce)
+            reads, self.pending_reads = self.pending_reads, set()
+            results = await asyncio.gather(*(self.messages_read(sender_id, reader_id)
+                                             for sender_id, reader_id in reads), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self.logger.error("Read notification failed", exc_info=result)
+        self.read_flusher = None
 
     async def message_received(self, user_id, message):
         if not self.check_online(user_id):
@@ -50,4 +179,3 @@ class ConnectionRegistry:
             return
         if sender_id in self.authorized:
             await self.authorized[sender_id].messages_read(reader_id)
-
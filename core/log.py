@@ -0,0 +1,62 @@
+import copy
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# атрибуты, которые есть у любой записи; все остальные пришли через extra и выводятся как key=value
+standard_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+# QueueHandler форматирует запись целиком, включая формат файла, в вызывающем потоке; здесь в нем
+# только подставляются аргументы сообщения и текст исключения - аргументы (например, словарь
+# отправляемого сообщения) могут измениться в цикле событий, пока запись ждет в очереди.
+# Строка журнала по формату собирается в потоке QueueListener.
+class LazyQueueHandler(QueueHandler):
+    exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        res = super().format(record)
+        extra = [f"{key}={value}" for key, value in vars(record).items() if key not in standard_attributes]
+        if extra:
+            res += " " + " ".join(extra)
+        return res
+
+
+# Пропускает только часть записей о каждом сообщении (sample_rate от 0 до 1),
+# чтобы при большом потоке сообщений журнал не стал узким местом
+class Sampler:
+    def __init__(self, rate=1.0):
+        self.rate = rate
+
+    def __call__(self):
+        return self.rate >= 1 or (self.rate > 0 and random.random() < self.rate)
+
+
+# Записи попадают в очередь, а в файл их пишет фоновый поток.
+# Возвращает запущенный QueueListener - его нужно остановить при завершении, чтобы дописать очередь.
+def init_logging(file_name, level, format, datetime_format, structured=False):
+    file_handler = logging.FileHandler(file_name, encoding="utf-8")
+    formatter_cls = KeyValueFormatter if structured else logging.Formatter
+    file_handler.setFormatter(formatter_cls(format, datetime_format))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(LazyQueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
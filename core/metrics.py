@@ -0,0 +1,188 @@
+import bisect
+import time
+from collections import defaultdict
+from http import HTTPStatus
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    type_ = "counter"
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def collect(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+# значение считывается функцией в момент запроса метрик: словарь {значения меток: значение} или число
+class Gauge:
+    type_ = "gauge"
+
+    def __init__(self, name, help_, func, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.func = func
+
+    def collect(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+# счетчик, который ведет сам наблюдаемый объект (реестр, БД): значение тоже считывается функцией,
+# но только растет, поэтому экспортируется как counter
+class CallbackCounter(Gauge):
+    type_ = "counter"
+
+
+class Histogram:
+    type_ = "histogram"
+
+    def __init__(self, name, help_, buckets, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = sorted(buckets)
+        # для каждого набора меток: число наблюдений по корзинам (последняя - +Inf), сумма
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def collect(self):
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                labels = format_labels(self.labels, label_values, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Metrics:
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+    def __init__(self):
+        self.metrics = []
+
+        self.requests = self.add(Counter("smln_requests_total", "Handled requests", ("type",)))
+        self.errors = self.add(Counter("smln_request_errors_total", "Responses with non-zero status", ("type",)))
+        self.latency = self.add(Histogram("smln_request_duration_seconds", "Request handling time",
+                                          self.latency_buckets, ("type",)))
+        self.frame_size = self.add(Histogram("smln_frame_bytes", "Size of websocket frames",
+                                             self.size_buckets, ("direction",)))
+        self.fanout_latency = self.add(Histogram("smln_broadcast_duration_seconds", "Event fan-out time",
+                                                 self.latency_buckets))
+        self.presence_batch = self.add(Histogram("smln_presence_batch_size", "Presence updates per database write",
+                                                 (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+        self.presence_flush_latency = self.add(Histogram("smln_presence_flush_duration_seconds",
+                                                         "Presence batch write time", self.latency_buckets))
+
+    # показатели, которые читаются из реестра соединений и БД в момент запроса метрик
+    def watch(self, registry, db):
+        registry.broadcaster.metrics = self
+
+        self.gauge("smln_connections", "Open websocket connections",
+                   lambda: {("unauthorized",): len(registry.unauthorized), ("authorized",): len(registry.authorized)},
+                   ("state",))
+        self.gauge("smln_broadcast_pending", "Event deliveries waiting in fan-out queues",
+                   lambda: registry.broadcaster.pending)
+        self.counter("smln_presence_events_total", "Presence changes of users connected to this process",
+                     lambda: registry.presence_events)
+        self.counter("smln_presence_frames_total", "Activity-update frames sent by this process",
+                     lambda: registry.presence_frames)
+        self.gauge("smln_presence_subscriptions", "Users with at least one presence subscriber",
+                   lambda: len(registry.subscribers))
+        self.counter("smln_db_queries_total", "Database queries by kind",
+                     lambda: {(kind,): count for kind, count in getattr(db, "counters", {}).items()}, ("kind",))
+
+        def cache_stats():
+            values = {}
+            for name in ("chat_cache", "user_cache"):
+                cache = getattr(db, name, None)
+                if cache is not None:
+                    values[(name, "hit")] = cache.hits
+                    values[(name, "miss")] = cache.misses
+            return values
+
+        self.counter("smln_cache_lookups_total", "Cache lookups by result", cache_stats, ("cache", "result"))
+
+        presence = getattr(db, "presence", None)
+        if presence is not None:
+            presence.metrics = self
+            self.counter("smln_presence_updates_total", "Presence changes by outcome",
+                         lambda: {("buffered",): presence.updates, ("coalesced",): presence.coalesced,
+                                  ("failed-flushes",): presence.errors}, ("outcome",))
+            self.gauge("smln_presence_pending", "Presence changes waiting to be written",
+                       lambda: len(presence.pending))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_, func, labels=()):
+        return self.add(Gauge(name, help_, func, labels))
+
+    def counter(self, name, help_, func, labels=()):
+        return self.add(CallbackCounter(name, help_, func, labels))
+
+    # время выполнения блока with записывается в гистограмму задержек запросов
+    def track(self, type_):
+        return _Timer(self, type_)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    # ответ на HTTP-запрос метрик для websockets.serve(process_request=...)
+    def http_handler(self, path):
+        async def process_request(request_path, request_headers):
+            if request_path != path:
+                return None
+            return HTTPStatus.OK, [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")], self.render().encode("utf-8")
+
+        return process_request
+
+
+class _Timer:
+    def __init__(self, metrics, type_):
+        self.metrics = metrics
+        self.type_ = type_
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.requests.inc(self.type_)
+        self.metrics.latency.observe(time.perf_counter() - self.start, self.type_)
+        return False
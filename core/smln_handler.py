@@ -1,18 +1,38 @@
 import traceback
 from io import StringIO
 
+from core.metrics import Metrics
+
 
 class SMLNHandler:
     def __init__(self, logger=None):
         self.logger = logger
         self.handler_dict = {}
+        self.ordered_types = set()
         self.invalid_type = None
         self.server_error = None
+        self.metrics = Metrics()
 
     def handler(self, func):
         self.handler_dict[func.__name__.replace('_', '-')] = func
         return func
 
+    # запросы, меняющие состояние, не выполняются параллельно с другими запросами соединения
+    def ordered(self, func):
+        self.ordered_types.add(func.__name__.replace('_', '-'))
+        return func
+
+    def is_ordered(self, type_):
+        return type_ in self.ordered_types
+
+    # все запросы обработчика учитываются в переданных метриках
+    def instrument(self, metrics):
+        self.metrics = metrics
+
+    # тип запроса для меток метрик: неизвестные типы не порождают новых рядов
+    def metric_type(self, type_):
+        return type_ if type_ in self.handler_dict else "unknown"
+
     def on_unknown_type(self, func):
         self.invalid_type = func
         return func
@@ -23,14 +43,15 @@ class SMLNHandler:
 
     async def handle(self, conn, type_, args):
         handler = self.handler_dict.get(type_, None)
-        if handler is None:
-            await self.invalid_type(conn, type_)
-        else:
-            try:
-                await handler(conn, args)
-            except Exception:
-                with StringIO() as st:
-                    traceback.print_exc(file=st)
-
-                    self.logger.error(st.getvalue())
-                await self.server_error(conn, type_)
+        with self.metrics.track(self.metric_type(type_)):
+            if handler is None:
+                await self.invalid_type(conn, type_)
+            else:
+                try:
+                    await handler(conn, args)
+                except Exception:
+                    with StringIO() as st:
+                        traceback.print_exc(file=st)
+
+                        self.logger.error(st.getvalue())
+                    await self.server_error(conn, type_)
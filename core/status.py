@@ -58,3 +58,39 @@ def user_not_found(user_id):
 
 def file_not_accessible(token):
     return status(3, f"Cannot access file: {token}")
+
+
+def invalid_range():
+    return status(2, "Invalid file range")
+
+
+def upload_not_found(upload_id):
+    return status(3, f"No upload with id: {upload_id}")
+
+
+def invalid_upload_offset(expected):
+    return status(2, f"Invalid chunk offset, expected: {expected}")
+
+
+def upload_incomplete(received, size):
+    return status(3, f"Upload is incomplete: received {received} of {size} bytes")
+
+
+def invalid_file():
+    return status(2, "Invalid file")
+
+
+def file_too_large(limit):
+    return status(2, f"File is too large, limit: {limit} bytes")
+
+
+def too_many_streams(limit):
+    return status(3, f"Too many file streams, limit: {limit}")
+
+
+def binary_frames_unavailable():
+    return status(2, "Binary transfer is not available with a binary subprotocol")
+
+
+def too_many_subscriptions(limit):
+    return status(3, f"Too many subscriptions, limit: {limit}")
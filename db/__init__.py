@@ -1,7 +1,9 @@
+from db.memory_db import InMemoryDB
 from db.mongo_db import MongoDB
+from db.sqlite_db import SQLiteDB
 
 
-all_drivers = ["MongoDB"]
+all_drivers = ["MongoDB", "InMemoryDB", "SQLiteDB"]
 
 
 def get(driver_name):
@@ -0,0 +1,152 @@
+import heapq
+import re
+import string
+import time
+
+from bson import ObjectId
+
+
+# Проверки запросов, общие для всех драйверов БД
+class BaseDB:
+    allowed_characters = set(string.ascii_letters + string.digits + " _-" +
+                             ''.join(chr(x) for x in range(ord('А'), ord('Я') + 1)) + 'Ё' +
+                             ''.join(chr(x) for x in range(ord('а'), ord('я') + 1)) + 'ё')
+
+    @staticmethod
+    def _chat_key(user1, user2):
+        return "-".join(sorted((str(user1), str(user2))))
+
+    @staticmethod
+    def _validate_people_filter(filter_: str):
+        if filter_ is None:
+            return True
+        if not isinstance(filter_, str):
+            return False
+        filters = filter_.split('&')
+
+        for f in filters:
+            if f != "online" and not f.startswith("role=") and not f.startswith("name-startswith="):
+                return False
+
+            if "=" in f:
+                f = f.split("=", 1)[1]
+
+            if not all(x in BaseDB.allowed_characters for x in f):
+                return False
+
+        return True
+
+    file_expr = re.compile(r"^[A-Za-z0-9 _.]+[^.]$")
+
+    def _validate_files(self, files):
+        if not isinstance(files, list):
+            return False
+        for file in files:
+            if not isinstance(file, dict):
+                return False
+
+            # содержимое передается в "data" или ссылкой на загруженный ранее файл в "token"
+            if "name" not in file or ("data" not in file) == ("token" not in file):
+                return False
+
+            if not self.file_expr.match(file["name"]):
+                return False
+
+        return True
+
+    @staticmethod
+    def _parse_cursor(cursor):
+        if not isinstance(cursor, str):
+            return None
+        time_, _, id_ = cursor.partition("-")
+        if not time_.isdigit() or not ObjectId.is_valid(id_):
+            return None
+        return int(time_), ObjectId(id_)
+
+    @staticmethod
+    def _validate_properties_cursor(list_properties, invalid):
+        before = list_properties.get("before", None)
+        if before is not None:
+            before = BaseDB._parse_cursor(before)
+            if before is None:
+                invalid.add("before")
+
+        after = list_properties.get("after", None)
+        if after is not None:
+            after = BaseDB._parse_cursor(after)
+            if after is None or "before" in list_properties:
+                invalid.add("after")
+
+        return before, after
+
+    @staticmethod
+    def _validate_properties_range(list_properties):
+        invalid = set()
+
+        from_ = list_properties.get("from", 0)
+        if not isinstance(from_, int):
+            invalid.add("from")
+        elif from_ < 0:
+            invalid.add("from")
+
+        count = list_properties.get("count", None)
+        if count is not None and not isinstance(count, int):
+            invalid.add("count")
+        elif isinstance(count, int) and count <= 0:
+            invalid.add("count")
+
+        return from_, count, invalid
+
+    # наибольший размер файла, загружаемого по частям, байт
+    max_upload_size = 1024 ** 3
+    # незавершенная загрузка, не получавшая кусков дольше upload_ttl секунд, удаляется при следующем upload-begin
+    upload_ttl = 24 * 60 * 60
+
+    # наибольшее число сообщений в одном ответе на sync
+    sync_page_size = 500
+    # наибольшее число смен статуса в одном ответе на sync
+    sync_users_limit = 500
+    # на сколько секунд токен sync отстает от текущего времени: сообщение получает время до записи,
+    # и запись, завершившаяся позже запроса, попадет в следующую синхронизацию
+    sync_settle = 5
+
+    # token - токен из ответа на предыдущую синхронизацию, курсор вида "<время>-<id>"
+    def _validate_sync(self, token, list_properties):
+        _, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
+        if before is not None:
+            invalid.add("before")
+        if token is not None:
+            token = self._parse_cursor(token)
+            if token is None:
+                invalid.add("token")
+        count = min(count or self.sync_page_size, self.sync_page_size)
+        return token, count, after, invalid
+
+    # Статусы из БД (user_id -> (is_online, last_seen)) дополняются еще не записанными в пределах scope,
+    # они новее записанных. Отдаются не больше sync_users_limit самых свежих
+    def _sync_users(self, changes, pending, scope):
+        changes.update((user_id, state) for user_id, state in pending.items() if user_id in scope)
+        latest = heapq.nlargest(self.sync_users_limit, changes.items(), key=lambda change: change[1][1])
+        return [{"user-id": user_id, "is-online": is_online, "last-seen": last_seen}
+                for user_id, (is_online, last_seen) in latest]
+
+    # Ответ на sync: сообщения выбираются с запасом в одно, чтобы узнать, есть ли следующая страница.
+    # Отметки о прочтении, статусы и токен следующей синхронизации отдаются только на первой странице:
+    # все, что не позже токена, уже записано и попадет на страницы этой синхронизации
+    def _sync_result(self, token, after, messages, count, reads, users):
+        has_more = len(messages) > count
+        messages = messages[:count]
+        next_token = None
+        if after is None:
+            settled = (int(time.time()) - self.sync_settle, ObjectId(b"\0" * 12))
+            next_time, next_id = settled if token is None else max(token, settled)
+            next_token = f"{next_time}-{next_id}"
+        return {
+            "token": next_token,
+            "messages": messages,
+            "reads": reads,
+            "users": users,
+            "cursor": messages[-1]["cursor"] if messages else None,
+            "has-more": has_more
+        }
@@ -0,0 +1,112 @@
+import bisect
+from itertools import islice
+
+
+# Справочник пользователей в памяти для people: профили в том виде, в котором их возвращает people,
+# и отсортированные индексы по имени, должности и статусу. Ключ индекса заканчивается id пользователя,
+# поэтому порядок однозначен и страницы не пересекаются. Фильтр name-startswith - диапазон индекса имен,
+# role= - диапазон индекса должностей, online - диапазон индекса статусов.
+class UserDirectory:
+    sorts = ("username", "role", "last-seen")
+
+    def __init__(self):
+        self.users = {}
+        self.indexes = {sort: [] for sort in self.sorts}
+
+    @staticmethod
+    def _key(user, sort):
+        if sort == "last-seen":
+            return user["is-online"], user["last-seen"], user["id"]
+        return user[sort], user["id"]
+
+    def __len__(self):
+        return len(self.users)
+
+    def put(self, user):
+        self.remove(user["id"])
+        self.users[user["id"]] = user
+        for sort, index in self.indexes.items():
+            bisect.insort(index, self._key(user, sort))
+
+    # профиль, прочитанный из БД, может быть старше статуса, уже известного справочнику
+    def merge(self, user):
+        old = self.users.get(user["id"])
+        if old is not None and old["last-seen"] >= user["last-seen"]:
+            user = {**user, "is-online": old["is-online"], "last-seen": old["last-seen"]}
+        self.put(user)
+
+    def remove(self, user_id):
+        user = self.users.pop(user_id, None)
+        if user is None:
+            return
+        for sort, index in self.indexes.items():
+            del index[bisect.bisect_left(index, self._key(user, sort))]
+
+    # полная замена содержимого, например при периодической перезагрузке из БД
+    def load(self, users):
+        old, self.users = self.users, {}
+        for user in users:
+            previous = old.get(user["id"])
+            if previous is not None and previous["last-seen"] >= user["last-seen"]:
+                user = {**user, "is-online": previous["is-online"], "last-seen": previous["last-seen"]}
+            self.users[user["id"]] = user
+        self.indexes = {sort: sorted(self._key(user, sort) for user in self.users.values()) for sort in self.sorts}
+
+    def update_presence(self, user_id, is_online, last_seen):
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        index = self.indexes["last-seen"]
+        del index[bisect.bisect_left(index, self._key(user, "last-seen"))]
+
+        # профили не изменяются на месте: они могут быть в уже сформированных ответах
+        user = self.users[user_id] = {**user, "is-online": is_online, "last-seen": last_seen}
+        bisect.insort(index, self._key(user, "last-seen"))
+
+    def _range(self, sort, lo, hi):
+        index = self.indexes[sort]
+        return bisect.bisect_left(index, lo), bisect.bisect_left(index, hi)
+
+    # filter_ уже проверен (BaseDB._validate_people_filter)
+    def people(self, filter_, sort, ascend, from_, count):
+        online, role, prefix = False, None, None
+        for f in filter_.split("&") if filter_ is not None else ():
+            if f == "online":
+                online = True
+            elif f.startswith("role="):
+                role = f.split("=", 1)[1]
+            elif f.startswith("name-startswith="):
+                prefix = f.split("=", 1)[1]
+
+        # диапазоны индексов, выделяемые условиями; символ "\0" не бывает в проверенных строках,
+        # поэтому (role + "\0",) - граница сразу после всех ключей с этой должностью
+        ranges = {}
+        if prefix is not None:
+            ranges["username"] = self._range("username", (prefix,), (prefix + "\U0010ffff",))
+        if role is not None:
+            ranges["role"] = self._range("role", (role,), (role + "\0",))
+        if online:
+            ranges["last-seen"] = self._range("last-seen", (True,), (True, float("inf")))
+
+        def matches(user):
+            return ((not online or user["is-online"]) and (role is None or user["role"] == role)
+                    and (prefix is None or user["username"].startswith(prefix)))
+
+        index = self.indexes[sort]
+        lo, hi = ranges.get(sort, (0, len(index)))
+        narrowest = min(ranges, key=lambda name: ranges[name][1] - ranges[name][0], default=sort)
+
+        if narrowest != sort and ranges[narrowest][1] - ranges[narrowest][0] < hi - lo:
+            # другое условие выделяет меньше пользователей, чем диапазон индекса сортировки:
+            # сортируются только они
+            n_lo, n_hi = ranges[narrowest]
+            candidates = (self.users[key[-1]] for key in self.indexes[narrowest][n_lo:n_hi])
+            keys = sorted((self._key(user, sort) for user in candidates if matches(user)), reverse=not ascend)
+            selected = (self.users[key[-1]] for key in keys)
+        else:
+            # обход индекса сортировки останавливается, как только набрана страница
+            order = range(lo, hi) if ascend else range(hi - 1, lo - 1, -1)
+            selected = (user for user in (self.users[index[i][-1]] for i in order) if matches(user))
+
+        end = None if count is None else from_ + count
+        return list(islice(selected, from_, end))
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Хранилище содержимого файлов, адресуемое хэшем: одинаковые вложения хранятся один раз.
+# Файл с хэшем abcdef... лежит в {root}/ab/cd/abcdef..., чтобы в одной папке не было миллионов записей.
+# Вся работа с диском выполняется в пуле потоков, чтобы большие файлы не блокировали цикл событий.
+class FileStore:
+    def __init__(self, root="files", workers=None):
+        self.root = root
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="file-store")
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    # файлы, сохраненные до появления хранилища, лежат в корне под именем токена
+    def legacy_path(self, token):
+        return os.path.join(self.root, token)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # запись во временный файл и атомарная замена - одновременные записи одного содержимого безопасны
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    # файлы загрузок, принимаемых по частям, до завершения загрузки
+    def upload_path(self, upload_id):
+        return os.path.join(self.root, "uploads", upload_id)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # удаляет файлы брошенных загрузок
+    async def remove(self, paths):
+        await self.run(self._remove, paths)
+
+    @staticmethod
+    def _write_at(path, offset, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(data)
+            # хвост мог остаться от куска, который был записан, но не был учтен в базе
+            f.truncate()
+
+    async def write_at(self, path, offset, data):
+        await self.run(self._write_at, path, offset, data)
+
+    def _put_file(self, src, block_size=1024 * 1024):
+        m = hashlib.sha256()
+        with open(src, "rb") as f:
+            while block := f.read(block_size):
+                m.update(block)
+        digest = m.hexdigest()
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(src)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(src, path)
+        return digest
+
+    # переносит готовый файл в хранилище, считая хэш по блокам, а не читая файл целиком
+    async def put_file(self, src):
+        return await self.run(self._put_file, src)
+
+    async def put(self, data):
+        return await self.run(self._put, data)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def read(self, path):
+        return await self.run(self._read, path)
+
+    @staticmethod
+    def _read_range(path, offset, length):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    # читает не больше length байт, поэтому память на запрос ограничена размером куска, а не файла
+    async def read_range(self, path, offset, length):
+        return await self.run(self._read_range, path, offset, length)
+
+    @staticmethod
+    def _read_range_into(path, offset, buffer):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.readinto(buffer)
+
+    async def read_range_into(self, path, offset, buffer):
+        return await self.run(self._read_range_into, path, offset, buffer)
+
+    def close(self):
+        self.executor.shutdown()
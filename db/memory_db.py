@@ -0,0 +1,605 @@
+import bisect
+import heapq
+import json
+import os
+import time
+import uuid
+from collections import Counter
+from itertools import islice, takewhile
+
+from bson import ObjectId
+
+from db.base import BaseDB
+from db.directory import UserDirectory
+from db.file_store import FileStore
+
+
+# Драйвер, хранящий все данные в памяти процесса: для профилирования сервера без MongoDB
+# и для небольших установок из одного процесса. Сообщения и пользователи не переживают перезапуск,
+# пользователи загружаются из users_file (JSON-список документов в формате коллекции users).
+class InMemoryDB(BaseDB):
+    options = ("users_file", "files_root", "file_workers", "max_upload_size", "upload_ttl")
+
+    def __init__(self, password_hasher, users_file=None, files_root="files", file_workers=None,
+                 max_upload_size=BaseDB.max_upload_size, upload_ttl=BaseDB.upload_ttl):
+        self.pswd = password_hasher
+        self.max_upload_size = max_upload_size
+        self.upload_ttl = upload_ttl
+
+        self.counters = Counter()
+
+        self.file_store = FileStore(files_root, file_workers)
+
+        # пользователи по id и по логину; справочник с индексами для people и sync
+        self.users = {}
+        self.logins = {}
+        self.directory = UserDirectory()
+
+        # беседы по ключу пары пользователей: сообщения и их ключи (time, _id) в порядке возрастания
+        self.chats = {}
+        # сводки бесед пользователя по собеседнику; ключи сводок (time, message-id) по возрастанию
+        # и собеседники в том же порядке. В сводке хранится и отметка о прочтении "read-key" - ключ
+        # последнего сообщения беседы на момент чтения
+        self.summaries = {}
+        self.summary_keys = {}
+        self.summary_peers = {}
+
+        self.files = {}
+        self.files_by_token = {}
+        self.blobs = Counter()
+        self.uploads = {}
+
+        if users_file is not None:
+            with open(users_file) as f:
+                for user in json.load(f):
+                    self.add_user(user)
+
+    @classmethod
+    def from_config(cls, cfg, password_hasher):
+        return cls(password_hasher, **{key: cfg[key] for key in cls.options if key in cfg})
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        self.file_store.close()
+
+    def add_user(self, user):
+        user = {"is-online": False, "last-seen": int(time.time()), **user}
+        user["_id"] = ObjectId(user["_id"]) if "_id" in user else ObjectId()
+        if user["login"] in self.logins:
+            raise ValueError("Such login already exists")
+
+        self.users[user["_id"]] = user
+        self.logins[user["login"]] = user
+        self.directory.put(self._user_view(user))
+        return user["_id"]
+
+    def _get_user(self, user_id):
+        return self.users.get(user_id)
+
+    @staticmethod
+    def _user_view(user, public_key=True):
+        res = {
+            "id": user["_id"],
+            "username": user["username"],
+            "role": user["role"],
+            "is-online": user["is-online"],
+            "last-seen": user["last-seen"]
+        }
+        if public_key:
+            res["public-key"] = user["public-key"]
+        return res
+
+    def _get_or_create_chat(self, user1, user2):
+        key = self._chat_key(user1, user2)
+        chat = self.chats.get(key)
+        if chat is None:
+            chat = self.chats[key] = {"name": key, "messages": [], "keys": []}
+        return chat
+
+    async def validate_password(self, login, password):
+        user = self.logins.get(login)
+
+        if user is None:
+            return False, None, None, None
+
+        hashed = user["password"]
+
+        valid = await self.pswd.check_password_async(password, hashed)
+
+        if valid:
+            if self.pswd.needs_rehash(hashed):
+                rehashed = await self.pswd.hash_password_async(password)
+                if user["password"] == hashed:
+                    user["password"] = rehashed
+            return valid, user["_id"], user["public-key"], user["private-key"]
+        return False, None, None, None
+
+    async def _update_user_online_status(self, user_id, status):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        self.counters["presence-queries"] += 1
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+
+        user["is-online"] = status
+        user["last-seen"] = int(time.time())
+        self.directory.update_presence(user_id, status, user["last-seen"])
+
+        return {"user-id": user_id, "is-online": user["is-online"], "last-seen": user["last-seen"]}
+
+    async def make_user_online(self, user_id):
+        return await self._update_user_online_status(user_id, True)
+
+    async def make_user_offline(self, user_id):
+        return await self._update_user_online_status(user_id, False)
+
+    async def people(self, list_properties):
+        from_, count, invalid = self._validate_properties_range(list_properties)
+
+        sort = list_properties.get("sort", "username")
+        if sort not in ("username", "last-seen", "role"):
+            invalid.add("sort")
+
+        ascend = list_properties.get("is-ascending", sort != "last-seen")
+        if not isinstance(ascend, bool):
+            invalid.add("is-ascending")
+
+        filter_ = list_properties.get("filter", None)
+        if not self._validate_people_filter(filter_):
+            invalid.add("filter")
+
+        if invalid:
+            return None, invalid
+
+        return self.directory.people(filter_, sort, ascend, from_, count), None
+
+    async def get_user(self, user_id):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        user = self._get_user(user_id)
+
+        if user is None:
+            return None, False
+
+        return self._user_view(user, public_key=False), True
+
+    async def save_files(self, files, owner_id, uploaded):
+        res = []
+        for file in files:
+            token = uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex
+            if "token" in file:
+                digest = uploaded[file["token"]]["blob"]
+                size = uploaded[file["token"]]["size"]
+            else:
+                enc = file["data"].encode('utf-8')
+                digest = await self.file_store.put(enc)
+                size = len(enc)
+            self.blobs[digest] += 1
+
+            saved = {
+                "_id": ObjectId(),
+                "name": file["name"],
+                "token": token,
+                "size": size,
+                "owner-id": owner_id,
+                "blob": digest
+            }
+            self.files[saved["_id"]] = saved
+            self.files_by_token[token] = saved
+            res.append(saved)
+
+        return [f["_id"] for f in res], res
+
+    def _find_uploaded(self, owner_id, messages):
+        uploaded = {}
+        for message in messages:
+            for f in message.get("files", []):
+                if "token" not in f:
+                    continue
+                file = self.files_by_token.get(f["token"])
+                if file is None or file["owner-id"] != owner_id:
+                    return None
+                uploaded[f["token"]] = file
+        return uploaded
+
+    async def upload_begin(self, owner_id, name, size):
+        if not self.file_expr.match(name) or not 0 <= size <= self.max_upload_size:
+            return None
+
+        await self._expire_uploads()
+
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {
+            "_id": upload_id,
+            "owner-id": owner_id,
+            "name": name,
+            "size": size,
+            "received": 0,
+            "time": int(time.time())
+        }
+        return upload_id
+
+    # "time" загрузки - время последнего принятого куска
+    async def _expire_uploads(self):
+        cutoff = int(time.time()) - self.upload_ttl
+        expired = [upload_id for upload_id, upload in self.uploads.items() if upload["time"] < cutoff]
+        for upload_id in expired:
+            del self.uploads[upload_id]
+        if expired:
+            await self.file_store.remove([self.file_store.upload_path(x) for x in expired])
+
+    def _find_upload(self, owner_id, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None or upload["owner-id"] != owner_id:
+            return None
+        return upload
+
+    async def upload_status(self, owner_id, upload_id):
+        upload = self._find_upload(owner_id, upload_id)
+        return None if upload is None else dict(upload)
+
+    async def upload_chunk(self, owner_id, upload_id, offset, data):
+        upload = self._find_upload(owner_id, upload_id)
+
+        if upload is None:
+            return None, False
+        if offset != upload["received"] or offset + len(data) > upload["size"]:
+            return dict(upload), False
+
+        await self.file_store.write_at(self.file_store.upload_path(upload_id), offset, data)
+
+        # пока кусок записывался, мог быть принят другой кусок с тем же смещением
+        if upload["received"] != offset:
+            return dict(upload), False
+        upload["received"] = offset + len(data)
+        upload["time"] = int(time.time())
+        return dict(upload), True
+
+    async def upload_commit(self, owner_id, upload_id):
+        upload = self._find_upload(owner_id, upload_id)
+
+        if upload is None:
+            return None, False
+        if upload["received"] != upload["size"]:
+            return dict(upload), False
+
+        del self.uploads[upload_id]
+
+        path = self.file_store.upload_path(upload_id)
+        if upload["size"] == 0:
+            await self.file_store.write_at(path, 0, b"")
+
+        digest = await self.file_store.put_file(path)
+
+        file = {
+            "_id": ObjectId(),
+            "name": upload["name"],
+            "token": uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex,
+            "size": upload["size"],
+            "owner-id": owner_id,
+            "blob": digest
+        }
+
+        self.blobs[digest] += 1
+        self.files[file["_id"]] = file
+        self.files_by_token[file["token"]] = file
+
+        return {"name": file["name"], "token": file["token"], "size": file["size"]}, True
+
+    # текст и вложения сообщения, предназначенные одному из участников беседы
+    @staticmethod
+    def _part(message, target):
+        return message["messages"][0 if message["messages"][0]["target"] == target else 1]
+
+    # сообщение прочитано получателем, если его ключ не позже отметки о прочтении
+    def _read_mark(self, user_id, peer_id):
+        return self.summaries.get(user_id, {}).get(peer_id, {}).get("read-key")
+
+    @staticmethod
+    def _is_read(key, mark):
+        return mark is not None and key <= mark
+
+    def _message_view(self, message, target, seen=False):
+        part = self._part(message, target)
+        files = [self.files[f] for f in part["files"]]
+        return {
+            "sender": message["sender-id"],
+            "receiver": message["receiver-id"],
+            "time": message["time"],
+            "text": part["text"],
+            "seen": seen,
+            "cursor": f"{message['time']}-{message['_id']}",
+            "files": [{"name": f["name"], "token": f["token"], "size": f["size"]} for f in files]
+        }
+
+    async def send_message(self, sender_id, receiver_id, message_for_receiver, message_for_sender):
+        if isinstance(sender_id, str):
+            sender_id = ObjectId(sender_id)
+
+        if isinstance(receiver_id, str):
+            receiver_id = ObjectId(receiver_id)
+
+        if sender_id == receiver_id:
+            return None, False, None
+
+        if self._get_user(receiver_id) is None:
+            return None, False, None
+
+        if self._get_user(sender_id) is None:
+            raise ValueError("Unknown sender")
+
+        for message in message_for_receiver, message_for_sender:
+
+            text = message.get("text", "")
+            files = message.get("files", [])
+
+            if not (text or files):
+                return None, True, "The message is empty"
+
+            if not self._validate_files(files):
+                return None, True, "invalid file"
+
+        uploaded = self._find_uploaded(sender_id, (message_for_receiver, message_for_sender))
+        if uploaded is None:
+            return None, True, "invalid file"
+
+        sender_ids, _ = await self.save_files(message_for_sender.get("files", []), sender_id, uploaded)
+        receiver_ids, _ = await self.save_files(message_for_receiver.get("files", []), receiver_id, uploaded)
+
+        chat = self._get_or_create_chat(sender_id, receiver_id)
+
+        message = {
+            "_id": ObjectId(),
+            "sender-id": sender_id,
+            "receiver-id": receiver_id,
+            "time": int(time.time()),
+            "messages": [
+                {
+                    "target": sender_id,
+                    "text": message_for_sender["text"],
+                    "files": sender_ids
+                },
+                {
+                    "target": receiver_id,
+                    "text": message_for_receiver["text"],
+                    "files": receiver_ids
+                }
+            ]
+        }
+
+        key = (message["time"], message["_id"])
+        index = bisect.bisect(chat["keys"], key)
+        chat["keys"].insert(index, key)
+        chat["messages"].insert(index, message)
+
+        server_message_for_receiver = self._message_view(message, receiver_id)
+        server_message_for_sender = self._message_view(message, sender_id)
+
+        self._update_summary(sender_id, receiver_id, message, server_message_for_sender, 0)
+        self._update_summary(receiver_id, sender_id, message, server_message_for_receiver, 1)
+
+        return server_message_for_receiver, True, None
+
+    def _update_summary(self, user_id, peer_id, message, view, unread):
+        summaries = self.summaries.setdefault(user_id, {})
+        keys = self.summary_keys.setdefault(user_id, [])
+        peers = self.summary_peers.setdefault(user_id, [])
+
+        summary = summaries.get(peer_id)
+        if summary is None:
+            summary = summaries[peer_id] = {"unread": 0}
+        else:
+            index = bisect.bisect_left(keys, summary["key"])
+            del keys[index], peers[index]
+
+        summary["key"] = (message["time"], message["_id"])
+        summary["last-message"] = view
+        summary["unread"] += unread
+
+        index = bisect.bisect(keys, summary["key"])
+        keys.insert(index, summary["key"])
+        peers.insert(index, peer_id)
+
+    # Выбирает элементы, упорядоченные по ключам keys (по возрастанию), начиная от курсора:
+    # при "before" - в порядке убывания, при "after" - в порядке возрастания
+    @staticmethod
+    def _from_cursor(items, keys, before, after):
+        if after is not None:
+            start = bisect.bisect_right(keys, after)
+            return (items[i] for i in range(start, len(items)))
+        end = len(items) if before is None else bisect.bisect_left(keys, before)
+        return (items[i] for i in range(end - 1, -1, -1))
+
+    @staticmethod
+    def _page(items, from_, count):
+        return list(islice(items, from_, None if count is None else from_ + count))
+
+    async def messages(self, target, other, list_properties):
+        from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
+
+        if isinstance(target, str):
+            target = ObjectId(target)
+        if isinstance(other, str):
+            other = ObjectId(other)
+
+        filter_ = list_properties.get("filter", None)
+        if filter_ not in {"has-files", "new", None}:
+            invalid.add("filter")
+
+        if invalid:
+            return None, None, invalid
+
+        if self._get_user(other) is None:
+            return None, False, None
+
+        if self._get_user(target) is None:
+            raise ValueError("Unknown receiver")
+
+        chat = self.chats.get(self._chat_key(target, other))
+
+        if chat is None:
+            return [], True, None
+
+        target_mark = self._read_mark(target, other)
+        marks = {target: target_mark, other: self._read_mark(other, target)}
+
+        # непрочитанные - полученные после отметки о прочтении
+        if filter_ == "new" and target_mark is not None and after is not None:
+            after = max(after, target_mark)
+
+        selected = self._from_cursor(chat["messages"], chat["keys"], before, after)
+
+        if filter_ == "new":
+            if target_mark is not None:
+                selected = takewhile(lambda m: (m["time"], m["_id"]) > target_mark, selected)
+            selected = (m for m in selected if m["receiver-id"] == target)
+        elif filter_ == "has-files":
+            selected = (m for m in selected if self._part(m, target)["files"])
+
+        res = [self._message_view(m, target, self._is_read((m["time"], m["_id"]), marks[m["receiver-id"]]))
+               for m in self._page(selected, from_, count)]
+
+        if after is not None:
+            res.reverse()
+
+        return res, True, None
+
+    async def people_with_messages(self, user_id, list_properties):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
+        if invalid:
+            return None, invalid
+
+        summaries = self.summaries.get(user_id, {})
+        keys = self.summary_keys.get(user_id, [])
+        peers = self.summary_peers.get(user_id, [])
+
+        selected = self._from_cursor(peers, keys, before, after)
+
+        res = []
+        for peer_id in self._page(selected, from_, count):
+            summary = summaries[peer_id]
+            message = summary["last-message"]
+            mark = self._read_mark(message["receiver"], message["sender"])
+            res.append({
+                "user": self._user_view(self.users[peer_id]),
+                "last-message": {**message, "seen": self._is_read(summary["key"], mark)},
+                "unread": summary["unread"]
+            })
+
+        if after is not None:
+            res.reverse()
+
+        return res, None
+
+    # Все изменения для пользователя с момента since: новые сообщения во всех беседах по возрастанию
+    # курсора (страницами), отметки о прочтении его бесед и смены статусов пользователей
+    async def sync(self, user_id, token, list_properties, watched=()):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        token, count, after, invalid = self._validate_sync(token, list_properties)
+        if invalid:
+            return None, invalid
+
+        since = token[0] if token is not None else 0
+        start = after if after is not None else token
+        summaries = self.summaries.get(user_id, {})
+
+        # беседы с новыми сообщениями - по ключам сводок пользователя
+        keys = self.summary_keys.get(user_id, [])
+        peers = self.summary_peers.get(user_id, [])
+        if start is not None:
+            peers = peers[bisect.bisect_right(keys, start):]
+
+        def chat_messages(peer_id):
+            chat = self.chats[self._chat_key(user_id, peer_id)]
+            index = bisect.bisect_right(chat["keys"], start) if start is not None else 0
+            return (chat["messages"][i] for i in range(index, len(chat["messages"])))
+
+        merged = heapq.merge(*(chat_messages(peer_id) for peer_id in peers),
+                             key=lambda m: (m["time"], m["_id"]))
+        messages = []
+        for m in islice(merged, count + 1):
+            mark = self._read_mark(m["receiver-id"], m["sender-id"])
+            messages.append(self._message_view(m, user_id, self._is_read((m["time"], m["_id"]), mark)))
+
+        reads, users = [], []
+        if after is None:
+            for peer_id, summary in summaries.items():
+                for reader, peer, read in ((user_id, peer_id, summary),
+                                           (peer_id, user_id, self.summaries[peer_id].get(user_id, {}))):
+                    if read.get("read-at", -1) >= since:
+                        time_, message_id = read["read-key"]
+                        reads.append({"reader": reader, "peer": peer, "cursor": f"{time_}-{message_id}"})
+
+            # статусы собеседников и пользователей из watched
+            changes = {}
+            for peer_id in set(summaries) | set(watched):
+                user = self.directory.users.get(peer_id)
+                if user is not None and user["last-seen"] >= since:
+                    changes[peer_id] = (user["is-online"], user["last-seen"])
+            users = self._sync_users(changes, {}, changes)
+
+        return self._sync_result(token, after, messages, count, reads, users), None
+
+    async def get_file(self, user_id, token):
+        if self._get_user(user_id) is None:
+            raise ValueError("Unknown user")
+
+        file = self.files_by_token.get(token)
+
+        if file is None:
+            return None, None
+        if file["owner-id"] != user_id:
+            return None, None
+
+        return self.file_store.path(file["blob"]), file["size"]
+
+    async def download(self, user_id, token):
+        path, _ = await self.get_file(user_id, token)
+
+        if path is None:
+            return None, False
+
+        data = await self.file_store.read(path)
+        return data.decode("utf-8"), True
+
+    async def read_file(self, path, offset, length):
+        return await self.file_store.read_range(path, offset, length)
+
+    async def read_file_into(self, path, offset, buffer):
+        return await self.file_store.read_range_into(path, offset, buffer)
+
+    # Возвращает признак существования собеседника и признак того, что были непрочитанные сообщения
+    async def read(self, reader_id, other_id):
+        if isinstance(reader_id, str):
+            reader_id = ObjectId(reader_id)
+
+        if isinstance(other_id, str):
+            other_id = ObjectId(other_id)
+
+        if self._get_user(reader_id) is None:
+            raise ValueError("Unknown user")
+
+        if self._get_user(other_id) is None:
+            return False, False
+
+        summary = self.summaries.get(reader_id, {}).get(other_id)
+
+        if summary is None or summary["unread"] == 0:
+            return True, False
+
+        summary["read-key"] = summary["key"]
+        summary["read-at"] = int(time.time())
+        summary["unread"] = 0
+        return True, True
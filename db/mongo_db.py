@@ -1,25 +1,229 @@
 import asyncio
+import heapq
+import logging
 import os
 import re
 import uuid
 import motor.motor_asyncio
-import string
 import time
+from collections import Counter
+from itertools import islice
+
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from db.base import BaseDB
+from db.cache import LRUCache, TTLCache
+from db.directory import UserDirectory
+from db.file_store import FileStore
+from db.presence import PresenceBuffer
+
+logger = logging.getLogger("smln.db")
+
 
+class MongoDB(BaseDB):
+    layouts = ("per-chat", "single")
 
-class MongoDB:
-    allowed_characters = set(string.ascii_letters + string.digits + " _-" +
-                             ''.join(chr(x) for x in range(ord('А'), ord('Я') + 1)) + 'Ё' +
-                             ''.join(chr(x) for x in range(ord('а'), ord('я') + 1)) + 'ё')
+    def __init__(self, conn_str, password_hasher, layout="per-chat", chat_cache_size=10000,
+                 user_cache_size=10000, user_cache_ttl=60, watch_users=False, files_root="files", file_workers=None,
+                 presence_flush_interval=0.005, user_directory=True, directory_refresh=60,
+                 max_upload_size=BaseDB.max_upload_size, upload_ttl=BaseDB.upload_ttl):
+        if layout not in self.layouts:
+            raise ValueError("Unknown messages layout")
+        self.layout = layout
 
-    def __init__(self, conn_str, password_hasher):
         client = motor.motor_asyncio.AsyncIOMotorClient(conn_str)
 
         self.db = client["smln-server"]
 
         self.pswd = password_hasher
 
+        self.counters = Counter()
+
+        self.file_store = FileStore(files_root, file_workers)
+        self.max_upload_size = max_upload_size
+        self.upload_ttl = upload_ttl
+
+        # имя беседы для пары пользователей не меняется, поэтому кэш не нужно инвалидировать
+        self.chat_cache = LRUCache(chat_cache_size)
+        self.chat_creations = {}
+
+        # профили пользователей для проверок существования и get-user;
+        # обновляется при смене статуса и, если включено, по change stream коллекции users
+        self.user_cache = TTLCache(user_cache_size, user_cache_ttl)
+        self.watch_users = watch_users
+        self.watcher = None
+
+        # смены статуса пользователей записываются пачками раз в presence_flush_interval секунд
+        self.presence = PresenceBuffer(self._write_presence, presence_flush_interval)
+
+        # справочник пользователей для people загружается в start(); без change stream он
+        # перезагружается раз в directory_refresh секунд
+        self.user_directory = user_directory
+        self.directory_refresh = directory_refresh
+        self.directory = None
+        self.directory_refresher = None
+
+    # необязательные параметры: layout - способ хранения сообщений ("per-chat" или "single"),
+    # chat_cache_size, user_cache_size, user_cache_ttl, watch_users - настройки кэшей,
+    # files_root, file_workers - папка файлового хранилища и число потоков для работы с диском,
+    # presence_flush_interval - задержка записи смен статуса пользователей,
+    # user_directory, directory_refresh - справочник пользователей в памяти для people,
+    # max_upload_size, upload_ttl - наибольший размер загрузки по частям и время жизни брошенной загрузки
+    options = ("layout", "chat_cache_size", "user_cache_size", "user_cache_ttl", "watch_users", "files_root",
+               "file_workers", "presence_flush_interval", "user_directory", "directory_refresh", "max_upload_size",
+               "upload_ttl")
+
+    @classmethod
+    def from_config(cls, cfg, password_hasher):
+        auth = ""
+        if hasattr(cfg, "login"):
+            auth = f"{cfg.login}:{cfg.password}@"
+
+        connection_string = f"mongodb://{auth}{cfg.host}"
+
+        return cls(connection_string, password_hasher, **{key: cfg[key] for key in cls.options if key in cfg})
+
+    async def start(self):
+        if self.user_directory:
+            self.directory = UserDirectory()
+            await self._load_directory()
+
+        if self.watch_users:
+            self.watcher = asyncio.create_task(self._watch_users())
+        elif self.directory is not None and self.directory_refresh:
+            self.directory_refresher = asyncio.create_task(self._refresh_directory())
+
+    # записывает накопленные смены статуса; вызывается при остановке сервера
+    async def close(self):
+        for task in self.watcher, self.directory_refresher:
+            if task is not None:
+                task.cancel()
+        await self.presence.close()
+        self.file_store.close()
+
+    # Change stream доступен только на наборе реплик. Если его нет или он оборвался, справочник
+    # дальше перезагружается раз в directory_refresh секунд, а профили в кэше живут не дольше user_cache_ttl
+    async def _watch_users(self):
+        try:
+            async with self.db["users"].watch(full_document="updateLookup") as stream:
+                async for change in stream:
+                    user_id = change["documentKey"]["_id"]
+                    self.user_cache.pop(user_id)
+                    if self.directory is None:
+                        continue
+                    user = change.get("fullDocument")
+                    if user is None:
+                        self.directory.remove(user_id)
+                    else:
+                        self.directory.merge(self._directory_entry(user))
+        except PyMongoError:
+            self.counters["watch-errors"] += 1
+            logger.exception("Change stream on users is unavailable, falling back to periodic directory refresh")
+
+        if self.directory is not None and self.directory_refresh:
+            await self._refresh_directory()
+
+    directory_projection = {"username": 1, "role": 1, "is-online": 1, "last-seen": 1, "public-key": 1}
+
+    def _directory_entry(self, user):
+        user_id = user["_id"]
+        user = self.presence.apply(user_id, user)
+        return {
+            "id": user_id,
+            "username": user["username"],
+            "role": user["role"],
+            "is-online": user.get("is-online", False),
+            "last-seen": user.get("last-seen", 0),
+            "public-key": user.get("public-key", "")
+        }
+
+    async def _load_directory(self):
+        self.counters["directory-loads"] += 1
+        users = [self._directory_entry(user) async for user in self.db["users"].find({}, self.directory_projection)]
+        self.directory.load(users)
+
+    async def _refresh_directory(self):
+        while True:
+            await asyncio.sleep(self.directory_refresh)
+            try:
+                await self._load_directory()
+            except Exception:
+                # до следующей попытки people отвечает по прежнему содержимому справочника
+                self.counters["directory-errors"] += 1
+
+    user_projection = {"username": 1, "role": 1, "is-online": 1, "last-seen": 1}
+
+    async def _get_user(self, user_id):
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        self.counters["user-queries"] += 1
+        user = await self.db["users"].find_one({"_id": user_id}, self.user_projection)
+        if user is None:
+            return None
+
+        del user["_id"]
+        user = self.presence.apply(user_id, user)
+        self.user_cache.put(user_id, user)
+        return user
+
+    # Сообщения хранятся либо в отдельной коллекции на каждую беседу ("per-chat"),
+    # либо в общей коллекции messages с полем chat и составными индексами ("single").
+    # Возвращает коллекцию с сообщениями беседы и условие, выделяющее их в этой коллекции.
+    def _chat_messages(self, name):
+        if self.layout == "single":
+            return self.db["messages"], {"chat": name}
+        return self.db[name], {}
+
+    async def _find_chat(self, user1, user2):
+        key = self._chat_key(user1, user2)
+        name = self.chat_cache.get(key)
+        if name is not None:
+            return name
+
+        chat = await self.db["chats"].find_one({"users": {"$all": [user1, user2]}}, {"name": 1})
+        if chat is None:
+            return None
+
+        self.chat_cache.put(key, chat["name"])
+        return chat["name"]
+
+    async def _create_chat(self, key, user1, user2):
+        chats = self.db["chats"]
+        name = uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex
+
+        # уникальный индекс по key не дает создать две беседы для одной пары из разных процессов
+        try:
+            chat = await chats.find_one_and_update({"key": key},
+                                                   {"$setOnInsert": {"name": name, "users": [user1, user2]}},
+                                                   {"name": 1}, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            chat = await chats.find_one({"key": key}, {"name": 1})
+
+        # коллекции новой беседы нужен индекс для истории и sync, как у messages в режиме "single"
+        if self.layout != "single" and chat["name"] == name:
+            await self.db[name].create_index([("time", 1), ("_id", 1)])
+
+        self.chat_cache.put(key, chat["name"])
+        return chat["name"]
+
+    # одновременные первые сообщения одной пары ждут одного и того же создания беседы
+    async def _get_or_create_chat(self, user1, user2):
+        name = await self._find_chat(user1, user2)
+        if name is not None:
+            return name
+
+        key = self._chat_key(user1, user2)
+        task = self.chat_creations.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create_chat(key, user1, user2))
+            self.chat_creations[key] = task
+            task.add_done_callback(lambda _: self.chat_creations.pop(key, None))
+        return await task
+
     async def validate_password(self, login, password):
         users = self.db["users"]
         user = await users.find_one({"login": login})
@@ -29,24 +233,41 @@ class MongoDB:
 
         hashed = user["password"]
 
-        valid = self.pswd.check_password(password, hashed)
+        valid = await self.pswd.check_password_async(password, hashed)
 
         if valid:
+            if self.pswd.needs_rehash(hashed):
+                await users.update_one({"_id": user["_id"], "password": hashed},
+                                       {"$set": {"password": await self.pswd.hash_password_async(password)}})
             return valid, user["_id"], user["public-key"], user["private-key"]
         return False, None, None, None
 
+    # Статус записывается, только если в БД нет более нового: в кластере повторная попытка
+    # одного воркера не должна затирать статус, записанный другим позже
+    async def _write_presence(self, updates):
+        self.counters["presence-queries"] += 1
+        await self.db["users"].bulk_write([
+            UpdateOne({"_id": user_id, "last-seen": {"$not": {"$gt": last_seen}}},
+                      {"$set": {"is-online": status, "last-seen": last_seen}})
+            for user_id, (status, last_seen) in updates.items()
+        ], ordered=False)
+
+    # Статус записывается в БД отложенно (см. PresenceBuffer), без предварительного чтения пользователя.
+    # Возвращает данные для события activity-update.
     async def _update_user_online_status(self, user_id, status):
         if isinstance(user_id, str):
             user_id = ObjectId(user_id)
-        users = self.db["users"]
-        user = await users.find_one({"_id": user_id})
 
-        if user is None:
-            return False
+        last_seen = int(time.time())
+        self.presence.put(user_id, status, last_seen)
+        if self.directory is not None:
+            self.directory.update_presence(user_id, status, last_seen)
+
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            self.user_cache.put(user_id, {**user, "is-online": status, "last-seen": last_seen})
 
-        await users.update_one({"_id": user_id}, {"$set": {"is-online": status,
-                                                           "last-seen": int(time.time())}})
-        return True
+        return {"user-id": user_id, "is-online": status, "last-seen": last_seen}
 
     async def make_user_online(self, user_id):
         return await self._update_user_online_status(user_id, True)
@@ -54,31 +275,6 @@ class MongoDB:
     async def make_user_offline(self, user_id):
         return await self._update_user_online_status(user_id, False)
 
-    @staticmethod
-    def _validate_people_filter(filter_: str):
-        if filter_ is None:
-            return True
-        if not isinstance(filter_, str):
-            return False
-        filters = filter_.split('&')
-
-        for f in filters:
-            if f != "online" and not f.startswith("role=") and not f.startswith("name-startswith="):
-                return False
-
-            if "=" in f:
-                f = f.split("=", 1)[1]
-
-            if not all(x in MongoDB.allowed_characters for x in f):
-                return False
-
-        return True
-
-    @staticmethod
-    def _remove_id_underscore(dct):
-        dct["id"] = dct["_id"]
-        del dct["_id"]
-
     async def people(self, list_properties):
         from_, count, invalid = self._validate_properties_range(list_properties)
 
@@ -97,36 +293,19 @@ class MongoDB:
         if invalid:
             return None, invalid
 
-        users = self.db["users"]
-
-        aggregate_pipeline = []
+        if self.directory is not None:
+            return self.directory.people(filter_, sort, ascend, from_, count), None
 
-        project = {
-            "_id": 0,
-            "id": "$_id",
-            "username": 1,
-            "role": 1,
-            "is-online": 1,
-            "last-seen": 1,
-            "public-key": 1
-        }
-
-        aggregate_pipeline.append({"$project": project})
-
-        if filter_ is not None:
-            match = {}
-
-            for f in filter_.split("&"):
-                if f == "online":
-                    match["is-online"] = True
-                elif f.startswith("role="):
-                    role = f.split("=", 1)[1]
-                    match["role"] = role
-                elif f.startswith("name-startswith="):
-                    prefix = f.split("=", 1)[1]
-                    match["username"] = {"$regex": f"^{prefix}"}
+        match = {}
 
-            aggregate_pipeline.append({"$match": match})
+        for f in filter_.split("&") if filter_ is not None else ():
+            if f == "online":
+                match["is-online"] = True
+            elif f.startswith("role="):
+                match["role"] = f.split("=", 1)[1]
+            elif f.startswith("name-startswith="):
+                # привязанное к началу выражение без флагов использует индекс по username
+                match["username"] = {"$regex": "^" + re.escape(f.split("=", 1)[1])}
 
         sort_ = {}
 
@@ -137,68 +316,179 @@ class MongoDB:
             sort_["last-seen"] = asc
         else:
             sort_[sort] = asc
+        # однозначный порядок нужен, чтобы страницы не пересекались
+        sort_["_id"] = asc
+
+        # $match и $sort до $project, чтобы использовались индексы коллекции users
+        aggregate_pipeline = [
+            {"$match": match},
+            {"$sort": sort_},
+            *self._page_stages(from_, count),
+            {
+                "$project": {
+                    "_id": 0,
+                    "id": "$_id",
+                    "username": 1,
+                    "role": 1,
+                    "is-online": 1,
+                    "last-seen": 1,
+                    "public-key": 1
+                }
+            }
+        ]
 
-        aggregate_pipeline.append({"$sort": sort_})
-
+        self.counters["people-queries"] += 1
         res = []
 
-        async for x in users.aggregate(aggregate_pipeline):
+        async for x in self.db["users"].aggregate(aggregate_pipeline):
             res.append(x)
 
-        return res[slice(from_, (None if count is None else from_ + count))], None
+        return res, None
 
     async def get_user(self, user_id):
-        users = self.db['users']
         if isinstance(user_id, str):
             user_id = ObjectId(user_id)
 
-        res = await users.find_one({"_id": user_id}, {"username": 1, "role": 1, "is-online": 1, "last-seen": 1})
+        res = await self._get_user(user_id)
 
         if res is None:
             return res, False
 
-        self._remove_id_underscore(res)
-        return res, True
-
-    file_expr = re.compile(r"^[A-Za-z0-9 _.]+[^.]$")
+        return {**res, "id": user_id}, True
 
-    def _validate_files(self, files):
-        if not isinstance(files, list):
-            return False
-        for file in files:
-            if not isinstance(file, dict):
-                return False
-
-            if "name" not in file or "data" not in file:
-                return False
-
-            if not self.file_expr.match(file["name"]):
-                return False
-
-        return True
-
-    async def save_files(self, files, owner_id):
+    # uploaded - файлы отправителя, на которые ссылаются вложения с "token", по токену
+    async def save_files(self, files, owner_id, uploaded):
         if not files:
             return [], []
         cfiles = self.db["files"]
 
         res = []
+        refs = Counter()
         for file in files:
             token = uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex
-            size = len(enc := file["data"].encode('utf-8'))
-
-            with open(f"files/{token}", "wb") as f:
-                f.write(enc)
+            if "token" in file:
+                digest = uploaded[file["token"]]["blob"]
+                size = uploaded[file["token"]]["size"]
+            else:
+                enc = file["data"].encode('utf-8')
+                digest = await self.file_store.put(enc)
+                size = len(enc)
+            refs[digest] += 1
 
             res.append({
                 "name": file["name"],
                 "token": token,
                 "size": size,
-                "owner-id": owner_id
+                "owner-id": owner_id,
+                "blob": digest
             })
 
+        # у каждого владельца свой токен, а содержимое общее: blobs хранит число ссылок на него
+        await self.db["blobs"].bulk_write([
+            UpdateOne({"_id": digest}, {"$inc": {"refs": n}}, upsert=True) for digest, n in refs.items()
+        ], ordered=False)
+
         return (await cfiles.insert_many(res)).inserted_ids, res
 
+    async def _find_uploaded(self, owner_id, messages):
+        tokens = {f["token"] for message in messages for f in message.get("files", []) if "token" in f}
+        if not tokens:
+            return {}
+
+        uploaded = {}
+        async for file in self.db["files"].find({"token": {"$in": list(tokens)}, "owner-id": owner_id,
+                                                 "blob": {"$exists": True}}):
+            uploaded[file["token"]] = file
+
+        if len(uploaded) != len(tokens):
+            return None
+        return uploaded
+
+    async def upload_begin(self, owner_id, name, size):
+        if not self.file_expr.match(name) or not 0 <= size <= self.max_upload_size:
+            return None
+
+        await self._expire_uploads()
+
+        upload_id = uuid.uuid4().hex
+        await self.db["uploads"].insert_one({
+            "_id": upload_id,
+            "owner-id": owner_id,
+            "name": name,
+            "size": size,
+            "received": 0,
+            "time": int(time.time())
+        })
+        return upload_id
+
+    # "time" загрузки - время последнего принятого куска; запись удаляется с условием на время,
+    # поэтому загрузка, получившая кусок после выборки, не удаляется
+    async def _expire_uploads(self):
+        uploads = self.db["uploads"]
+        cutoff = int(time.time()) - self.upload_ttl
+        removed = []
+        async for upload in uploads.find({"time": {"$lt": cutoff}}, {"_id": 1}):
+            result = await uploads.delete_one({"_id": upload["_id"], "time": {"$lt": cutoff}})
+            if result.deleted_count:
+                removed.append(self.file_store.upload_path(upload["_id"]))
+        if removed:
+            await self.file_store.remove(removed)
+
+    async def upload_status(self, owner_id, upload_id):
+        return await self.db["uploads"].find_one({"_id": upload_id, "owner-id": owner_id})
+
+    # Принимает кусок, начинающийся ровно с уже полученного числа байт.
+    # Возвращает состояние загрузки (или None, если ее нет) и признак того, что кусок принят.
+    async def upload_chunk(self, owner_id, upload_id, offset, data):
+        uploads = self.db["uploads"]
+        upload = await uploads.find_one({"_id": upload_id, "owner-id": owner_id})
+
+        if upload is None:
+            return None, False
+        if offset != upload["received"] or offset + len(data) > upload["size"]:
+            return upload, False
+
+        await self.file_store.write_at(self.file_store.upload_path(upload_id), offset, data)
+
+        upload = await uploads.find_one_and_update({"_id": upload_id, "received": offset},
+                                                   {"$set": {"received": offset + len(data),
+                                                             "time": int(time.time())}},
+                                                   return_document=ReturnDocument.AFTER)
+        if upload is None:
+            return await uploads.find_one({"_id": upload_id}), False
+        return upload, True
+
+    # Переносит полученный файл в хранилище и выдает токен, на который можно сослаться в send.
+    # Возвращает файл (или None, если загрузки нет) и признак того, что загрузка завершена.
+    async def upload_commit(self, owner_id, upload_id):
+        uploads = self.db["uploads"]
+        upload = await uploads.find_one({"_id": upload_id, "owner-id": owner_id})
+
+        if upload is None:
+            return None, False
+        if upload["received"] != upload["size"]:
+            return upload, False
+
+        path = self.file_store.upload_path(upload_id)
+        if upload["size"] == 0:
+            await self.file_store.write_at(path, 0, b"")
+
+        digest = await self.file_store.put_file(path)
+
+        file = {
+            "name": upload["name"],
+            "token": uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex,
+            "size": upload["size"],
+            "owner-id": owner_id,
+            "blob": digest
+        }
+
+        await self.db["blobs"].update_one({"_id": digest}, {"$inc": {"refs": 1}}, upsert=True)
+        await self.db["files"].insert_one(file)
+        await uploads.delete_one({"_id": upload_id})
+
+        return {"name": file["name"], "token": file["token"], "size": file["size"]}, True
+
     async def send_message(self, sender_id, receiver_id, message_for_receiver, message_for_sender):
         if isinstance(sender_id, str):
             sender_id = ObjectId(sender_id)
@@ -209,14 +499,12 @@ class MongoDB:
         if sender_id == receiver_id:
             return None, False, None
 
-        users = self.db["users"]
-
-        receiver = await users.find_one({"_id": receiver_id})
+        receiver = await self._get_user(receiver_id)
 
         if receiver is None:
             return None, False, None
 
-        sender = await users.find_one({"_id": sender_id})
+        sender = await self._get_user(sender_id)
 
         if sender is None:
             raise ValueError("Unknown sender")
@@ -232,27 +520,24 @@ class MongoDB:
             if not self._validate_files(files):
                 return None, True, "invalid file"
 
-        chats = self.db["chats"]
+        uploaded = await self._find_uploaded(sender_id, (message_for_receiver, message_for_sender))
+        if uploaded is None:
+            return None, True, "invalid file"
 
-        chat = await chats.find_one({"users": {"$all": [sender_id, receiver_id]}})
+        name = await self._get_or_create_chat(sender_id, receiver_id)
 
-        if chat is None:
-            name = uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex
-            await chats.insert_one({"name": name, "users": [sender_id, receiver_id]})
-        else:
-            name = chat["name"]
-
-        chat = self.db[name]
+        chat, scope = self._chat_messages(name)
 
         timestamp = int(time.time())
 
-        sender_ids, _ = await self.save_files(message_for_sender.get("files", []), sender_id)
-        receiver_ids, receiver_files = await self.save_files(message_for_receiver.get("files", []), receiver_id)
+        sender_ids, sender_files = await self.save_files(message_for_sender.get("files", []), sender_id, uploaded)
+        receiver_ids, receiver_files = await self.save_files(message_for_receiver.get("files", []), receiver_id,
+                                                             uploaded)
         message = {
+            **scope,
             "sender-id": sender_id,
             "receiver-id": receiver_id,
             "time": timestamp,
-            "seen": False,
             "messages": [
                 {
                     "target": sender_id,
@@ -269,41 +554,127 @@ class MongoDB:
 
         await chat.insert_one(message)
 
-        server_message_for_receiver = {
-            "sender": sender_id,
-            "receiver": receiver_id,
-            "seen": False,
-            "text": message_for_receiver["text"],
-            "time": timestamp,
-        }
+        def server_message(text, files):
+            return {
+                "sender": sender_id,
+                "receiver": receiver_id,
+                "seen": False,
+                "text": text,
+                "time": timestamp,
+                "cursor": f"{timestamp}-{message['_id']}",
+                "files": [{"name": f["name"], "token": f["token"], "size": f["size"]} for f in files]
+            }
 
-        for f in receiver_files:
-            del f["owner-id"]
+        server_message_for_receiver = server_message(message_for_receiver["text"], receiver_files)
+        server_message_for_sender = server_message(message_for_sender["text"], sender_files)
 
-        server_message_for_receiver["files"] = receiver_files
+        await self._update_summaries(name, message["_id"], server_message_for_sender, server_message_for_receiver)
 
         return server_message_for_receiver, True, None
 
+    # chat-summaries хранит для каждой пары (пользователь, собеседник) последнее сообщение
+    # и число непрочитанных, чтобы people-with-messages был одним запросом по индексу.
+    # Одновременные отправки могут записать сводку в любом порядке, поэтому последнее сообщение
+    # заменяется, только если новое позже по (time, message-id); unread увеличивается всегда.
+    # Обновление - конвейер агрегации, чтобы сравнение и запись были одной атомарной операцией
+    async def _update_summaries(self, chat_name, message_id, message_for_sender, message_for_receiver):
+        sender_id = message_for_sender["sender"]
+        receiver_id = message_for_sender["receiver"]
+        timestamp = message_for_sender["time"]
+
+        # у новой сводки полей нет, а отсутствующее значение меньше любого числа
+        newer = {
+            "$or": [
+                {"$lt": ["$time", timestamp]},
+                {"$and": [{"$eq": ["$time", timestamp]}, {"$lt": ["$message-id", message_id]}]}
+            ]
+        }
+
+        def latest(field, value):
+            return {"$cond": [newer, {"$literal": value}, f"${field}"]}
+
+        def update(user_id, peer_id, message, unread):
+            return UpdateOne(
+                {"user": user_id, "peer": peer_id},
+                [
+                    {
+                        "$set": {
+                            "chat": latest("chat", chat_name),
+                            "time": latest("time", timestamp),
+                            "message-id": latest("message-id", message_id),
+                            "last-message": latest("last-message", message),
+                            "unread": {"$add": [{"$ifNull": ["$unread", 0]}, unread]}
+                        }
+                    }
+                ],
+                upsert=True
+            )
+
+        await self.db["chat-summaries"].bulk_write([
+            update(sender_id, receiver_id, message_for_sender, 0),
+            update(receiver_id, sender_id, message_for_receiver, 1)
+        ], ordered=False)
+
     @staticmethod
-    def _validate_properties_range(list_properties):
-        invalid = set()
+    def _page_stages(from_, count):
+        stages = []
+        if from_:
+            stages.append({"$skip": from_})
+        if count is not None:
+            stages.append({"$limit": count})
+        return stages
 
-        from_ = list_properties.get("from", 0)
-        if not isinstance(from_, int):
-            invalid.add("from")
-        elif from_ < 0:
-            invalid.add("from")
+    # Курсор сообщения - "<time>-<_id>": time имеет точность в секунду, поэтому _id нужен для однозначности
+    cursor_expr = {"$concat": [{"$toString": "$time"}, "-", {"$toString": "$_id"}]}
 
-        count = list_properties.get("count", None)
-        if count is not None and not isinstance(count, int):
-            invalid.add("count")
-        elif isinstance(count, int) and count <= 0:
-            invalid.add("count")
+    @staticmethod
+    def _cursor_match(before, after, time_field="time", id_field="_id"):
+        if before is not None:
+            op, (time_, id_) = "$lt", before
+        elif after is not None:
+            op, (time_, id_) = "$gt", after
+        else:
+            return {}
+        return {"$or": [{time_field: {op: time_}}, {time_field: time_, id_field: {op: id_}}]}
 
-        return from_, count, invalid
+    # часть сообщения, предназначенная target, с вложениями
+    def _message_stages(self, target):
+        return [
+            {
+                "$unwind": "$messages"
+            },
+            {
+                "$match": {"messages.target": target}
+            },
+            {
+                "$lookup": {
+                    "from": "files",
+                    "localField": "messages.files",
+                    "foreignField": "_id",
+                    "as": "messages.server_files"
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "sender": "$sender-id",
+                    "receiver": "$receiver-id",
+                    "time": 1,
+                    "text": "$messages.text",
+                    "cursor": self.cursor_expr,
+                    "files": {
+                        "$map": {
+                            "input": "$messages.server_files",
+                            "in": {"name": "$$this.name", "token": "$$this.token", "size": "$$this.size"}
+                        }
+                    }
+                }
+            }
+        ]
 
     async def messages(self, target, other, list_properties):
         from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
 
         if isinstance(target, str):
             target = ObjectId(target)
@@ -317,121 +688,100 @@ class MongoDB:
         if invalid:
             return None, None, invalid
 
-        users = self.db["users"]
-
-        receiver = await users.find_one({"_id": other})
+        receiver = await self._get_user(other)
 
         if receiver is None:
             return None, False, None
 
-        sender = await users.find_one({"_id": target})
+        sender = await self._get_user(target)
 
         if sender is None:
             raise ValueError("Unknown receiver")
 
-        chats = self.db["chats"]
-
-        chat = await chats.find_one({"users": {"$all": [target, other]}})
+        name = await self._find_chat(target, other)
 
-        if chat is None:
+        if name is None:
             return [], True, None
-        name = chat["name"]
-        chat = self.db[name]
-
-        aggregation_pipeline = [
-            {
-                "$unwind": "$messages"
-            },
-            {
-                "$match": {"messages.target": target}
-            },
-            {
-                "$lookup": {
-                    "from": "files",
-                    "localField": "messages.files",
-                    "foreignField": "_id",
-                    "as": "messages.server_files"
-                }
-            },
-            {
-                "$project": {
-                    "messages.server_files._id": 0,
-                    "messages.server_files.owner-id": 0
-                }
-            }
-        ]
+        chat, scope = self._chat_messages(name)
 
         if filter_ == 'has-files':
             m = {
-                "messages.files": {
-                    "$exists": True,
-                    "$ne": []
+                "messages": {
+                    "$elemMatch": {
+                        "target": target,
+                        "files.0": {"$exists": True}
+                    }
                 }
             }
         elif filter_ == "new":
-            m = {
-                "seen": False,
-                "receiver-id": target
-            }
+            m = {"receiver-id": target}
         else:
             m = {}
 
-        aggregation_pipeline.append({
-            "$match": m
-        })
-
-        project = {
-            "_id": 0,
-            "sender": "$sender-id",
-            "receiver": "$receiver-id",
-            "time": 1,
-            "text": "$messages.text",
-            "seen": 1,
-            "files": "$messages.server_files"
-        }
+        marks = await self._read_marks(target, other)
 
-        aggregation_pipeline.append({
-            "$project": project
-        })
+        m.update(scope)
+        conditions = [m, self._cursor_match(before, after)]
+        if filter_ == "new":
+            # непрочитанные - полученные после отметки о прочтении
+            conditions.append(self._cursor_match(None, marks.get(target)))
+        conditions = [x for x in conditions if x]
+        m = {"$and": conditions} if conditions else {}
 
-        sort_ = {
-            "time": -1
-        }
+        # при "after" берутся ближайшие к курсору (самые старые) сообщения, затем порядок разворачивается
+        order = 1 if after is not None else -1
 
-        aggregation_pipeline.append({
-            "$sort": sort_
-        })
+        aggregation_pipeline = [
+            {
+                "$match": m
+            },
+            {
+                "$sort": {"time": order, "_id": order}
+            },
+            *self._page_stages(from_, count),
+            *self._message_stages(target)
+        ]
 
         res = []
 
         async for mes in chat.aggregate(aggregation_pipeline):
+            mes["seen"] = self._is_read(self._parse_cursor(mes["cursor"]), marks.get(mes["receiver"]))
             res.append(mes)
 
-        return res[slice(from_, (None if count is None else from_ + count))], True, None
+        if order == 1:
+            res.reverse()
+
+        return res, True, None
 
     async def people_with_messages(self, user_id, list_properties):
         if isinstance(user_id, str):
             user_id = ObjectId(user_id)
 
         from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
         if invalid:
             return None, invalid
 
-        chats = self.db["chats"]
+        summaries = self.db["chat-summaries"]
+
+        m = {"user": user_id}
+        m.update(self._cursor_match(before, after, id_field="message-id"))
+
+        # при "after" берутся ближайшие к курсору (самые старые) беседы, затем порядок разворачивается
+        order = 1 if after is not None else -1
+
         aggregation_pipeline = [
             {
-                "$match": {"users": user_id}
+                "$match": m
             },
             {
-                "$unwind": "$users"
-            },
-            {
-                "$match": {"users": {"$ne": user_id}}
+                "$sort": {"time": order, "message-id": order}
             },
+            *self._page_stages(from_, count),
             {
                 "$lookup": {
                     "from": "users",
-                    "let": {"user_id": "$users"},
+                    "let": {"user_id": "$peer"},
                     "pipeline": [
                         {
                             "$match": {"$expr": {"$eq": ["$_id", "$$user_id"]}},
@@ -451,78 +801,145 @@ class MongoDB:
                     "as": "user"
                 }
             },
+            {
+                "$lookup": {
+                    "from": "chat-summaries",
+                    "let": {"user_id": "$user", "peer_id": "$peer"},
+                    "pipeline": [
+                        {
+                            "$match": {"$expr": {"$and": [{"$eq": ["$user", "$$peer_id"]},
+                                                          {"$eq": ["$peer", "$$user_id"]}]}}
+                        },
+                        {
+                            "$project": {"_id": 0, "read-time": 1, "read-id": 1}
+                        }
+                    ],
+                    "as": "peer-read"
+                }
+            },
             {
                 "$project": {
                     "_id": 0,
                     "user": {"$arrayElemAt": ["$user", 0]},
-                    "name": 1
+                    "last-message": 1,
+                    "unread": 1,
+                    "time": 1,
+                    "message-id": 1,
+                    "read-time": 1,
+                    "read-id": 1,
+                    "peer-read": {"$arrayElemAt": ["$peer-read", 0]}
                 }
             }
         ]
 
-        tasks = []
+        res = []
 
-        async def task(cht_, cur_):
-            res = None
-            async for mes in cur_:
-                res = {
-                    "user": cht_["user"],
-                    "last-message": mes
-                }
-            return res
+        async for cht in summaries.aggregate(aggregation_pipeline):
+            # последнее сообщение прочитано, если отметка его получателя не раньше него
+            reader = cht if cht["last-message"]["receiver"] == user_id else cht.get("peer-read", {})
+            cht["last-message"]["seen"] = self._is_read((cht.pop("time"), cht.pop("message-id")),
+                                                        self._read_mark(reader))
+            for key in ("read-time", "read-id", "peer-read"):
+                cht.pop(key, None)
+            res.append(cht)
 
-        async for cht in chats.aggregate(aggregation_pipeline):
-            aggregation_pipeline = [
-                {
-                    "$sort": {"time": -1}
-                },
-                {
-                    "$limit": 1
-                },
-                {
-                    "$unwind": "$messages"
-                },
+        if order == 1:
+            res.reverse()
+
+        return res, None
+
+    # Все изменения для пользователя после токена предыдущей синхронизации: новые сообщения во всех беседах
+    # по возрастанию курсора (страницами), отметки о прочтении его бесед и смены статусов его собеседников
+    # и пользователей из watched (подписок соединения)
+    async def sync(self, user_id, token, list_properties, watched=()):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        token, count, after, invalid = self._validate_sync(token, list_properties)
+        if invalid:
+            return None, invalid
+
+        since = token[0] if token is not None else 0
+        start = after if after is not None else token
+        summaries = self.db["chat-summaries"]
+
+        # беседы с новыми сообщениями - по индексу сводок (user, time)
+        chats = {}
+        query = {"user": user_id}
+        if start is not None:
+            query["time"] = {"$gte": start[0]}
+        async for summary in summaries.find(query, {"chat": 1, "peer": 1, "read-time": 1, "read-id": 1}):
+            chats[summary["chat"]] = summary
+
+        messages = await self._sync_messages(user_id, list(chats), start, count + 1)
+
+        if messages:
+            marks = {summary["peer"]: self._read_mark(summary) for summary in chats.values()}
+            peer_marks = {}
+            async for summary in summaries.find({"user": {"$in": list(marks)}, "peer": user_id},
+                                                {"user": 1, "read-time": 1, "read-id": 1}):
+                peer_marks[summary["user"]] = self._read_mark(summary)
+            for mes in messages:
+                if mes["receiver"] == user_id:
+                    mark = marks.get(mes["sender"])
+                else:
+                    mark = peer_marks.get(mes["receiver"])
+                mes["seen"] = self._is_read(self._parse_cursor(mes["cursor"]), mark)
+
+        reads, users = [], []
+        if after is None:
+            # прочтения бесед пользователя им самим и его собеседниками - по индексам (user|peer, read-at)
+            async for summary in summaries.find({"$or": [{"user": user_id, "read-at": {"$gte": since}},
+                                                         {"peer": user_id, "read-at": {"$gte": since}}]},
+                                                {"user": 1, "peer": 1, "read-time": 1, "read-id": 1}):
+                reads.append({"reader": summary["user"], "peer": summary["peer"],
+                              "cursor": f"{summary['read-time']}-{summary['read-id']}"})
+            scope = set(await summaries.distinct("peer", {"user": user_id})) | set(watched)
+            users = await self._presence_since(scope, since)
+
+        return self._sync_result(token, after, messages, count, reads, users), None
+
+    async def _sync_messages(self, user_id, names, start, limit):
+        if not names:
+            return []
+
+        match = self._cursor_match(None, start)
+        if self.layout == "single":
+            sources = [(self.db["messages"], {"chat": {"$in": names}})]
+        else:
+            sources = [(self.db[name], {}) for name in names]
+
+        def pipeline(scope):
+            return [
                 {
-                    "$match": {"messages.target": user_id}
+                    "$match": {**scope, **match}
                 },
                 {
-                    "$unwind": {"path": "$message.files", "preserveNullAndEmptyArrays": True}
+                    "$sort": {"time": 1, "_id": 1}
                 },
                 {
-                    "$lookup": {
-                        "from": "files",
-                        "localField": "messages.files",
-                        "foreignField": "_id",
-                        "as": "files"
-                    }
+                    "$limit": limit
                 },
-                {
-                    "$project": {
-                        "_id": 0,
-                        "sender": "$sender-id",
-                        "receiver": "$receiver-id",
-                        "time": 1,
-                        "seen": 1,
-                        "text": "$messages.text",
-                        "files.token": 1,
-                        "files.name": 1,
-                        "files.size": 1
-                    }
-                }
+                *self._message_stages(user_id)
             ]
 
-            cur = self.db[cht["name"]].aggregate(aggregation_pipeline)
-            tasks.append(task(cht, cur))
+        results = await asyncio.gather(*(collection.aggregate(pipeline(scope)).to_list(None)
+                                         for collection, scope in sources))
+        merged = heapq.merge(*results, key=lambda mes: self._parse_cursor(mes["cursor"]))
+        return list(islice(merged, limit))
 
-        res = await asyncio.gather(*tasks)
-        res = sorted(res, key=lambda x: x["last-message"]['time'], reverse=True)
+    async def _presence_since(self, scope, since):
+        changes = {}
+        async for user in self.db["users"].find({"_id": {"$in": list(scope)}, "last-seen": {"$gte": since}},
+                                                {"is-online": 1, "last-seen": 1},
+                                                sort=[("last-seen", -1)], limit=self.sync_users_limit):
+            changes[user["_id"]] = (user["is-online"], user["last-seen"])
 
-        return res[slice(from_, (None if count is None else from_ + count))], None
-
-    async def download(self, user_id, token):
-        users = self.db["users"]
+        return self._sync_users(changes, self.presence.changed_since(since), scope)
 
-        user = await users.find_one({"_id": user_id})
+    # возвращает путь к содержимому и размер файла, если он доступен пользователю
+    async def get_file(self, user_id, token):
+        user = await self._get_user(user_id)
 
         if user is None:
             raise ValueError("Unknown user")
@@ -532,13 +949,50 @@ class MongoDB:
         file = await files.find_one({"token": token})
 
         if file is None:
-            return None, False
+            return None, None
         if file["owner-id"] != user_id:
+            return None, None
+
+        if "blob" in file:
+            return self.file_store.path(file["blob"]), file["size"]
+        return self.file_store.legacy_path(token), file["size"]
+
+    async def download(self, user_id, token):
+        path, _ = await self.get_file(user_id, token)
+
+        if path is None:
             return None, False
 
-        with open(f"files/{token}", encoding="utf-8") as f:
-            return f.read(), True
+        data = await self.file_store.read(path)
+        return data.decode("utf-8"), True
+
+    async def read_file(self, path, offset, length):
+        return await self.file_store.read_range(path, offset, length)
 
+    async def read_file_into(self, path, offset, buffer):
+        return await self.file_store.read_range_into(path, offset, buffer)
+
+    # Отметка о прочтении - (время, _id) последнего сообщения беседы на момент чтения, она хранится
+    # в сводке беседы читателя. Сообщение прочитано получателем, если не позже его отметки.
+    @staticmethod
+    def _read_mark(summary):
+        if summary.get("read-time") is None:
+            return None
+        return summary["read-time"], summary["read-id"]
+
+    @staticmethod
+    def _is_read(key, mark):
+        return mark is not None and key <= mark
+
+    async def _read_marks(self, user1, user2):
+        marks = {}
+        async for summary in self.db["chat-summaries"].find(
+                {"$or": [{"user": user1, "peer": user2}, {"user": user2, "peer": user1}]},
+                {"user": 1, "read-time": 1, "read-id": 1}):
+            marks[summary["user"]] = self._read_mark(summary)
+        return marks
+
+    # Возвращает признак существования собеседника и признак того, что были непрочитанные сообщения
     async def read(self, reader_id, other_id):
         if isinstance(reader_id, str):
             reader_id = ObjectId(reader_id)
@@ -546,25 +1000,21 @@ class MongoDB:
         if isinstance(other_id, str):
             other_id = ObjectId(other_id)
 
-        users = self.db["users"]
-
-        reader = await users.find_one({"_id": reader_id})
+        reader = await self._get_user(reader_id)
 
         if reader is None:
             raise ValueError("Unknown user")
 
-        other = await users.find_one({"_id": other_id})
+        other = await self._get_user(other_id)
 
         if other is None:
-            return False
-
-        chats = self.db["chats"]
-
-        chat = await chats.find_one({"users": {"$all": [reader_id, other_id]}})
-
-        if chat is None:
-            return True
-
-        chat = self.db[chat["name"]]
-        await chat.update_many({"seen": False, "receiver-id": reader_id}, {"$set": {"seen": True}})
-        return True
+            return False, False
+
+        # одна запись: отметка переносится на последнее сообщение беседы, счетчик непрочитанных сбрасывается;
+        # без непрочитанных сводка не изменяется, чтобы sync не получал прочтений, которых не было
+        summary = await self.db["chat-summaries"].find_one_and_update(
+            {"user": reader_id, "peer": other_id, "unread": {"$gt": 0}},
+            [{"$set": {"read-time": "$time", "read-id": "$message-id", "unread": 0, "read-at": int(time.time())}}],
+            {"_id": 1}
+        )
+        return True, summary is not None
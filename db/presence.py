@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("smln.presence")
+
+
+# Отложенная запись статусов пользователей: смены статуса копятся несколько миллисекунд,
+# повторные смены одного пользователя схлопываются в последнюю, и накопленное записывается одной
+# пачкой через write(updates), где updates - {user_id: (is_online, last_seen)}.
+# При массовом переподключении клиентов это одна запись в БД на пачку вместо запроса на каждый вход.
+# Если БД недоступна, повторные попытки выполняются с экспоненциально растущей задержкой до max_retry_delay.
+class PresenceBuffer:
+    def __init__(self, write, interval=0.005, max_retry_delay=5.0):
+        self.write = write
+        self.interval = interval
+        self.max_retry_delay = max_retry_delay
+
+        self.pending = {}
+        self.flusher = None
+        self.metrics = None
+
+        self.updates = 0
+        self.coalesced = 0
+        self.batches = 0
+        self.errors = 0
+
+    def put(self, user_id, is_online, last_seen):
+        self.updates += 1
+        if user_id in self.pending:
+            self.coalesced += 1
+        self.pending[user_id] = (is_online, last_seen)
+
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    # профиль пользователя, прочитанный из БД, может не содержать еще не записанный статус
+    def apply(self, user_id, user):
+        state = self.pending.get(user_id)
+        if state is None:
+            return user
+        return {**user, "is-online": state[0], "last-seen": state[1]}
+
+    # еще не записанные статусы, измененные не раньше since
+    def changed_since(self, since):
+        return {user_id: state for user_id, state in self.pending.items() if state[1] >= since}
+
+    async def _flush_later(self):
+        delay = self.interval
+        failures = 0
+        while self.pending:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception:
+                # пачка возвращена в буфер и будет записана при следующей попытке;
+                # в журнал попадает только первая ошибка, пока БД не станет доступной
+                if not failures:
+                    logger.exception("Presence write failed, retrying with backoff")
+                failures += 1
+                self.errors += 1
+                delay = min(delay * 2, self.max_retry_delay)
+            else:
+                if failures:
+                    logger.info("Presence write recovered after %s failed attempts", failures)
+                delay = self.interval
+                failures = 0
+        self.flusher = None
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.write(batch)
+        except BaseException:
+            # более новые статусы, пришедшие во время записи, важнее неудачно записанных
+            for user_id, state in batch.items():
+                self.pending.setdefault(user_id, state)
+            raise
+
+        self.batches += 1
+        if self.metrics is not None:
+            self.metrics.presence_batch.observe(len(batch))
+            self.metrics.presence_flush_latency.observe(time.perf_counter() - start)
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            try:
+                await self.flusher
+            except asyncio.CancelledError:
+                pass
+            self.flusher = None
+        await self.flush()
@@ -0,0 +1,785 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+
+from db.base import BaseDB
+from db.file_store import FileStore
+from db.presence import PresenceBuffer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    login TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    username TEXT NOT NULL,
+    role TEXT NOT NULL,
+    public_key TEXT NOT NULL,
+    private_key TEXT NOT NULL,
+    is_online INTEGER NOT NULL DEFAULT 0,
+    last_seen INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username, id);
+CREATE INDEX IF NOT EXISTS users_role ON users (role, id);
+CREATE INDEX IF NOT EXISTS users_last_seen ON users (is_online, last_seen, id);
+CREATE INDEX IF NOT EXISTS users_changed ON users (last_seen);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    chat TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    sender_text TEXT NOT NULL,
+    receiver_text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat, time, id);
+
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    token TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS files_message ON files (message, owner);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    time INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS uploads_time ON uploads (time);
+
+CREATE TABLE IF NOT EXISTS summaries (
+    user TEXT NOT NULL,
+    peer TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    unread INTEGER NOT NULL DEFAULT 0,
+    read_time INTEGER,
+    read_message TEXT,
+    read_at INTEGER,
+    PRIMARY KEY (user, peer)
+);
+CREATE INDEX IF NOT EXISTS summaries_user_time ON summaries (user, time, message);
+CREATE INDEX IF NOT EXISTS summaries_user_read ON summaries (user, read_at);
+CREATE INDEX IF NOT EXISTS summaries_peer_read ON summaries (peer, read_at);
+"""
+
+USER_COLUMNS = "u.id, u.username, u.role, u.is_online, u.last_seen, u.public_key"
+# Отметка о прочтении (read_time, read_message) - последнее сообщение беседы на момент чтения,
+# она хранится в сводке беседы читателя. Сообщение прочитано, если не позже отметки получателя.
+SEEN_EXPR = ("EXISTS (SELECT 1 FROM summaries r WHERE r.user = m.receiver AND r.peer = m.sender "
+             "AND (m.time, m.id) <= (r.read_time, r.read_message))")
+MESSAGE_COLUMNS = f"m.id, m.sender, m.receiver, m.time, {SEEN_EXPR}, m.sender_text, m.receiver_text"
+
+
+# Драйвер для установок без MongoDB: данные в одном файле SQLite в режиме WAL.
+# Все запросы выполняются в отдельном потоке с единственным соединением, чтобы не блокировать
+# цикл событий. Операции, накопившиеся, пока поток занят, выполняются следующей пачкой в одной
+# транзакции (каждая - в своей точке сохранения), поэтому на пачку приходится одна фиксация.
+class SQLiteDB(BaseDB):
+    options = ("users_file", "files_root", "file_workers", "presence_flush_interval", "max_upload_size",
+               "upload_ttl")
+
+    def __init__(self, path, password_hasher, users_file=None, files_root="files", file_workers=None,
+                 presence_flush_interval=0.005, max_upload_size=BaseDB.max_upload_size, upload_ttl=BaseDB.upload_ttl):
+        self.path = path
+        self.pswd = password_hasher
+        self.users_file = users_file
+        self.max_upload_size = max_upload_size
+        self.upload_ttl = upload_ttl
+
+        self.counters = Counter()
+
+        self.file_store = FileStore(files_root, file_workers)
+
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+        self.connection = None
+        self.pending = []
+        self.runner = None
+
+        self.presence = PresenceBuffer(self._write_presence, presence_flush_interval)
+
+    @classmethod
+    def from_config(cls, cfg, password_hasher):
+        return cls(cfg.path, password_hasher, **{key: cfg[key] for key in cls.options if key in cfg})
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def _execute_batch(self, batch):
+        if self.connection is None:
+            self._connect()
+
+        results = []
+        cur = self.connection.cursor()
+        cur.execute("BEGIN")
+        for func, args in batch:
+            cur.execute("SAVEPOINT op")
+            try:
+                results.append((func(cur, *args), None))
+                cur.execute("RELEASE op")
+            except Exception as e:
+                cur.execute("ROLLBACK TO op")
+                cur.execute("RELEASE op")
+                results.append((None, e))
+        cur.execute("COMMIT")
+        return results
+
+    async def _run_pending(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            batch, self.pending = self.pending, []
+            self.counters["sqlite-batches"] += 1
+            try:
+                results = await loop.run_in_executor(self.executor, self._execute_batch,
+                                                     [(func, args) for func, args, _ in batch])
+            except Exception as e:
+                results = [(None, e)] * len(batch)
+
+            for (_, _, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        self.runner = None
+
+    # func(cursor, *args) выполняется в потоке БД в составе ближайшей пачки
+    async def _run(self, func, *args):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((func, args, future))
+        self.counters["sqlite-queries"] += 1
+        if self.runner is None:
+            self.runner = asyncio.create_task(self._run_pending())
+        return await future
+
+    async def start(self):
+        await self._run(lambda cur: None)
+        if self.users_file is not None:
+            with open(self.users_file) as f:
+                for user in json.load(f):
+                    await self.add_user(user, replace=False)
+
+    async def close(self):
+        await self.presence.close()
+        if self.runner is not None:
+            await self.runner
+        if self.connection is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.connection.close)
+            self.connection = None
+        self.executor.shutdown()
+        self.file_store.close()
+
+    @staticmethod
+    def _add_user(cur, user, replace):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        cur.execute(f"{verb} INTO users (id, login, password, username, role, public_key, private_key, "
+                    f"is_online, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(user["_id"]), user["login"], user["password"], user["username"], user["role"],
+                     user["public-key"], user["private-key"], int(user["is-online"]), user["last-seen"]))
+
+    async def add_user(self, user, replace=True):
+        user = {"is-online": False, "last-seen": int(time.time()), **user}
+        user["_id"] = ObjectId(user["_id"]) if "_id" in user else ObjectId()
+        await self._run(self._add_user, user, replace)
+        return user["_id"]
+
+    @staticmethod
+    def _user_view(row, public_key=True):
+        res = {
+            "id": ObjectId(row[0]),
+            "username": row[1],
+            "role": row[2],
+            "is-online": bool(row[3]),
+            "last-seen": row[4]
+        }
+        if public_key:
+            res["public-key"] = row[5]
+        return res
+
+    @staticmethod
+    def _select_user(cur, user_id):
+        return cur.execute(f"SELECT {USER_COLUMNS} FROM users u WHERE u.id = ?", (user_id,)).fetchone()
+
+    async def _get_user(self, user_id):
+        return await self._run(self._select_user, str(user_id))
+
+    @staticmethod
+    def _select_password(cur, login):
+        return cur.execute("SELECT id, password, public_key, private_key FROM users WHERE login = ?",
+                           (login,)).fetchone()
+
+    @staticmethod
+    def _update_password(cur, user_id, hashed, rehashed):
+        cur.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (rehashed, user_id, hashed))
+
+    async def validate_password(self, login, password):
+        user = await self._run(self._select_password, login)
+
+        if user is None:
+            return False, None, None, None
+
+        user_id, hashed, pub, pr = user
+
+        valid = await self.pswd.check_password_async(password, hashed)
+
+        if valid:
+            if self.pswd.needs_rehash(hashed):
+                await self._run(self._update_password, user_id, hashed, await self.pswd.hash_password_async(password))
+            return valid, ObjectId(user_id), pub, pr
+        return False, None, None, None
+
+    @staticmethod
+    def _update_statuses(cur, updates):
+        # более новый статус, уже записанный другим воркером, не затирается
+        cur.executemany("UPDATE users SET is_online = ?, last_seen = ? WHERE id = ? AND last_seen <= ?",
+                        [(int(status), last_seen, str(user_id), last_seen)
+                         for user_id, (status, last_seen) in updates.items()])
+
+    async def _write_presence(self, updates):
+        self.counters["presence-queries"] += 1
+        await self._run(self._update_statuses, updates)
+
+    # статус записывается отложенно (см. PresenceBuffer), без проверки существования пользователя
+    async def _update_user_online_status(self, user_id, status):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        last_seen = int(time.time())
+        self.presence.put(user_id, status, last_seen)
+
+        return {"user-id": user_id, "is-online": status, "last-seen": last_seen}
+
+    async def make_user_online(self, user_id):
+        return await self._update_user_online_status(user_id, True)
+
+    async def make_user_offline(self, user_id):
+        return await self._update_user_online_status(user_id, False)
+
+    @staticmethod
+    def _select_people(cur, where, params, order, from_, count):
+        query = f"SELECT {USER_COLUMNS} FROM users u {where} ORDER BY {order} LIMIT ? OFFSET ?"
+        return cur.execute(query, (*params, -1 if count is None else count, from_)).fetchall()
+
+    async def people(self, list_properties):
+        from_, count, invalid = self._validate_properties_range(list_properties)
+
+        sort = list_properties.get("sort", "username")
+        if sort not in ("username", "last-seen", "role"):
+            invalid.add("sort")
+
+        ascend = list_properties.get("is-ascending", sort != "last-seen")
+        if not isinstance(ascend, bool):
+            invalid.add("is-ascending")
+
+        filter_ = list_properties.get("filter", None)
+        if not self._validate_people_filter(filter_):
+            invalid.add("filter")
+
+        if invalid:
+            return None, invalid
+
+        conditions = []
+        params = []
+        if filter_ is not None:
+            for f in filter_.split("&"):
+                if f == "online":
+                    conditions.append("u.is_online = 1")
+                elif f.startswith("role="):
+                    conditions.append("u.role = ?")
+                    params.append(f.split("=", 1)[1])
+                elif f.startswith("name-startswith="):
+                    # диапазон вместо LIKE, чтобы использовался индекс по username
+                    prefix = f.split("=", 1)[1]
+                    conditions.append("u.username >= ? AND u.username < ?")
+                    params.extend((prefix, prefix + "\U0010ffff"))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        direction = "ASC" if ascend else "DESC"
+        if sort == "last-seen":
+            columns = ("u.is_online", "u.last_seen", "u.id")
+        else:
+            columns = (f"u.{sort}", "u.id")
+        # однозначный порядок нужен, чтобы страницы не пересекались
+        order = ", ".join(f"{c} {direction}" for c in columns)
+
+        rows = await self._run(self._select_people, where, params, order, from_, count)
+        return [self._user_view(row) for row in rows], None
+
+    async def get_user(self, user_id):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        row = await self._get_user(user_id)
+
+        if row is None:
+            return None, False
+
+        return self.presence.apply(user_id, self._user_view(row, public_key=False)), True
+
+    @staticmethod
+    def _select_uploaded(cur, owner_id, tokens):
+        marks = ", ".join("?" * len(tokens))
+        rows = cur.execute(f"SELECT token, size, blob FROM files WHERE owner = ? AND token IN ({marks})",
+                           (owner_id, *tokens)).fetchall()
+        return {token: {"size": size, "blob": blob} for token, size, blob in rows}
+
+    async def _find_uploaded(self, owner_id, messages):
+        tokens = list({f["token"] for message in messages for f in message.get("files", []) if "token" in f})
+        if not tokens:
+            return {}
+
+        uploaded = await self._run(self._select_uploaded, str(owner_id), tokens)
+        if len(uploaded) != len(tokens):
+            return None
+        return uploaded
+
+    # содержимое вложений записывается в хранилище заранее, строки files создаются вместе с сообщением
+    async def _store_files(self, files, owner_id, uploaded):
+        res = []
+        for file in files:
+            if "token" in file:
+                digest = uploaded[file["token"]]["blob"]
+                size = uploaded[file["token"]]["size"]
+            else:
+                enc = file["data"].encode('utf-8')
+                digest = await self.file_store.put(enc)
+                size = len(enc)
+
+            res.append({
+                "name": file["name"],
+                "token": uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex,
+                "size": size,
+                "owner-id": owner_id,
+                "blob": digest
+            })
+        return res
+
+    @staticmethod
+    def _insert_files(cur, files, message_id):
+        cur.executemany("INSERT INTO files (token, name, size, owner, blob, message) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(f["token"], f["name"], f["size"], str(f["owner-id"]), f["blob"], message_id)
+                         for f in files])
+        refs = Counter(f["blob"] for f in files)
+        cur.executemany("INSERT INTO blobs (digest, refs) VALUES (?, ?) "
+                        "ON CONFLICT (digest) DO UPDATE SET refs = refs + excluded.refs", refs.items())
+
+    async def upload_begin(self, owner_id, name, size):
+        if not self.file_expr.match(name) or not 0 <= size <= self.max_upload_size:
+            return None
+
+        expired = await self._run(self._delete_expired_uploads, int(time.time()) - self.upload_ttl)
+        if expired:
+            await self.file_store.remove([self.file_store.upload_path(x) for x in expired])
+
+        upload_id = uuid.uuid4().hex
+        await self._run(lambda cur: cur.execute(
+            "INSERT INTO uploads (id, owner, name, size, received, time) VALUES (?, ?, ?, ?, 0, ?)",
+            (upload_id, str(owner_id), name, size, int(time.time()))))
+        return upload_id
+
+    # "time" загрузки - время последнего принятого куска
+    @staticmethod
+    def _delete_expired_uploads(cur, cutoff):
+        expired = [upload_id for upload_id, in cur.execute("SELECT id FROM uploads WHERE time < ?", (cutoff,))]
+        cur.execute("DELETE FROM uploads WHERE time < ?", (cutoff,))
+        return expired
+
+    @staticmethod
+    def _select_upload(cur, owner_id, upload_id):
+        row = cur.execute("SELECT id, owner, name, size, received, time FROM uploads WHERE id = ? AND owner = ?",
+                          (upload_id, owner_id)).fetchone()
+        if row is None:
+            return None
+        return {"_id": row[0], "owner-id": ObjectId(row[1]), "name": row[2], "size": row[3], "received": row[4],
+                "time": row[5]}
+
+    async def upload_status(self, owner_id, upload_id):
+        return await self._run(self._select_upload, str(owner_id), upload_id)
+
+    @staticmethod
+    def _advance_upload(cur, upload_id, offset, received, time_):
+        cur.execute("UPDATE uploads SET received = ?, time = ? WHERE id = ? AND received = ?",
+                    (received, time_, upload_id, offset))
+        return cur.rowcount
+
+    async def upload_chunk(self, owner_id, upload_id, offset, data):
+        upload = await self.upload_status(owner_id, upload_id)
+
+        if upload is None:
+            return None, False
+        if offset != upload["received"] or offset + len(data) > upload["size"]:
+            return upload, False
+
+        await self.file_store.write_at(self.file_store.upload_path(upload_id), offset, data)
+
+        accepted = await self._run(self._advance_upload, upload_id, offset, offset + len(data), int(time.time()))
+        return await self.upload_status(owner_id, upload_id), bool(accepted)
+
+    @staticmethod
+    def _commit_upload(cur, upload_id, file):
+        cur.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        if not cur.rowcount:
+            return False
+        SQLiteDB._insert_files(cur, [file], None)
+        return True
+
+    async def upload_commit(self, owner_id, upload_id):
+        upload = await self.upload_status(owner_id, upload_id)
+
+        if upload is None:
+            return None, False
+        if upload["received"] != upload["size"]:
+            return upload, False
+
+        path = self.file_store.upload_path(upload_id)
+        if upload["size"] == 0:
+            await self.file_store.write_at(path, 0, b"")
+
+        digest = await self.file_store.put_file(path)
+
+        file = {
+            "name": upload["name"],
+            "token": uuid.uuid5(uuid.NAMESPACE_DNS, str(os.urandom(16))).hex,
+            "size": upload["size"],
+            "owner-id": owner_id,
+            "blob": digest
+        }
+
+        if not await self._run(self._commit_upload, upload_id, file):
+            return None, False
+
+        return {"name": file["name"], "token": file["token"], "size": file["size"]}, True
+
+    @staticmethod
+    def _select_message_files(cur, message_ids):
+        files = {}
+        if not message_ids:
+            return files
+        marks = ", ".join("?" * len(message_ids))
+        for message_id, owner, name, token, size in cur.execute(
+                f"SELECT message, owner, name, token, size FROM files WHERE message IN ({marks}) ORDER BY id",
+                message_ids):
+            files.setdefault((message_id, owner), []).append({"name": name, "token": token, "size": size})
+        return files
+
+    @staticmethod
+    def _message_view(row, target, files):
+        message_id, sender, receiver, time_, seen, sender_text, receiver_text = row
+        return {
+            "sender": ObjectId(sender),
+            "receiver": ObjectId(receiver),
+            "time": time_,
+            "text": sender_text if sender == target else receiver_text,
+            "seen": bool(seen),
+            "cursor": f"{time_}-{message_id}",
+            "files": files.get((message_id, target), [])
+        }
+
+    @staticmethod
+    def _insert_message(cur, chat, message, files):
+        cur.execute("INSERT INTO messages (id, chat, sender, receiver, time, sender_text, receiver_text) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (message["id"], chat, message["sender"], message["receiver"], message["time"],
+                     message["sender-text"], message["receiver-text"]))
+        SQLiteDB._insert_files(cur, files, message["id"])
+
+        # summaries хранит для каждой пары (пользователь, собеседник) последнее сообщение
+        # и число непрочитанных, чтобы people-with-messages был одним запросом по индексу
+        cur.executemany("INSERT INTO summaries (user, peer, time, message, unread) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT (user, peer) DO UPDATE SET time = excluded.time, message = excluded.message, "
+                        "unread = unread + excluded.unread",
+                        [(message["sender"], message["receiver"], message["time"], message["id"], 0),
+                         (message["receiver"], message["sender"], message["time"], message["id"], 1)])
+
+    async def send_message(self, sender_id, receiver_id, message_for_receiver, message_for_sender):
+        if isinstance(sender_id, str):
+            sender_id = ObjectId(sender_id)
+
+        if isinstance(receiver_id, str):
+            receiver_id = ObjectId(receiver_id)
+
+        if sender_id == receiver_id:
+            return None, False, None
+
+        if await self._get_user(receiver_id) is None:
+            return None, False, None
+
+        if await self._get_user(sender_id) is None:
+            raise ValueError("Unknown sender")
+
+        for message in message_for_receiver, message_for_sender:
+
+            text = message.get("text", "")
+            files = message.get("files", [])
+
+            if not (text or files):
+                return None, True, "The message is empty"
+
+            if not self._validate_files(files):
+                return None, True, "invalid file"
+
+        uploaded = await self._find_uploaded(sender_id, (message_for_receiver, message_for_sender))
+        if uploaded is None:
+            return None, True, "invalid file"
+
+        sender_files = await self._store_files(message_for_sender.get("files", []), sender_id, uploaded)
+        receiver_files = await self._store_files(message_for_receiver.get("files", []), receiver_id, uploaded)
+
+        message = {
+            "id": str(ObjectId()),
+            "sender": str(sender_id),
+            "receiver": str(receiver_id),
+            "time": int(time.time()),
+            "sender-text": message_for_sender["text"],
+            "receiver-text": message_for_receiver["text"]
+        }
+        await self._run(self._insert_message, self._chat_key(sender_id, receiver_id), message,
+                        sender_files + receiver_files)
+
+        row = (message["id"], message["sender"], message["receiver"], message["time"], 0,
+               message["sender-text"], message["receiver-text"])
+        files = {}
+        for f in receiver_files:
+            files.setdefault((message["id"], message["receiver"]), []).append(
+                {"name": f["name"], "token": f["token"], "size": f["size"]})
+
+        return self._message_view(row, message["receiver"], files), True, None
+
+    @staticmethod
+    def _cursor_condition(before, after, time_column, id_column, params):
+        if before is not None:
+            op, (time_, id_) = "<", before
+        elif after is not None:
+            op, (time_, id_) = ">", after
+        else:
+            return ""
+        params.extend((time_, time_, str(id_)))
+        return f" AND ({time_column} {op} ? OR ({time_column} = ? AND {id_column} {op} ?))"
+
+    @staticmethod
+    def _select_messages(cur, query, params, target):
+        rows = cur.execute(query, params).fetchall()
+        files = SQLiteDB._select_message_files(cur, [row[0] for row in rows])
+        return [SQLiteDB._message_view(row, target, files) for row in rows]
+
+    async def messages(self, target, other, list_properties):
+        from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
+
+        if isinstance(target, str):
+            target = ObjectId(target)
+        if isinstance(other, str):
+            other = ObjectId(other)
+
+        filter_ = list_properties.get("filter", None)
+        if filter_ not in {"has-files", "new", None}:
+            invalid.add("filter")
+
+        if invalid:
+            return None, None, invalid
+
+        if await self._get_user(other) is None:
+            return None, False, None
+
+        if await self._get_user(target) is None:
+            raise ValueError("Unknown receiver")
+
+        params = [self._chat_key(target, other)]
+        query = f"SELECT {MESSAGE_COLUMNS} FROM messages m WHERE m.chat = ?"
+
+        if filter_ == "has-files":
+            query += " AND EXISTS (SELECT 1 FROM files f WHERE f.message = m.id AND f.owner = ?)"
+            params.append(str(target))
+        elif filter_ == "new":
+            # непрочитанные - полученные после отметки о прочтении
+            query += (" AND m.receiver = ? AND (m.time, m.id) > (SELECT IFNULL(read_time, -1), "
+                      "IFNULL(read_message, '') FROM summaries WHERE user = ? AND peer = ?)")
+            params.extend((str(target), str(target), str(other)))
+
+        query += self._cursor_condition(before, after, "m.time", "m.id", params)
+
+        # при "after" берутся ближайшие к курсору (самые старые) сообщения, затем порядок разворачивается
+        direction = "ASC" if after is not None else "DESC"
+        query += f" ORDER BY m.time {direction}, m.id {direction} LIMIT ? OFFSET ?"
+        params.extend((-1 if count is None else count, from_))
+
+        res = await self._run(self._select_messages, query, params, str(target))
+
+        if after is not None:
+            res.reverse()
+
+        return res, True, None
+
+    @staticmethod
+    def _select_chats(cur, query, params, user_id):
+        rows = cur.execute(query, params).fetchall()
+        files = SQLiteDB._select_message_files(cur, [row[6] for row in rows])
+        return [{
+            "user": SQLiteDB._user_view(row[:6]),
+            "last-message": SQLiteDB._message_view(row[6:13], user_id, files),
+            "unread": row[13]
+        } for row in rows]
+
+    async def people_with_messages(self, user_id, list_properties):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        from_, count, invalid = self._validate_properties_range(list_properties)
+        before, after = self._validate_properties_cursor(list_properties, invalid)
+        if invalid:
+            return None, invalid
+
+        params = [str(user_id)]
+        query = (f"SELECT {USER_COLUMNS}, {MESSAGE_COLUMNS}, s.unread FROM summaries s "
+                 f"JOIN users u ON u.id = s.peer JOIN messages m ON m.id = s.message WHERE s.user = ?")
+        query += self._cursor_condition(before, after, "s.time", "s.message", params)
+
+        # при "after" берутся ближайшие к курсору (самые старые) беседы, затем порядок разворачивается
+        direction = "ASC" if after is not None else "DESC"
+        query += f" ORDER BY s.time {direction}, s.message {direction} LIMIT ? OFFSET ?"
+        params.extend((-1 if count is None else count, from_))
+
+        res = await self._run(self._select_chats, query, params, str(user_id))
+
+        if after is not None:
+            res.reverse()
+
+        return res, None
+
+    # все запросы sync выполняются одной операцией, то есть в одной транзакции
+    @staticmethod
+    def _select_sync(cur, user_id, since, start, first, watched, limit, users_limit):
+        # беседы с новыми сообщениями - по индексу сводок (user, time)
+        query, params = "SELECT peer FROM summaries WHERE user = ?", [user_id]
+        if start is not None:
+            query += " AND time >= ?"
+            params.append(start[0])
+        chats = [SQLiteDB._chat_key(user_id, peer) for peer, in cur.execute(query, params)]
+        messages = []
+        if chats:
+            params = list(chats)
+            query = f"SELECT {MESSAGE_COLUMNS} FROM messages m WHERE m.chat IN ({', '.join('?' * len(chats))})"
+            query += SQLiteDB._cursor_condition(None, start, "m.time", "m.id", params)
+            query += " ORDER BY m.time, m.id LIMIT ?"
+            params.append(limit)
+            messages = SQLiteDB._select_messages(cur, query, params, user_id)
+
+        if not first:
+            return messages, [], [], []
+
+        reads = [{"reader": ObjectId(reader), "peer": ObjectId(peer), "cursor": f"{read_time}-{read_message}"}
+                 for reader, peer, read_time, read_message in cur.execute(
+                     "SELECT user, peer, read_time, read_message FROM summaries WHERE user = ? AND read_at >= ? "
+                     "UNION ALL "
+                     "SELECT user, peer, read_time, read_message FROM summaries WHERE peer = ? AND read_at >= ?",
+                     (user_id, since, user_id, since))]
+
+        # статусы собеседников и пользователей из watched
+        users = cur.execute(
+            f"SELECT id, is_online, last_seen FROM users WHERE last_seen >= ? "
+            f"AND (id IN (SELECT peer FROM summaries WHERE user = ?) OR id IN ({', '.join('?' * len(watched))})) "
+            f"ORDER BY last_seen DESC LIMIT ?",
+            (since, user_id, *watched, users_limit)).fetchall()
+        peers = [peer for peer, in cur.execute("SELECT peer FROM summaries WHERE user = ?", (user_id,))]
+        return messages, reads, users, peers
+
+    # Все изменения для пользователя после токена предыдущей синхронизации: новые сообщения во всех беседах
+    # по возрастанию курсора (страницами), отметки о прочтении его бесед и смены статусов его собеседников
+    # и пользователей из watched (подписок соединения)
+    async def sync(self, user_id, token, list_properties, watched=()):
+        if isinstance(user_id, str):
+            user_id = ObjectId(user_id)
+
+        token, count, after, invalid = self._validate_sync(token, list_properties)
+        if invalid:
+            return None, invalid
+
+        since = token[0] if token is not None else 0
+        start = after if after is not None else token
+        watched = [str(x) for x in watched]
+        messages, reads, rows, peers = await self._run(self._select_sync, str(user_id), since, start, after is None,
+                                                watched, count + 1, self.sync_users_limit)
+
+        users = []
+        if after is None:
+            scope = {ObjectId(x) for x in [*watched, *peers]}
+            changes = {ObjectId(id_): (bool(is_online), last_seen) for id_, is_online, last_seen in rows}
+            users = self._sync_users(changes, self.presence.changed_since(since), scope)
+
+        return self._sync_result(token, after, messages, count, reads, users), None
+
+    async def get_file(self, user_id, token):
+        if await self._get_user(user_id) is None:
+            raise ValueError("Unknown user")
+
+        file = await self._run(lambda cur: cur.execute("SELECT owner, blob, size FROM files WHERE token = ?",
+                                                       (token,)).fetchone())
+
+        if file is None:
+            return None, None
+        if file[0] != str(user_id):
+            return None, None
+
+        return self.file_store.path(file[1]), file[2]
+
+    async def download(self, user_id, token):
+        path, _ = await self.get_file(user_id, token)
+
+        if path is None:
+            return None, False
+
+        data = await self.file_store.read(path)
+        return data.decode("utf-8"), True
+
+    async def read_file(self, path, offset, length):
+        return await self.file_store.read_range(path, offset, length)
+
+    async def read_file_into(self, path, offset, buffer):
+        return await self.file_store.read_range_into(path, offset, buffer)
+
+    # одна запись: отметка переносится на последнее сообщение беседы, если были непрочитанные
+    @staticmethod
+    def _mark_read(cur, reader_id, other_id, read_at):
+        cur.execute("UPDATE summaries SET read_time = time, read_message = message, unread = 0, read_at = ? "
+                    "WHERE user = ? AND peer = ? AND unread > 0", (read_at, reader_id, other_id))
+        return cur.rowcount > 0
+
+    # Возвращает признак существования собеседника и признак того, что были непрочитанные сообщения
+    async def read(self, reader_id, other_id):
+        if isinstance(reader_id, str):
+            reader_id = ObjectId(reader_id)
+
+        if isinstance(other_id, str):
+            other_id = ObjectId(other_id)
+
+        if await self._get_user(reader_id) is None:
+            raise ValueError("Unknown user")
+
+        if await self._get_user(other_id) is None:
+            return False, False
+
+        return True, await self._run(self._mark_read, str(reader_id), str(other_id), int(time.time()))
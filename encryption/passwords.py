@@ -1,16 +1,101 @@
+import asyncio
 import hashlib
+import hmac
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 from encryption.utils import *
 
+hash_algorithms = {name: getattr(hashlib, name) for name in hashlib.algorithms_guaranteed}
+
+
+def _scrypt(password, salt, n, r, p):
+    # с запасом к минимально необходимой памяти 128 * r * (n + p + 2)
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p + 2), dklen=32).hex()
+
+
+def _pbkdf2_sha256(password, salt, i):
+    return hashlib.pbkdf2_hmac("sha256", password, salt, i).hex()
+
+
+kdf_functions = {
+    "scrypt": _scrypt,
+    "pbkdf2_sha256": _pbkdf2_sha256
+}
+
+default_kdf_params = {
+    "scrypt": {"n": 2 ** 14, "r": 8, "p": 1},
+    "pbkdf2_sha256": {"i": 600000}
+}
+
+
+def encode_params(params):
+    return ",".join(f"{key}={value}" for key, value in params.items())
+
+
+def decode_params(params):
+    return {key: int(value) for key, value in (x.split("=", 1) for x in params.split(","))}
+
+
+def hash_with_kdf(password, kdf, params):
+    salt = generate_salt()
+    digest = kdf_functions[kdf](password.encode("utf-8"), salt, **params)
+    return f"{kdf}${encode_params(params)}${salt.decode('utf-8')}${digest}"
+
+
+# Форматы хэша:
+#   "<alg>$<salt>$<digest>" - устаревший, один проход хэш-функции hashlib
+#   "<kdf>$<params>$<salt>$<digest>" - функция формирования ключа (scrypt, pbkdf2_sha256)
+#   с параметрами, например "scrypt$n=16384,r=8,p=1$<salt>$<digest>"
+# Функция вынесена на уровень модуля, чтобы ее можно было выполнять в пуле процессов.
+def verify(password, hashed_password):
+    parts = hashed_password.split('$')
+    password = password.encode("utf-8")
+
+    if len(parts) == 3:
+        alg_name, salt, digest = parts
+        m = hash_algorithms[alg_name]()
+        m.update(salt.encode("utf-8"))
+        m.update(password)
+        return hmac.compare_digest(m.hexdigest(), digest)
+
+    kdf, params, salt, digest = parts
+    res = kdf_functions[kdf](password, salt.encode("utf-8"), **decode_params(params))
+    return hmac.compare_digest(res, digest)
+
 
 class PasswordHasher:
-    hash_algorithms = {name: getattr(hashlib, name) for name in hashlib.algorithms_guaranteed}
+    hash_algorithms = hash_algorithms
 
-    def __init__(self, alg):
+    def __init__(self, alg, kdf=None, kdf_params=None, executor="process", workers=None, max_concurrency=None):
         self.alg = self.hash_algorithms[alg]
         self.alg_name = alg
 
+        if kdf is not None and kdf not in kdf_functions:
+            raise ValueError("Unknown key derivation function")
+        self.kdf = kdf
+        self.kdf_params = {**default_kdf_params[kdf], **(kdf_params or {})} if kdf is not None else None
+
+        if executor not in ("process", "thread"):
+            raise ValueError("Unknown executor")
+        self.executor_type = executor
+        self.workers = workers
+        # по умолчанию - не больше проверок одновременно, чем исполнителей в пуле
+        self.max_concurrency = max_concurrency
+
+        self.executor = None
+        self.semaphore = None
+
+    @classmethod
+    def from_config(cls, crypto):
+        options = {key: crypto[key] for key in ("kdf", "kdf_params", "executor", "workers", "max_concurrency")
+                   if key in crypto}
+        return cls(crypto.hash_alg, **options)
+
     def hash_password(self, password):
 
+        if self.kdf is not None:
+            return hash_with_kdf(password, self.kdf, self.kdf_params)
+
         salt = generate_salt()
 
         m = self.alg()
@@ -19,14 +104,47 @@ class PasswordHasher:
         return f"{self.alg_name}${salt.decode('utf-8')}${m.hexdigest()}"
 
     def check_password(self, password, hashed_password):
-        alg_name, salt, digest = hashed_password.split('$')
+        return verify(password, hashed_password)
 
-        alg = self.hash_algorithms[alg_name]
+    # хэш, сохраненный в устаревшем формате или с другими параметрами, нужно пересчитать при входе
+    def needs_rehash(self, hashed_password):
+        if self.kdf is None:
+            return False
+        parts = hashed_password.split('$')
+        return len(parts) != 4 or parts[0] != self.kdf or decode_params(parts[1]) != self.kdf_params
 
-        m = alg()
-        m.update(salt.encode("utf-8"))
-        m.update(password.encode("utf-8"))
-        return m.hexdigest() == digest
+    def _get_executor(self):
+        if self.executor is None:
+            if self.executor_type == "process":
+                self.executor = ProcessPoolExecutor(self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(self.workers)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency or self.executor._max_workers)
+        return self.executor
+
+    async def _run(self, func, *args):
+        executor = self._get_executor()
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    # устаревший хэш - один проход хэш-функции, он проверяется за микросекунды и быстрее без пула
+    @staticmethod
+    def is_legacy(hashed_password):
+        return hashed_password.count('$') == 2
+
+    async def check_password_async(self, password, hashed_password):
+        if self.is_legacy(hashed_password):
+            return verify(password, hashed_password)
+        return await self._run(verify, password, hashed_password)
+
+    async def hash_password_async(self, password):
+        if self.kdf is None:
+            return self.hash_password(password)
+        return await self._run(hash_with_kdf, password, self.kdf, self.kdf_params)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
 
 
 if __name__ == '__main__':
@@ -22,6 +22,34 @@ db.users.createIndex(
     }
 );
 
+db.users.createIndex(
+    {
+        "last-seen": 1
+    }
+);
+
+db.users.createIndex(
+    {
+        "username": 1,
+        "_id": 1
+    }
+);
+
+db.users.createIndex(
+    {
+        "role": 1,
+        "_id": 1
+    }
+);
+
+db.users.createIndex(
+    {
+        "is-online": 1,
+        "last-seen": 1,
+        "_id": 1
+    }
+);
+
 db.files.createIndex(
     {
         "token": 1
@@ -31,10 +59,66 @@ db.files.createIndex(
     }
 );
 
+db.uploads.createIndex(
+    {
+        "time": 1
+    }
+);
+
 db.chats.createIndex(
     {
         "users": 1
     }
 )
+
+db.chats.createIndex(
+    {
+        "key": 1
+    },
+    {
+        "unique": true,
+        "partialFilterExpression": {"key": {"$exists": true}}
+    }
+);
+db["chat-summaries"].createIndex(
+    {
+        "user": 1,
+        "peer": 1
+    },
+    {
+        "unique": true
+    }
+);
+
+db["chat-summaries"].createIndex(
+    {
+        "user": 1,
+        "time": -1,
+        "message-id": -1
+    }
+);
+
+db["chat-summaries"].createIndex(
+    {
+        "user": 1,
+        "read-at": 1
+    }
+);
+
+db["chat-summaries"].createIndex(
+    {
+        "peer": 1,
+        "read-at": 1
+    }
+);
+
+db.messages.createIndex(
+    {
+        "chat": 1,
+        "time": -1,
+        "_id": -1
+    }
+);
+
 db.test_collection.insertOne({"test": "test"})
 db.test_collection.drop()
\ No newline at end of file
@@ -1,12 +1,18 @@
 import asyncio
 import logging
+import multiprocessing
 import os
+import signal
 from sys import argv
 import db as drivers
 
 import websockets
+from core import log
+from core.cluster import Bus, ClusterRegistry
+from core.codecs import Codecs
 from core.connection import Connection
 from core.connection_registry import ConnectionRegistry
+from core.metrics import Metrics
 from encryption import *
 from config import yaml_config
 
@@ -19,28 +25,162 @@ def init_file_system():
         os.mkdir("logs")
 
 
-async def main():
-    init_file_system()
+logger = logging.getLogger("smln")
 
-    cfg = yaml_config(argv[1])
-    logging.basicConfig(
-        filename=f"logs/{cfg.logging.file_name}",
-        level=getattr(logging, cfg.logging.level),
-        format=cfg.logging.format,
-        datefmt=cfg.logging.datetime_format
+
+def init_logging(cfg):
+    # structured - дописывать к записям поля из extra в виде key=value
+    return log.init_logging(
+        f"logs/{cfg.logging.file_name}",
+        getattr(logging, cfg.logging.level),
+        cfg.logging.format,
+        cfg.logging.datetime_format,
+        cfg.logging.get("structured", False)
     )
+
+
+def connect_db(cfg):
     driver = drivers.get(cfg.db.driver)
+    return driver.from_config(cfg.db, PasswordHasher.from_config(cfg.crypto))
+
+
+# db - уже созданный драйвер БД (например, в бенчмарках); по умолчанию создается по конфигурации
+async def serve(cfg, bus_path=None, db=None):
+    if db is None:
+        db = connect_db(cfg)
+    await db.start()
+
+    broadcast_concurrency = 256
+    if hasattr(cfg, "broadcast"):
+        broadcast_concurrency = cfg.broadcast.concurrency
+
+    # число запросов одного соединения, выполняемых одновременно; 1 - последовательная обработка
+    max_in_flight = 1
+    if hasattr(cfg, "pipeline"):
+        max_in_flight = cfg.pipeline.max_in_flight
+
+    # наибольший кусок файла в одном ответе на частичную загрузку
+    # и наибольшее число одновременных потоковых загрузок одного соединения
+    max_chunk_size = 256 * 1024
+    max_streams = 4
+    if hasattr(cfg, "download"):
+        max_chunk_size = cfg.download.max_chunk_size
+        max_streams = cfg.download.get("max_streams", 4)
+
+    # кодеки сообщений: JSON (через orjson, если он установлен и не отключен) и MessagePack
+    codecs = Codecs()
+    if hasattr(cfg, "codec"):
+        codecs = Codecs(**cfg.codec)
+
+    # доля сообщений и рассылок событий, о которых пишется запись уровня INFO
+    log_sampler = log.Sampler(cfg.logging.get("sample_rate", 1.0))
+
+    # метрики в формате Prometheus отдаются по HTTP на том же порту, что и websocket
+    metrics = Metrics()
+    process_request = None
+    if hasattr(cfg, "metrics"):
+        process_request = metrics.http_handler(cfg.metrics.path)
+
+    # кому и с какой задержкой рассылаются смены статуса пользователей
+    presence = {}
+    if hasattr(cfg, "presence"):
+        presence = {"presence_scope": cfg.presence.get("scope", "all"),
+                    "presence_debounce": cfg.presence.get("debounce", 0.2),
+                    "max_subscriptions": cfg.presence.get("max_subscriptions", 1000)}
+
+    if bus_path is None:
+        registry = ConnectionRegistry(logger, broadcast_concurrency, **presence)
+        done = asyncio.Future()
+    else:
+        registry = ClusterRegistry(logger, bus_path, broadcast_concurrency, **presence)
+        await registry.connect_bus()
+        # воркер завершается, если потерял связь с шиной - супервизор запустит новый
+        done = registry.listener
 
-    auth = ""
-    if hasattr(cfg.db, "login"):
-        auth = f"{cfg.db.login}:{cfg.db.password}@"
+    registry.broadcaster.log_sampler = log_sampler
+    metrics.watch(registry, db)
 
-    connection_string = f"mongodb://{auth}{cfg.db.host}"
+    # в режиме нескольких воркеров все они слушают один порт (SO_REUSEPORT)
+    handler = Connection.connect(registry, db, logger, codecs, max_in_flight, max_chunk_size, log_sampler, metrics,
+                                 max_streams)
+    try:
+        async with websockets.serve(handler, cfg.ip, cfg.port, reuse_port=bus_path is not None,
+                                    subprotocols=codecs.subprotocols, process_request=process_request):
 
-    db = driver(connection_string, PasswordHasher(cfg.crypto.hash_alg))
-    async with websockets.serve(Connection.connect(ConnectionRegistry(logging), db, logging), cfg.ip, cfg.port):
+            await done
+    finally:
+        # накопленные смены статуса записываются до выхода, затем останавливается пул проверки паролей
+        await db.close()
+        db.pswd.close()
+
+
+# Супервизор останавливает воркеров через SIGTERM. Обработчик сигнала отменяет serve, чтобы
+# соединения закрылись, а накопленные смены статуса были записаны в БД до выхода процесса
+async def serve_worker(cfg, bus_path, db=None):
+    server = asyncio.create_task(serve(cfg, bus_path, db))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.cancel)
+    try:
+        await server
+    except asyncio.CancelledError:
+        logger.info("Worker %s stopped", os.getpid())
+
+
+def run_worker(config_path, bus_path):
+    cfg = yaml_config(config_path)
+    listener = init_logging(cfg)
+    try:
+        asyncio.run(serve_worker(cfg, bus_path))
+    finally:
+        listener.stop()
+
+
+async def supervise(cfg, config_path):
+    bus_path = cfg.cluster.bus_path
+    if os.path.exists(bus_path):
+        os.remove(bus_path)
+
+    bus = Bus(bus_path, logger)
+    await bus.start()
+
+    context = multiprocessing.get_context("spawn")
+
+    # воркеры не демонические: демоническому процессу нельзя создавать дочерние, а они нужны
+    # пулу процессов для проверки паролей. Поэтому супервизор завершает воркеров сам
+    def start_worker():
+        process = context.Process(target=run_worker, args=(config_path, bus_path))
+        process.start()
+        logger.info("Worker %s started", process.pid)
+        return process
+
+    workers = [start_worker() for _ in range(cfg.cluster.workers)]
+    try:
+        while True:
+            await asyncio.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.warning("Worker %s exited with code %s, restarting", process.pid, process.exitcode)
+                    workers[i] = start_worker()
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+        await bus.close()
+
+
+async def main():
+    init_file_system()
+
+    cfg = yaml_config(argv[1])
+    listener = init_logging(cfg)
 
-        await asyncio.Future()
+    try:
+        if hasattr(cfg, "cluster") and cfg.cluster.workers > 1:
+            await supervise(cfg, argv[1])
+        else:
+            await serve(cfg)
+    finally:
+        listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,83 @@
+# Драйверы БД, которым не нужны внешние сервисы: InMemoryDB и SQLiteDB во временной папке.
+# MongoDB (MONGO) работает с FakeDatabase и годится только для входа и смен статуса.
+# pytest-asyncio не используется, поэтому тесты запускают свои сценарии через asyncio.run
+import asyncio
+import inspect
+import os
+import tempfile
+from collections import Counter
+
+from bson import ObjectId
+
+from db import InMemoryDB, MongoDB, SQLiteDB
+from encryption.passwords import PasswordHasher
+from tests.fake_mongo import FakeDatabase
+
+DRIVERS = ("InMemoryDB", "SQLiteDB")
+MONGO = "MongoDB"
+PASSWORD = "password"
+
+
+def make_users(n, hashed):
+    return [{"_id": ObjectId(), "login": f"user{i}", "password": hashed, "username": f"User {i}", "role": "user",
+             "public-key": "", "private-key": "", "is-online": False, "last-seen": 0} for i in range(n)]
+
+
+# возвращает запущенный драйвер и id созданных пользователей; options - параметры конструктора драйвера
+async def open_db(driver, n_users, **options):
+    hasher = PasswordHasher("sha3_256", executor="thread")
+    users = make_users(n_users, hasher.hash_password(PASSWORD))
+    root = tempfile.mkdtemp()
+
+    if driver == "SQLiteDB":
+        db = SQLiteDB(os.path.join(root, "test.db"), hasher, files_root=root, **options)
+        await db.start()
+        for user in users:
+            await db.add_user(user)
+    elif driver == MONGO:
+        # клиент motor не подключается, пока к нему не обращаются
+        db = MongoDB("mongodb://localhost:27017", hasher, files_root=root, **options)
+        db.db = FakeDatabase()
+        await db.db["users"].insert_many(users)
+        await db.start()
+    else:
+        db = InMemoryDB(hasher, files_root=root, **options)
+        for user in users:
+            db.add_user(user)
+
+    return db, [user["_id"] for user in users]
+
+
+async def send(db, sender_id, receiver_id, text):
+    message, _, _ = await db.send_message(sender_id, receiver_id, {"text": text}, {"text": text})
+    return message
+
+
+# Считает вызовы открытых корутин драйвера - обращения к БД со стороны соединений и реестра
+class CountingDB:
+    def __init__(self, driver):
+        self.driver = driver
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.driver, name)
+        if name.startswith("_") or not inspect.iscoroutinefunction(attr):
+            return attr
+
+        async def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+# выполняет сценарий scenario(db, *user_ids) на новом драйвере
+def run(driver, scenario, n_users=2):
+    async def main():
+        db, user_ids = await open_db(driver, n_users)
+        try:
+            await scenario(db, *user_ids)
+        finally:
+            await db.close()
+
+    asyncio.run(main())
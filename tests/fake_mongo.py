@@ -0,0 +1,90 @@
+# Минимальная замена базы motor для тестов драйвера MongoDB без сервера: коллекции в памяти,
+# только операции, нужные входу и записи статусов, и счетчик вызовов каждой операции.
+# Change stream, как на MongoDB без набора реплик, недоступен
+from collections import Counter, defaultdict
+
+from pymongo.errors import OperationFailure
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$gt" and not (value is not None and value > operand):
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$not" and matches(document, {key: operand}):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def project(document, projection):
+    if not projection:
+        return dict(document)
+    return {key: value for key, value in document.items() if key == "_id" or key in projection}
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = iter(documents)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, calls):
+        self.documents = {}
+        self.calls = calls
+
+    async def insert_many(self, documents):
+        for document in documents:
+            self.documents[document["_id"]] = dict(document)
+
+    async def find_one(self, query, projection=None):
+        self.calls["find_one"] += 1
+        return next((project(d, projection) for d in self.documents.values() if matches(d, query)), None)
+
+    def find(self, query, projection=None):
+        self.calls["find"] += 1
+        return FakeCursor([project(d, projection) for d in self.documents.values() if matches(d, query)])
+
+    async def update_one(self, query, update):
+        self.calls["update_one"] += 1
+        self._update(query, update)
+
+    # как у MongoDB без набора реплик
+    def watch(self, *args, **kwargs):
+        self.calls["watch"] += 1
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", 40573)
+
+    async def bulk_write(self, requests, ordered=True):
+        self.calls["bulk_write"] += 1
+        for request in requests:
+            self._update(request._filter, request._doc)
+
+    def _update(self, query, update):
+        document = next((d for d in self.documents.values() if matches(d, query)), None)
+        if document is not None:
+            document.update(update["$set"])
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.calls = Counter()
+        self.collections = defaultdict(lambda: FakeCollection(self.calls))
+
+    def __getitem__(self, name):
+        return self.collections[name]
@@ -0,0 +1,26 @@
+import pytest
+
+from core.codecs import Codecs, FastJsonCodec, JsonCodec, orjson
+
+JSON_CODECS = (JsonCodec, pytest.param(FastJsonCodec, marks=pytest.mark.skipif(orjson is None, reason="no orjson")))
+
+
+# JSON принимается и в текстовых, и в бинарных кадрах (UTF-8)
+@pytest.mark.parametrize("codec", JSON_CODECS)
+def test_json_decodes_text_and_binary_frames(codec):
+    msg = {"type": "send", "args": {"text": "привет"}}
+    encoded = codec.encode(msg)
+
+    assert codec.decode(encoded) == msg
+    assert codec.decode(encoded.encode("utf-8")) == msg
+
+
+@pytest.mark.parametrize("codec", JSON_CODECS)
+def test_json_rejects_invalid_utf8(codec):
+    with pytest.raises(ValueError):
+        codec.decode(b'{"type": "\\xff\xff"}')
+
+
+def test_json_is_used_without_subprotocol():
+    codecs = Codecs()
+    assert codecs.get(None) is codecs.json
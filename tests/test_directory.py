@@ -0,0 +1,27 @@
+import asyncio
+import logging
+
+from tests.drivers import MONGO, make_users, open_db
+
+
+# Без change stream (MongoDB без набора реплик) ошибка записывается в журнал один раз,
+# а справочник пользователей перезагружается периодически
+def test_directory_refresh_without_change_stream(caplog):
+    async def main():
+        db, _ = await open_db(MONGO, 2, watch_users=True, directory_refresh=0.05)
+        try:
+            (user,) = make_users(1, "")
+            user["login"] = "late"
+            await db.db["users"].insert_many([user])
+            await asyncio.sleep(0.3)
+            return len(db.directory), dict(db.counters)
+        finally:
+            await db.close()
+
+    with caplog.at_level(logging.ERROR, logger="smln.db"):
+        size, counters = asyncio.run(main())
+
+    assert size == 3
+    assert counters["watch-errors"] == 1
+    assert counters["directory-loads"] > 2
+    assert len(caplog.records) == 1
@@ -0,0 +1,55 @@
+import asyncio
+import base64
+import json
+
+import pytest
+import websockets
+
+from bench.load import free_port
+from config import Config
+from main import serve
+from tests.drivers import DRIVERS, PASSWORD, open_db
+
+
+# Потоковые загрузки сверх download.max_streams отклоняются со статусом 3,
+# пока уже начатые не завершатся
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_streams_over_limit_are_refused(driver):
+    async def main():
+        db, _ = await open_db(driver, 1)
+        port = free_port()
+        cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0}),
+                      "download": Config({"max_chunk_size": 256 * 1024, "max_streams": 2})})
+        server = asyncio.create_task(serve(cfg, db=db))
+        await asyncio.sleep(0.2)
+
+        async def request(ws, type_, args):
+            await ws.send(json.dumps({"type": type_, "args": args}))
+            while True:
+                response = json.loads(await ws.recv())
+                if response["type"] == type_:
+                    return response
+
+        try:
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}")
+            await request(ws, "auth", {"login": "user0", "pass": PASSWORD})
+
+            data = bytes(512 * 1024)
+            upload = await request(ws, "upload-begin", {"name": "file", "size": len(data)})
+            upload_id = upload["args"]["upload-id"]
+            for offset in range(0, len(data), 64 * 1024):
+                chunk = base64.b64encode(data[offset:offset + 64 * 1024]).decode("ascii")
+                await request(ws, "upload-chunk", {"upload-id": upload_id, "offset": offset, "data": chunk})
+            token = (await request(ws, "upload-commit", {"upload-id": upload_id}))["args"]["file"]["token"]
+
+            # по 16 байт в куске первые две загрузки идут дольше, чем приходит третий запрос
+            args = {"token": token, "stream": True, "chunk-size": 16}
+            statuses = [(await request(ws, "download", args))["status"]["status"] for _ in range(3)]
+            await ws.close()
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+        assert statuses == [0, 0, 3]
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import pytest
+
+from tests.drivers import DRIVERS, run, send
+
+
+# страницы по курсору в обе стороны не теряют и не повторяют сообщений
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_messages_cursor_pages(driver):
+    async def scenario(db, a, b):
+        sent = [await send(db, *((a, b) if i % 2 else (b, a)), f"m{i}") for i in range(7)]
+        cursors = [m["cursor"] for m in sent]
+
+        # от новых к старым: before - курсор самого старого сообщения страницы
+        pages, properties = [], {"count": 3}
+        while True:
+            page, _, invalid = await db.messages(a, b, properties)
+            assert invalid is None
+            if not page:
+                break
+            pages.append([m["cursor"] for m in page])
+            properties = {"count": 3, "before": page[-1]["cursor"]}
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert sum(pages, []) == cursors[::-1]
+
+        # от старых к новым: страница тоже упорядочена от новых к старым, after - ее первый курсор
+        collected, properties = [], {"count": 3, "after": cursors[0]}
+        while True:
+            page, _, _ = await db.messages(b, a, properties)
+            if not page:
+                break
+            collected += [m["cursor"] for m in reversed(page)]
+            properties = {"count": 3, "after": page[0]["cursor"]}
+        assert collected == cursors[1:]
+
+        _, _, invalid = await db.messages(a, b, {"before": "bad"})
+        assert invalid == {"before"}
+
+    run(driver, scenario)
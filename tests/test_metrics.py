@@ -0,0 +1,39 @@
+import asyncio
+import urllib.request
+
+from bench.load import free_port
+from config import Config
+from main import serve
+from tests.drivers import open_db
+
+
+# Растущие показатели экспортируются как counter с суффиксом _total, текущие - как gauge.
+# SQLiteDB, в отличие от InMemoryDB, пишет статусы через PresenceBuffer и отдает все показатели
+def test_metric_types():
+    async def main():
+        db, _ = await open_db("SQLiteDB", 1)
+        port = free_port()
+        cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0}),
+                      "metrics": Config({"path": "/metrics"})})
+        server = asyncio.create_task(serve(cfg, db=db))
+        await asyncio.sleep(0.2)
+
+        def fetch():
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                return response.read().decode("utf-8")
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, fetch)
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    text = asyncio.run(main())
+    types = dict(line.split()[2:4] for line in text.splitlines() if line.startswith("# TYPE"))
+
+    for name in ("smln_db_queries_total", "smln_presence_events_total", "smln_presence_frames_total",
+                 "smln_cache_lookups_total", "smln_presence_updates_total"):
+        assert types[name] == "counter"
+    for name in ("smln_connections", "smln_broadcast_pending", "smln_presence_subscriptions",
+                 "smln_presence_pending"):
+        assert types[name] == "gauge"
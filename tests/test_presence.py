@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import signal
+import sqlite3
+from collections import Counter
+
+import pytest
+import websockets
+
+from bench.load import free_port
+from config import Config
+from main import serve, serve_worker
+from tests.drivers import DRIVERS, MONGO, PASSWORD, CountingDB, open_db
+
+
+# Вход и выход пользователя - по одной записи статуса и ни одного чтения пользователя на получателя
+# activity-update: число обращений к БД не зависит от числа подключенных получателей
+@pytest.mark.parametrize("driver", (*DRIVERS, MONGO))
+def test_presence_cost_does_not_grow_with_recipients(driver):
+    async def main():
+        db, _ = await open_db(driver, 8)
+        counting = CountingDB(db)
+        port = free_port()
+        cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0})})
+        server = asyncio.create_task(serve(cfg, db=counting))
+        await asyncio.sleep(0.2)
+
+        async def login(i):
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}")
+            await ws.send(json.dumps({"type": "auth", "args": {"login": f"user{i}", "pass": PASSWORD}}))
+            assert json.loads(await ws.recv())["status"]["status"] == 0
+            return ws
+
+        # вызовы методов драйвера, счетчики драйвера и, для MongoDB, операции с коллекциями
+        def snapshot():
+            calls = Counter(counting.calls)
+            calls.update(db.counters)
+            if driver == MONGO:
+                calls.update(db.db.calls)
+            return calls
+
+        async def cost(recipients):
+            watchers = [await login(i) for i in range(1, recipients + 1)]
+            await asyncio.sleep(0.3)
+            before = snapshot()
+
+            ws = await login(0)
+            await asyncio.sleep(0.3)
+            await ws.close()
+            await asyncio.sleep(0.3)
+            spent = snapshot() - before
+
+            for watcher in watchers:
+                await watcher.close()
+            await asyncio.sleep(0.3)
+            return spent
+
+        try:
+            one = await cost(1)
+            many = await cost(6)
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+        assert one == many
+        assert one["presence-queries"] == 2
+        assert one["get_user"] == 0 and one["user-queries"] == 0
+
+    asyncio.run(main())
+
+
+# Запоздавшая запись статуса (повтор после ошибки, другой воркер) не затирает более новый
+@pytest.mark.parametrize("driver", ("SQLiteDB", MONGO))
+def test_older_presence_write_is_ignored(driver):
+    async def main():
+        db, (user_id,) = await open_db(driver, 1)
+
+        async def stored():
+            if driver == MONGO:
+                user = db.db["users"].documents[user_id]
+            else:
+                user, _ = await db.get_user(user_id)
+            return user["is-online"], user["last-seen"]
+
+        try:
+            await db._write_presence({user_id: (True, 200)})
+            await db._write_presence({user_id: (False, 100)})
+            assert await stored() == (True, 200)
+
+            # в пределах одной секунды побеждает последняя запись
+            await db._write_presence({user_id: (False, 200)})
+            assert await stored() == (False, 200)
+        finally:
+            await db.close()
+
+    asyncio.run(main())
+
+
+# SIGTERM от супервизора завершает воркер с записью накопленных смен статуса
+def test_worker_flushes_presence_on_sigterm():
+    async def main():
+        db, (user_id,) = await open_db("SQLiteDB", 1)
+        port = free_port()
+        cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0})})
+        worker = asyncio.create_task(serve_worker(cfg, None, db))
+        await asyncio.sleep(0.2)
+
+        ws = await websockets.connect(f"ws://127.0.0.1:{port}")
+        await ws.send(json.dumps({"type": "auth", "args": {"login": "user0", "pass": PASSWORD}}))
+        await ws.recv()
+        await asyncio.sleep(0.1)
+
+        # смена статуса при отключении еще в буфере, когда приходит сигнал
+        db.presence.interval = 60
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(worker, 5)
+
+        with sqlite3.connect(db.path) as connection:
+            row = connection.execute("SELECT is_online FROM users WHERE id = ?", (str(user_id),)).fetchone()
+        assert row == (0,)
+
+    asyncio.run(main())
+
+
+# Несколько смен статуса одним событием получают только клиенты, запросившие это при входе
+def test_batched_presence_is_opt_in():
+    async def main():
+        db, _ = await open_db("SQLiteDB", 4)
+        port = free_port()
+        cfg = Config({"ip": "127.0.0.1", "port": port, "logging": Config({"sample_rate": 0.0}),
+                      "presence": Config({"debounce": 0.3})})
+        server = asyncio.create_task(serve(cfg, db=db))
+        await asyncio.sleep(0.2)
+
+        async def login(i, **args):
+            ws = await websockets.connect(f"ws://127.0.0.1:{port}")
+            await ws.send(json.dumps({"type": "auth", "args": {"login": f"user{i}", "pass": PASSWORD, **args}}))
+            while json.loads(await ws.recv())["type"] != "auth":
+                pass
+            return ws
+
+        async def updates(ws):
+            frames = []
+            try:
+                while True:
+                    msg = json.loads(await asyncio.wait_for(ws.recv(), 0.6))
+                    if msg["type"] == "activity-update":
+                        frames.append(msg["args"])
+            except asyncio.TimeoutError:
+                return frames
+
+        try:
+            legacy = await login(0)
+            batched = await login(1, **{"batch-presence": True})
+            await asyncio.gather(updates(legacy), updates(batched))
+
+            # оба входа попадают в одно окно debounce
+            await login(2)
+            await login(3)
+            return await asyncio.gather(updates(legacy), updates(batched))
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    legacy, batched = asyncio.run(main())
+
+    assert len(legacy) == 2 and all("user-id" in frame for frame in legacy)
+    assert len(batched) == 1 and len(batched[0]["users"]) == 2
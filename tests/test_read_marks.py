@@ -0,0 +1,33 @@
+import pytest
+
+from tests.drivers import DRIVERS, run, send
+
+
+# "new" и "seen" определяются отметкой о прочтении получателя
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_new_filter_follows_read_mark(driver):
+    async def scenario(db, a, b):
+        for i in range(3):
+            await send(db, b, a, f"old{i}")
+        await send(db, a, b, "reply")
+
+        assert await db.read(a, b) == (True, True)
+        # без непрочитанных отметка не переносится
+        assert await db.read(a, b) == (True, False)
+
+        await send(db, b, a, "new0")
+        await send(db, b, a, "new1")
+
+        new, _, _ = await db.messages(a, b, {"filter": "new"})
+        assert [m["text"] for m in new] == ["new1", "new0"]
+        assert not any(m["seen"] for m in new)
+
+        history, _, _ = await db.messages(a, b, {})
+        seen = {m["text"]: m["seen"] for m in history}
+        assert seen == {"old0": True, "old1": True, "old2": True, "reply": False, "new0": False, "new1": False}
+
+        assert await db.read(a, b) == (True, True)
+        new, _, _ = await db.messages(a, b, {"filter": "new"})
+        assert new == []
+
+    run(driver, scenario)
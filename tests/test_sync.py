@@ -0,0 +1,79 @@
+import pytest
+
+from tests.drivers import DRIVERS, run, send
+
+
+# страницы sync в сумме дают все сообщения пользователя в порядке курсоров; отметки о прочтении,
+# статусы и токен - только на первой странице
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_sync_pages(driver):
+    async def scenario(db, a, b, c):
+        expected = []
+        for i in range(5):
+            expected.append((await send(db, b, a, f"b{i}"))["cursor"])
+            expected.append((await send(db, a, c, f"c{i}"))["cursor"])
+            await send(db, b, c, "not for a")
+        await db.read(a, b)
+
+        collected, properties, first = [], {"count": 3}, True
+        while True:
+            res, invalid = await db.sync(a, None, properties)
+            assert invalid is None
+            collected += [m["cursor"] for m in res["messages"]]
+            if first:
+                assert res["token"] is not None
+                assert [(x["reader"], x["peer"]) for x in res["reads"]] == [(a, b)]
+            else:
+                assert res["token"] is None and res["reads"] == [] and res["users"] == []
+            first = False
+            if not res["has-more"]:
+                break
+            properties = {"count": 3, "after": res["cursor"]}
+        assert collected == expected
+
+        _, invalid = await db.sync(a, None, {"before": expected[0]})
+        assert invalid == {"before"}
+        _, invalid = await db.sync(a, "bad", {})
+        assert invalid == {"token"}
+
+    run(driver, scenario, 3)
+
+
+# после токена приходят новые сообщения; токен отстает от текущего времени, поэтому недавние
+# сообщения приходят повторно, а не теряются
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_sync_token(driver):
+    async def scenario(db, a, b):
+        old = await send(db, b, a, "old")
+        res, _ = await db.sync(a, None, {})
+        token = res["token"]
+
+        new = await send(db, a, b, "new")
+        res, _ = await db.sync(a, token, {})
+        assert [m["cursor"] for m in res["messages"]] == [old["cursor"], new["cursor"]]
+
+        db.sync_settle = -60
+        res, _ = await db.sync(a, None, {})
+        res, _ = await db.sync(a, res["token"], {})
+        assert res["messages"] == [] and res["reads"] == [] and res["users"] == []
+
+    run(driver, scenario)
+
+
+# статусы в sync - только собеседников и пользователей, на которых подписано соединение
+@pytest.mark.parametrize("driver", DRIVERS)
+def test_sync_presence_scope(driver):
+    async def scenario(db, a, peer, stranger, watched):
+        await send(db, peer, a, "hi")
+        for user_id in peer, stranger, watched:
+            await db.make_user_online(user_id)
+
+        res, _ = await db.sync(a, None, {}, watched={watched})
+        assert {u["user-id"] for u in res["users"]} == {peer, watched}
+        assert all(u["is-online"] for u in res["users"])
+
+        db.sync_users_limit = 1
+        res, _ = await db.sync(a, None, {}, watched={watched})
+        assert len(res["users"]) == 1
+
+    run(driver, scenario, 4)